@@ -6,8 +6,9 @@ from optparse import OptionGroup, OptionParser
 from time import sleep
 
 from apoclypsebm import log
+from apoclypsebm.mining.sensors import SensorSampler
 from apoclypsebm.switch import Switch
-from apoclypsebm.util import tokenize
+from apoclypsebm.util import tokenize, tokenize_weights
 from apoclypsebm.version import VERSION
 
 
@@ -16,9 +17,15 @@ class LongPollingSocket(socket.socket):
     Socket wrapper to enable socket.TCP_NODELAY and KEEPALIVE
     """
 
-    def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0):
-        super(LongPollingSocket, self).__init__(family, type, proto)
-        if type == socket.SOCK_STREAM:
+    def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0,
+                 fileno=None):
+        super(LongPollingSocket, self).__init__(family, type, proto, fileno)
+        # Sockets wrapping existing ones, like the event loop's socketpair,
+        # are left alone.
+        if fileno is not None:
+            return
+        if type == socket.SOCK_STREAM and family in (socket.AF_INET,
+                                                     socket.AF_INET6):
             self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         self.settimeout(20)
@@ -40,6 +47,9 @@ parser.add_option('--no-ocl', dest='no_ocl', action='store_true', help="don't us
 parser.add_option('--no-bfl', dest='no_bfl', action='store_true', help="don't use Butterfly Labs")
 parser.add_option('--stratum-proxies', dest='stratum_proxies', action='store_true',
                   help="search for and use stratum proxies in subnet")
+parser.add_option('--weights', dest='weights', default='',
+                  help='mine for several servers at once, as comma separated tag=weight, splitting hashes between them in'
+                       ' proportion to their weights. Servers without a weight are left out')
 parser.add_option('-d', '--device', dest='device', default=[],
                   help='comma separated device IDs, by default will use all (for OpenCL - only GPU devices)')
 parser.add_option('-a', '--address', dest='address',
@@ -56,13 +66,43 @@ group.add_option('-t', '--tolerance', dest='tolerance', default=2,
                  help='use fallback pool only after N consecutive connection errors, default 2', type='int')
 group.add_option('-b', '--failback', dest='failback', default=60,
                  help='attempt to fail back to the primary pool after N seconds, default 60', type='int')
+group.add_option('--standby', dest='standby', default=1,
+                 help='number of backup pools kept connected and following their jobs, to fail over to at once,'
+                      ' default 1. The primary pool is also kept on standby while on a backup', type='int')
+group.add_option('--latency', dest='latency', action='store_true',
+                 help='mine for the pool with the lowest latency among the current one and those on standby, by'
+                      ' connect time, request round trip and delay notifying new blocks, instead of the first one'
+                      ' up in the order given. Set --standby to cover the pools to choose from')
 group.add_option('--cutoff-temp', dest='cutoff_temp', default=[],
-                 help='AMD GPUs, BFL only. For GPUs requires github.com/mjmvisser/adl3. Comma separated temperatures at'
-                      ' which to skip kernel execution, in C, default=95')
+                 help='AMD GPUs with github.com/mjmvisser/adl3, GPUs with a Linux hwmon sensor and BFL only. Comma'
+                      ' separated temperatures at which to stop hashing, in C, default=95')
+group.add_option('--throttle-band', dest='throttle_band', default=[],
+                 help='comma separated ranges below CUTOFF_TEMP over which hashing is throttled, from full speed at'
+                      ' its bottom to stopped at CUTOFF_TEMP, in C, default=5')
 group.add_option('--cutoff-interval', dest='cutoff_interval', default=[],
-                 help='how long to not execute calculations if CUTOFF_TEMP is reached, in seconds, default=0.01')
+                 help='how long to wait before checking again while throttled, in seconds, default=0.01')
+group.add_option('--hwmon', dest='hwmon', default=[],
+                 help='OpenCL only. Comma separated Linux hwmon directories or temperature inputs to read each'
+                      " device's temperature from, by default found from the device's PCI address")
+group.add_option('--power', dest='power', default=[],
+                 help='OpenCL only. Comma separated Linux hwmon directories or power inputs to read each device\'s'
+                      ' power draw from, by default found like --hwmon')
+group.add_option('--efficiency', dest='efficiency', action='store_true',
+                 help='OpenCL devices with a power sensor only. Keep searching frames and duty cycle for the most'
+                      ' hashes per joule instead of running at the most hashes per second')
+group.add_option('--efficiency-window', dest='efficiency_window', default=30, type='float',
+                 help='seconds each operating point is measured for when searching for efficiency, default=30')
 group.add_option('--no-server-failbacks', dest='nsf', action='store_true',
                  help='disable using failback hosts provided by server')
+group.add_option('--version-rolls', dest='version_rolls', default=4, type='int',
+                 help='number of block versions to mine each job with where the server allows version rolling'
+                      ' (BIP 310), default 4. 1 disables version rolling')
+group.add_option('--shard', dest='shard', action='store_true',
+                 help='split the nonces of each work unit between devices in proportion to their hash rates instead'
+                      ' of building a work unit for each device. Not for BFL devices')
+group.add_option('--prefetch', dest='prefetch', default=2,
+                 help='number of work units the pool\'s work source keeps ready for each device, default 2. 0 only'
+                      ' gets work once a device asks for it', type='int')
 parser.add_option_group(group)
 
 group = OptionGroup(parser,
@@ -72,7 +112,7 @@ group = OptionGroup(parser,
                     "Use --vv to specify per-device vectors usage."
                     )
 group.add_option('-p', '--platform', dest='platform', default=-1, help='use platform by id', type='int')
-group.add_option('-k', '--kernel', dest='kernel', default='apoclypse-0',
+group.add_option('-k', '--kernel', dest='kernel', default=None,
                   choices=('apoclypse-0', 'apoclypse-loopy',),
                   help='OpenCL Kernel to use. Defaults to apoclypse-0')
 group.add_option('-w', '--worksize', dest='worksize', default=[],
@@ -81,16 +121,35 @@ group.add_option('-f', '--frames', dest='frames', default=[],
                  help='will try to bring single kernel execution to 1/frames seconds, default=30, increase this for'
                       ' less desktop lag')
 group.add_option('-s', '--sleep', dest='frame_sleep', default=[], help='sleep per frame in seconds, default 0')
+group.add_option('--queue-depth', dest='queue_depth', default=[],
+                 help='number of kernel executions kept in flight, default=2. 1 waits for each execution to finish'
+                      ' before queuing the next')
+group.add_option('--timings', dest='timings', action='store_true',
+                 help='time every kernel execution and readback with OpenCL profiling events. With --verbose, kernel,'
+                      ' host gap and readback time histograms are shown for each device')
 group.add_option('--vv', dest='vectors', default=[], help='Specifies size of SIMD vectors per selected device. Only size 0 (no vectors) and 2 supported for now. Comma separated for each device. e.g. 0,2,2')
 group.add_option('-v', '--vectors', dest='old_vectors', action='store_true', help='Use 2-item vectors for all devices.')
+group.add_option('--autotune', dest='autotune', action='store_true',
+                 help='benchmark kernel, worksize, vectors and frames on each selected device, save the fastest as the'
+                      ' device profile and exit. Options given restrict the values tried')
+group.add_option('--profile-file', dest='profile_file', default=None,
+                 help='file autotuned device profiles are saved to and loaded from, default is profiles.json in the'
+                      ' user config directory. Options given override the profile')
+group.add_option('--prebuild', dest='prebuild', action='store_true',
+                 help='compile every kernel, worksize and vectors combination for the selected devices into the kernel'
+                      ' cache and exit. Options given restrict the combinations built')
+group.add_option('--cache-dir', dest='cache_dir', default=None,
+                 help='directory compiled kernels are cached in, default is kernels in the user cache directory')
+group.add_option('--cache-size', dest='cache_size', default=256, type='float',
+                 help='evict least recently used compiled kernels beyond this many MiB, default=256')
+group.add_option('--cache-age', dest='cache_age', default=30, type='float',
+                 help='evict compiled kernels unused for this many days, default=30')
 parser.add_option_group(group)
 
 
-def main():
-    options, options.servers = parser.parse_args()
-
-    log.verbose = options.verbose
-    log.quiet = options.quiet
+def parse_options(args=None):
+    """Parses the command line, args or sys.argv[1:], into options."""
+    options, options.servers = parser.parse_args(args)
 
     options.rate = max(options.rate, 60) if options.verbose else max(options.rate, 0.1)
 
@@ -101,11 +160,36 @@ def main():
     options.device = tokenize(options.device, 'device', [])
 
     options.cutoff_temp = tokenize(options.cutoff_temp, 'cutoff_temp', [95], float)
+    options.throttle_band = tokenize(options.throttle_band, 'throttle_band', [5], float)
     options.cutoff_interval = tokenize(options.cutoff_interval, 'cutoff_interval', [0.01], float)
+    options.hwmon = tokenize(options.hwmon, 'hwmon', [], str)
+    options.power = tokenize(options.power, 'power', [], str)
+    options.weights = tokenize_weights(options.weights)
+    return options
+
+
+def main():
+    options = parse_options()
+
+    log.verbose = options.verbose
+    log.quiet = options.quiet
 
     options_encoding = sys.stdin.encoding
 
+    if options.prebuild:
+        from apoclypsebm.mining import opencl
+
+        opencl.prebuild(options)
+        return
+
+    if options.autotune:
+        from apoclypsebm.mining import autotune
+
+        autotune.autotune(options)
+        return
+
     switch = None
+    sensors = SensorSampler()
     try:
         switch = Switch(options, options_encoding)
 
@@ -127,11 +211,15 @@ def main():
             print('\nNothing to mine on, exiting\n')
         else:
             for miner in switch.miners:
+                if miner.sensor or miner.power_sensor:
+                    sensors.add(miner)
                 miner.start()
+            sensors.start()
             switch.loop()
     except KeyboardInterrupt:
         print('\nbye')
     finally:
+        sensors.stop()
         for miner in switch.miners:
             miner.stop()
         if switch:
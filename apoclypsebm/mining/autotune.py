@@ -0,0 +1,120 @@
+import json
+import os
+from itertools import product
+
+from apoclypsebm.log import say_line
+from apoclypsebm.util import atomic_write, tokenize, user_dir
+
+KERNELS = ('apoclypse-0', 'apoclypse-loopy')
+FRAMES = (60, 30, 15)
+MIN_WORKSIZE = 32
+BENCHMARK_SECONDS = 3
+
+# Later candidates must beat the best so far by this factor to replace it,
+# so that measurement noise doesn't trade away lower latency (higher frames)
+# or the default kernel for nothing.
+IMPROVEMENT = 1.02
+
+
+def default_profile_file():
+    return os.path.join(user_dir('config'), 'profiles.json')
+
+
+def profile_key(device):
+    return (
+        f'{device.platform.name.strip()}|{device.name.strip()}'
+        f'|{device.driver_version.strip()}'
+    )
+
+
+def load_profiles(path):
+    try:
+        with open(path or default_profile_file()) as profile_file:
+            return json.load(profile_file)
+    except FileNotFoundError:
+        return {}
+    except (IOError, ValueError) as e:
+        say_line('Ignoring unreadable autotune profiles: %s', e)
+        return {}
+
+
+def save_profiles(path, profiles):
+    data = json.dumps(profiles, indent=2, sort_keys=True)
+    atomic_write(path or default_profile_file(), data.encode('utf-8'))
+
+
+def candidate_worksizes(max_worksize):
+    worksizes = []
+    worksize = MIN_WORKSIZE
+    while worksize < max_worksize:
+        worksizes.append(worksize)
+        worksize *= 2
+    return worksizes + [max_worksize]
+
+
+def candidates(options, max_worksize):
+    """
+    The kernel, worksize and vectors combinations to try on a device, limited
+    to the ones given in options.
+    """
+    from apoclypsebm.mining.opencl import vectors_option
+
+    kernels = (options.kernel,) if options.kernel else KERNELS
+    worksizes = tokenize(options.worksize, 'worksize', ())
+    vectors = (True,) if options.old_vectors else tokenize(
+        options.vectors, 'vectors', (False, True), vectors_option)
+    return list(product(
+        kernels, worksizes or candidate_worksizes(max_worksize), vectors
+    ))
+
+
+def autotune(options, seconds=BENCHMARK_SECONDS):
+    """
+    Benchmarks the kernel, worksize, vectors and frames combinations on each
+    selected OpenCL device with a synthetic job and saves the fastest as the
+    profile opencl.initialize() applies to that device. Options given by the
+    user restrict the combinations tried.
+    """
+    from apoclypsebm.mining import opencl
+
+    if not opencl.OPENCL:
+        say_line('OpenCL is not available, nothing to tune')
+        return {}
+
+    frames = tokenize(options.frames, 'frames', FRAMES)
+
+    profiles = load_profiles(options.profile_file)
+    for device_idx in opencl.select_devices(options):
+        miner = opencl.OpenCLMiner(device_idx, options)
+        best = None
+        for kernel, worksize, vector in candidates(
+                options, miner.device.max_work_group_size):
+            miner.kernel_name = kernel
+            miner.worksize = worksize
+            miner.vectors = vector
+            try:
+                rate_divisor, hashspace = miner.build()
+            except opencl.cl.Error as e:
+                say_line('%s: kernel %s, worksize %d, vectors %s failed: %s',
+                         (miner.id(), kernel, worksize, vector, e))
+                continue
+
+            for frame in frames:
+                miner.frames = frame
+                rate = miner.benchmark(seconds, rate_divisor)
+                say_line('%s: kernel %s, worksize %d, vectors %s, frames %d:'
+                         ' %.03f MH/s',
+                         (miner.id(), kernel, worksize, vector, frame, rate))
+                if not best or rate > best['rate'] * IMPROVEMENT:
+                    best = {'kernel': kernel, 'worksize': worksize,
+                            'vectors': vector, 'frames': frame, 'rate': rate}
+
+        if best:
+            say_line('%s: best is kernel %s, worksize %d, vectors %s, frames %d'
+                     ' (%.03f MH/s)',
+                     (miner.id(), best['kernel'], best['worksize'],
+                      best['vectors'], best['frames'], best['rate']))
+            profiles[profile_key(miner.device)] = best
+            save_profiles(options.profile_file, profiles)
+
+    return profiles
@@ -1,21 +1,60 @@
+from collections import deque
 from queue import Queue
 from threading import Thread
 from time import monotonic
 
+from apoclypsebm.mining.sensors import DEFAULT_BAND, duty_cycle
+from apoclypsebm.util import CountingLock
+
 
 class Miner(object):
+    # Whether the miner can be given part of the nonces of a work unit.
+    shardable = True
+
     def __init__(self, device_idx, options):
         self.device_idx = device_idx
         self.options = options
 
         self.update_time_counter = 1
         self.share_count = [0, 0]
+        # Results dropped for being found on work that had gone stale.
+        self.stale_count = 0
         self.work_queue = Queue()
+        # Work units prepared ahead by the source, taken by want_work().
+        self.work_buffer = deque()
+        # Taken by the mining thread and the switch to move work between the
+        # buffer and the queue, never across network I/O.
+        self.work_lock = CountingLock()
 
         self.update = True
+        # The server the miner works for when mining with --weights.
+        self.pool = None
 
         self.accept_hist = []
         self.rate = self.estimated_rate = 0
+        self.stats = {}
+        self.target_update = None
+
+        # Sensors are callables returning the device temperature in C and
+        # power draw in W. The sensor sampler keeps temperature and power up
+        # to date from them.
+        self.sensor = None
+        self.temperature = None
+        self.power_sensor = None
+        self.power = None
+        self.cutoff_temp = 95
+        self.throttle_band = DEFAULT_BAND
+
+    @property
+    def update(self):
+        """Whether the miner wants new work. Setting it wakes the switch."""
+        return self._update
+
+    @update.setter
+    def update(self, update):
+        self._update = update
+        if update and hasattr(self, 'switch'):
+            self.switch.wake()
 
     def start(self):
         self.should_stop = False
@@ -27,6 +66,37 @@ class Miner(object):
             print('\n%s' % message)
         self.should_stop = True
 
+    def duty_cycle(self):
+        """The fraction of the time to hash at the latest temperature."""
+        return duty_cycle(self.temperature, self.cutoff_temp,
+                          self.throttle_band)
+
+    def want_work(self):
+        """Moves on to the next prefetched work unit, or asks the source for
+        work if there's none ready. Either way the source then refills the
+        buffer."""
+        try:
+            with self.work_lock:
+                self.work_queue.put(self.work_buffer.popleft())
+        except IndexError:
+            self.update = True
+        else:
+            self.switch.wake()
+
+    def target_updated(self, server, target, targetQ):
+        """Applies a share target changed by server to its current, queued
+        and prefetched work."""
+        self.target_update = (server, target, targetQ)
+        with self.work_lock:
+            for work in self.work_buffer:
+                if work.server is server:
+                    work.target, work.targetQ = target, targetQ
+            # The miner thread takes work off the queue under its mutex.
+            with self.work_queue.mutex:
+                for work in self.work_queue.queue:
+                    if work and work.server is server:
+                        work.target, work.targetQ = target, targetQ
+
     def update_rate(self, now, iterations, t, targetQ, rate_divisor=1000):
         self.rate = (iterations / t) / rate_divisor
         self.rate /= 1000
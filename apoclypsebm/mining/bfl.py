@@ -2,6 +2,7 @@ from binascii import unhexlify
 from queue import Empty
 from struct import error, pack, unpack
 from sys import maxsize
+from threading import Lock
 from time import sleep, time
 
 import serial
@@ -10,6 +11,7 @@ from serial.serialutil import SerialException
 from apoclypsebm.ioutil import find_com_ports, find_serial_by_id, find_udev
 from apoclypsebm.log import say_exception, say_line
 from apoclypsebm.mining.base import Miner
+from apoclypsebm.mining.sensors import pause
 from apoclypsebm.util import Object, bytereverse, uint32
 
 CHECK_INTERVAL = 0.01
@@ -78,10 +80,15 @@ def initialize(options):
             min(i, len(options.cutoff_temp) - 1)]
         miners[i].cutoff_interval = options.cutoff_interval[
             min(i, len(options.cutoff_interval) - 1)]
+        miners[i].throttle_band = options.throttle_band[
+            min(i, len(options.throttle_band) - 1)]
     return miners
 
 
 class BFLMiner(Miner):
+    # Units always search all nonces of a job.
+    shardable = False
+
     def __init__(self, device_idx, port, options):
         super(BFLMiner, self).__init__(device_idx, options)
         self.port = port
@@ -91,18 +98,31 @@ class BFLMiner(Miner):
         self.last_job = None
         self.min_interval = maxsize
 
+        # The sensor sampler asks for the temperature between the mining
+        # thread's requests.
+        self.device = None
+        self.device_lock = Lock()
+        self.sensor = self.get_temperature
+        # Throttled, jobs aren't started before resume_at.
+        self.resume_at = 0
+
     def id(self):
         return self.device_name
 
     def is_ok(self, response):
         return response and response == b'OK\n'
 
+    def request(self, message):
+        with self.device_lock:
+            return request(self.device, message)
+
     def put_job(self):
-        if self.busy: return
+        if self.busy or not self.job: return
 
-        temperature = self.get_temperature()
-        if temperature < self.cutoff_temp:
-            response = request(self.device, b'ZDX')
+        if self.duty_cycle() > 0:
+            if time() < self.resume_at:
+                return
+            response = self.request(b'ZDX')
             if self.is_ok(response):
                 if self.switch.update_time:
                     self.job.time = bytereverse(
@@ -110,8 +130,8 @@ class BFLMiner(Miner):
                 data = b''.join([pack('<8I', *self.job.state),
                                  pack('<3I', self.job.merkle_end, self.job.time,
                                       self.job.difficulty)])
-                response = request(self.device,
-                                   b''.join([b'>>>>>>>>', data, b'>>>>>>>>']))
+                response = self.request(
+                    b''.join([b'>>>>>>>>', data, b'>>>>>>>>']))
                 if self.is_ok(response):
                     self.busy = True
                     self.job_started = time()
@@ -132,7 +152,7 @@ class BFLMiner(Miner):
                     if not self.switch.update_time or bytereverse(
                             self.job.time) - bytereverse(
                             self.job.original_time) > 55:
-                        self.update = True
+                        self.want_work()
                         self.job = None
                 else:
                     say_line('%s: bad response when sending block data: %s',
@@ -144,15 +164,17 @@ class BFLMiner(Miner):
             say_line('%s: temperature exceeds cutoff, waiting...', self.id())
 
     def get_temperature(self):
-        response = request(self.device, b'ZLX')
-        if len(response) < 23 or response[0] != b'T' or response[-1:] != b'\n':
+        response = self.request(b'ZLX')
+        if response is None:
+            return None
+        if len(response) < 23 or response[:1] != b'T' or response[-1:] != b'\n':
             say_line('%s: bad response for temperature: %s',
                      (self.id(), response))
-            return 0
+            return None
         return float(response[23:-1])
 
     def check_result(self):
-        response = request(self.device, b'ZFX')
+        response = self.request(b'ZFX')
         if response.startswith(b'B'): return False
         if response == b'NO-NONCE\n': return response
         if response[:12] != 'NONCE-FOUND:' or response[-1:] != '\n':
@@ -174,14 +196,15 @@ class BFLMiner(Miner):
 
         while not self.should_stop:
             try:
-                self.device = open_device(self.port)
-                response = init_device(self.device)
+                device = open_device(self.port)
+                with self.device_lock:
+                    self.device = device
+                    response = init_device(self.device)
                 if not is_good_init(response):
                     say_line(
                         'Failed to initialize %s (response: %s), retrying...',
                         (self.id(), response))
-                    self.device.close()
-                    self.device = None
+                    self.close_device()
                     sleep(1)
                     continue
 
@@ -198,7 +221,8 @@ class BFLMiner(Miner):
                             if not self.busy:
                                 continue
                         else:
-                            if not self.job and not self.busy:
+                            # Flushed work leaves the job running to finish.
+                            if not self.job:
                                 continue
                             targetQ = self.job.targetQ
                             self.job.original_time = self.job.time
@@ -215,6 +239,10 @@ class BFLMiner(Miner):
                             self.busy = False
                             r = self.last_job
                             job_duration = now - self.job_started
+                            duty = self.duty_cycle()
+                            if duty < 1:
+                                self.resume_at = now + pause(job_duration,
+                                                             duty)
                             self.put_job()
 
                             self.min_interval = min(self.min_interval,
@@ -231,7 +259,8 @@ class BFLMiner(Miner):
                                 r.nonces = result
                                 self.switch.put(r)
 
-                            sleep(self.min_interval - (CHECK_INTERVAL * 2))
+                            if self.busy:
+                                sleep(self.min_interval - (CHECK_INTERVAL * 2))
                         else:
                             if result is None:
                                 self.check_interval = min(
@@ -240,7 +269,11 @@ class BFLMiner(Miner):
                     sleep(self.check_interval)
             except Exception:
                 say_exception()
-                if self.device:
-                    self.device.close()
-                    self.device = None
+                self.close_device()
                 sleep(1)
+
+    def close_device(self):
+        with self.device_lock:
+            if self.device:
+                self.device.close()
+                self.device = None
@@ -0,0 +1,95 @@
+FRAMES = (5, 10, 15, 20, 30, 45, 60, 90, 120)
+DUTIES = (1.0, 0.95, 0.9, 0.85, 0.8, 0.7, 0.6, 0.5)
+DEFAULT_WINDOW = 30  # seconds
+
+# How much better a neighbouring operating point has to measure to be moved
+# to, so that noise doesn't make the search wander.
+IMPROVEMENT = 1.01
+
+
+class EfficiencyOptimizer(object):
+    """
+    Searches for the frames and duty cycle a device mines the most hashes
+    per joule at, by perturb and observe: it measures the current operating
+    point over a window of seconds, then a neighbouring one, moving there if
+    it does better. A step that does worse is undone, and the next step is
+    tried in the other direction along the other setting. The current point
+    is measured again before each new step, so the search follows changes in
+    temperature, clocks or load and never stops.
+    """
+
+    def __init__(self, frames, window=DEFAULT_WINDOW):
+        self.settings = (FRAMES, DUTIES)
+        self.point = [
+            min(range(len(FRAMES)), key=lambda i: abs(FRAMES[i] - frames)), 0
+        ]
+        self.window = window
+        self.dimension = 0
+        self.directions = [1, 1]
+        self.previous = None
+        self.score = None
+        self.last = None
+        self.reset()
+
+    @property
+    def frames(self):
+        return FRAMES[self.point[0]]
+
+    @property
+    def duty(self):
+        return DUTIES[self.point[1]]
+
+    def reset(self):
+        self.hashes = self.joules = self.elapsed = 0
+
+    def completed(self, now, hashes, power):
+        """Accounts for hashes done by now at the latest power reading in W.
+        Returns whether the operating point changed."""
+        if power is None:
+            self.last = None
+            return False
+        if self.last is not None:
+            seconds = now - self.last
+            self.hashes += hashes
+            self.joules += power * seconds
+            self.elapsed += seconds
+        self.last = now
+        if self.elapsed < self.window or not self.joules:
+            return False
+
+        score = self.hashes / self.joules
+        self.reset()
+        self.evaluate(score)
+        return True
+
+    def evaluate(self, score):
+        if self.previous is None:
+            self.score = score
+        elif score > self.score * IMPROVEMENT:
+            self.score = score
+            self.previous = None
+        else:
+            self.point = self.previous
+            self.previous = None
+            self.directions[self.dimension] *= -1
+            self.dimension = (self.dimension + 1) % len(self.point)
+            # Measure the current point again before the next step.
+            return
+        self.step()
+
+    def step(self):
+        """Moves to the neighbouring point in the current direction along the
+        current setting, turning around at the ends of its range."""
+        index = self.point[self.dimension]
+        steps = self.settings[self.dimension]
+        if not 0 <= index + self.directions[self.dimension] < len(steps):
+            self.directions[self.dimension] *= -1
+        self.previous = list(self.point)
+        self.point[self.dimension] += self.directions[self.dimension]
+
+    def stats(self):
+        """The current operating point for display in the miner status."""
+        return {
+            'eff frames': self.frames,
+            'eff duty %': round(100 * self.duty),
+        }
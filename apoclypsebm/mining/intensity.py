@@ -0,0 +1,67 @@
+from math import exp, log
+
+
+class IntensityController(object):
+    """
+    Sizes kernel launches to hold their execution time at target seconds.
+
+    Each measured launch updates an exponentially weighted moving average of
+    the device throughput and of the launch time. The next size is the
+    smoothed throughput times the target, corrected by a proportional and an
+    integral term on the logarithm of target / smoothed time so that a biased
+    throughput estimate still settles on the target. Sizes are multiples of
+    unit and change by at most max_step per launch to avoid frame time spikes.
+    """
+
+    def __init__(self, target, unit, initial=None, limit=0xFFFFFFFF,
+                 alpha=0.3, kp=0.3, ki=0.1, max_step=2.0):
+        self.target = target
+        self.unit = unit
+        self.limit = max(limit - limit % unit, unit)
+        self.alpha = alpha
+        self.kp = kp
+        self.ki = ki
+        self.max_step = max_step
+
+        self.size = self.clamp(initial or unit)
+        self.throughput = None
+        self.latency = None
+        self.integral = 0.0
+
+    def clamp(self, size):
+        size = int(size) - int(size) % self.unit
+        return min(max(size, self.unit), self.limit)
+
+    def measured(self, size, seconds):
+        """Accounts for a launch of size threads that took seconds to execute
+        and returns the size to use for the next launch."""
+        if seconds <= 0:
+            return self.size
+        throughput = size / seconds
+        if self.throughput is None:
+            self.throughput = throughput
+            self.latency = seconds
+        else:
+            self.throughput += self.alpha * (throughput - self.throughput)
+            self.latency += self.alpha * (seconds - self.latency)
+
+        error = log(self.target / self.latency)
+        correction = self.kp * error + self.ki * (self.integral + error)
+        # Only integrate while the correction isn't saturated (anti-windup).
+        if abs(correction) < log(self.max_step):
+            self.integral += error
+
+        wanted = self.throughput * self.target * exp(correction)
+        wanted = min(max(wanted, self.size / self.max_step),
+                     self.size * self.max_step)
+        self.size = self.clamp(wanted)
+        return self.size
+
+    def stats(self):
+        """The controller state for display in the miner status."""
+        if self.latency is None:
+            return {}
+        return {
+            'launch ms': round(self.latency * 1000, 1),
+            'global size': self.size,
+        }
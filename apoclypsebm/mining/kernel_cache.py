@@ -0,0 +1,108 @@
+import json
+import os
+from threading import Lock
+from time import time
+
+from apoclypsebm.log import say_line
+from apoclypsebm.util import atomic_write, user_dir
+
+MANIFEST = 'manifest.json'
+SUFFIX = '.bin'
+
+DEFAULT_MAX_SIZE = 256  # MiB
+DEFAULT_MAX_AGE = 30  # days
+
+
+def default_cache_dir():
+    return os.path.join(user_dir('cache'), 'kernels')
+
+
+class KernelCache(object):
+    """
+    Compiled kernel binaries stored by key in a cache directory. Binaries and
+    the manifest are written atomically, so processes starting at the same
+    time at worst compile the same kernel twice. The manifest records the size
+    and last use of each binary; binaries unused for longer than max_age days
+    or beyond max_size MiB of the least recently used are evicted on store.
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE,
+                 max_age=DEFAULT_MAX_AGE):
+        self.directory = directory or default_cache_dir()
+        self.max_size = max_size * 1024 * 1024
+        self.max_age = max_age * 24 * 60 * 60
+        self.lock = Lock()
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(options.cache_dir, options.cache_size, options.cache_age)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as binary:
+                data = binary.read()
+        except IOError:
+            return None
+        try:
+            with self.lock:
+                manifest = self.read_manifest()
+                manifest[key] = {'size': len(data), 'used': time()}
+                self.write_manifest(manifest)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        try:
+            atomic_write(self.path(key), data)
+            with self.lock:
+                manifest = self.read_manifest()
+                manifest[key] = {'size': len(data), 'used': time()}
+                self.evict(manifest, keep=key)
+                self.write_manifest(manifest)
+        except OSError as e:
+            say_line('Could not cache kernel binary in %s: %s',
+                     (self.directory, e))
+
+    def evict(self, manifest, keep=None):
+        """Removes expired and least recently used binaries from the
+        directory and manifest until they fit the limits."""
+        # Binaries stored by a process that lost a manifest update still count
+        # towards the limits, aged by their modification time.
+        for name in os.listdir(self.directory):
+            key = name[:-len(SUFFIX)]
+            if name.endswith(SUFFIX) and key not in manifest:
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                manifest[key] = {'size': stat.st_size, 'used': stat.st_mtime}
+
+        now = time()
+        size = sum(entry['size'] for entry in manifest.values())
+        for key, entry in sorted(manifest.items(),
+                                 key=lambda item: item[1]['used']):
+            if key == keep:
+                continue
+            if size <= self.max_size and now - entry['used'] <= self.max_age:
+                continue
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+            del manifest[key]
+            size -= entry['size']
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as manifest:
+                return json.load(manifest)
+        except (IOError, ValueError):
+            return {}
+
+    def write_manifest(self, manifest):
+        atomic_write(os.path.join(self.directory, MANIFEST),
+                     json.dumps(manifest, sort_keys=True).encode('utf-8'))
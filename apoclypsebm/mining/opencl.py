@@ -1,22 +1,45 @@
 import pkgutil
 import sys
 from hashlib import md5
+from collections import deque
 from queue import Empty
+from random import getrandbits
 from struct import error, pack, unpack
 from threading import Lock
 from time import monotonic, sleep
 
 from apoclypsebm.log import say_line
 from apoclypsebm.mining.base import Miner
-from apoclypsebm.sha256 import calculateF, partial
-from apoclypsebm.util import (Object, bytearray_to_uint32, bytereverse,
+from apoclypsebm.mining.efficiency import EfficiencyOptimizer
+from apoclypsebm.mining.intensity import IntensityController
+from apoclypsebm.mining.kernel_cache import KernelCache
+from apoclypsebm.mining.sensors import (find_hwmon, hwmon_power,
+                                        hwmon_sensor, pause)
+from apoclypsebm.mining.telemetry import LaunchTelemetry
+from apoclypsebm.sha256 import STATE, precompute, sha256
+from apoclypsebm.util import (Object, bytereverse,
                               tokenize, uint32, uint32_as_bytes)
 
+# Search kernel arguments, following the JOB_ARGS precomputed job arguments.
+# Built with MIDSTATES, for work with several midstates, the kernel takes
+# them from a buffer instead, a row for each midstate it sweeps.
+JOB_ARGS = 23
+TARGET_ARG = 0
+BASE_ARG = 1
+COUNT_ARG = 2
+OUTPUT_ARG = 3
+
+DEFAULT_KERNEL = 'apoclypse-0'
+
+# How many upcoming ntime values of a job to keep kernel arguments ready for.
+NTIME_LOOKAHEAD = 4
+
 PYOPENCL = False
 OPENCL = False
 ADL = False
 
 try:
+    import numpy as np
     import pyopencl as cl
 
     PYOPENCL = True
@@ -67,10 +90,10 @@ if OPENCL:
     except ImportError:
         if has_amd():
             print('\nWARNING: no adl3 module found (github.com/mjmvisser/adl3),'
-                  'temperature control is disabled\n')
+                  'ADL temperature control is disabled\n')
     except OSError:  # if no ADL is present i.e. no AMD platform
-        print('\nWARNING: ADL missing (no AMD platform?), temperature control'
-              'is disabled\n')
+        print('\nWARNING: ADL missing (no AMD platform?), ADL temperature'
+              ' control is disabled\n')
 else:
     print("\nNot using OpenCL\n")
 
@@ -80,17 +103,31 @@ def shutdown():
         ADL_Main_Control_Destroy()
 
 
-def initialize(options):
-    if not OPENCL:
-        options.no_ocl = True
-        return []
-
-    options.worksize = tokenize(options.worksize, 'worksize')
-    options.frames = tokenize(options.frames, 'frames', (30,))
-    options.frame_sleep = tokenize(options.frame_sleep, 'frame_sleep', cast=float)
-    options.vectors = (True,) if options.old_vectors else tokenize(
-        options.vectors, 'vectors', (False,), bool)
-
+def pci_address(device):
+    """The PCI address of device as dddd:bb:dd.f where its platform tells,
+    otherwise None."""
+    try:
+        if 'cl_amd_device_attribute_query' in device.extensions:
+            topology = device.get_info(cl.device_info.TOPOLOGY_AMD)
+            return '0000:%02x:%02x.%x' % (topology.bus, topology.device,
+                                          topology.function)
+        if 'cl_nv_device_attribute_query' in device.extensions:
+            slot = device.get_info(cl.device_info.PCI_SLOT_ID_NV)
+            return '%04x:%02x:%02x.%x' % (
+                device.get_info(cl.device_info.PCI_DOMAIN_ID_NV),
+                device.get_info(cl.device_info.PCI_BUS_ID_NV),
+                slot >> 3, slot & 7)
+    except (cl.Error, AttributeError):
+        pass
+    return None
+
+
+def vectors_option(value):
+    return int(value) > 0
+
+
+def select_devices(options):
+    """Returns the indices of the devices of the selected platform to use."""
     platforms = cl.get_platforms()
 
     if options.platform >= len(platforms) or (
@@ -112,14 +149,39 @@ def initialize(options):
             print(f'[{i}]\t{devices[i].name}')
         print('\nNo devices specified, using all GPU devices\n')
 
-    miners = [
-        OpenCLMiner(i, options)
+    return [
+        i
         for i in range(len(devices))
         if ((not options.device
              and devices[i].type == cl.device_type.GPU)
              or (i in options.device))
     ]
 
+
+def initialize(options):
+    if not OPENCL:
+        options.no_ocl = True
+        return []
+
+    # Autotuned profiles only fill in the options not given by the user.
+    from apoclypsebm.mining.autotune import load_profiles, profile_key
+    explicit = {
+        'kernel': bool(options.kernel),
+        'worksize': bool(options.worksize),
+        'frames': bool(options.frames),
+        'vectors': bool(options.vectors or options.old_vectors),
+    }
+    profiles = load_profiles(options.profile_file)
+
+    options.worksize = tokenize(options.worksize, 'worksize')
+    options.frames = tokenize(options.frames, 'frames', (30,))
+    options.frame_sleep = tokenize(options.frame_sleep, 'frame_sleep', cast=float)
+    options.queue_depth = tokenize(options.queue_depth, 'queue_depth', (2,))
+    options.vectors = (True,) if options.old_vectors else tokenize(
+        options.vectors, 'vectors', (False,), vectors_option)
+
+    miners = [OpenCLMiner(i, options) for i in select_devices(options)]
+
     for i in range(len(miners)):
         miner = miners[i]
         miner.worksize = options.worksize[min(i, len(options.worksize) - 1)]
@@ -128,15 +190,94 @@ def initialize(options):
             min(i, len(options.frame_sleep) - 1)
         ]
         miner.vectors = options.vectors[min(i, len(options.vectors) - 1)]
+        miner.queue_depth = max(
+            options.queue_depth[min(i, len(options.queue_depth) - 1)], 1
+        )
+        miner.timings = options.timings
         miner.cutoff_temp = options.cutoff_temp[
             min(i, len(options.cutoff_temp) - 1)
         ]
         miner.cutoff_interval = options.cutoff_interval[
             min(i, len(options.cutoff_interval) - 1)
         ]
+        miner.throttle_band = options.throttle_band[
+            min(i, len(options.throttle_band) - 1)
+        ]
+        address = pci_address(miner.device)
+        hwmon = address and find_hwmon(address)
+        if options.hwmon:
+            path = options.hwmon[min(i, len(options.hwmon) - 1)]
+            miner.sensor = hwmon_sensor(path)
+            if not miner.sensor:
+                say_line('%s: no temperature input in %s', (miner.id(), path))
+        elif not miner.sensor and hwmon:
+            miner.sensor = hwmon_sensor(hwmon)
+        if options.power:
+            path = options.power[min(i, len(options.power) - 1)]
+            miner.power_sensor = hwmon_power(path)
+            if not miner.power_sensor:
+                say_line('%s: no power input in %s', (miner.id(), path))
+        elif hwmon:
+            miner.power_sensor = hwmon_power(hwmon)
+        if options.efficiency:
+            if miner.power_sensor:
+                miner.efficiency = True
+            else:
+                say_line('%s: no power sensor, mining for hash rate',
+                         miner.id())
+
+        profile = profiles.get(profile_key(miner.device))
+        if profile:
+            applied = []
+            for name, attribute in (('kernel', 'kernel_name'),
+                                    ('worksize', 'worksize'),
+                                    ('vectors', 'vectors'),
+                                    ('frames', 'frames')):
+                if not explicit[name]:
+                    setattr(miner, attribute, profile[name])
+                    applied.append(f'{name}={profile[name]}')
+            if applied:
+                say_line('%s: using autotuned %s', (miner.id(),
+                                                   ', '.join(applied)))
     return miners
 
 
+def prebuild(options):
+    """
+    Compiles every kernel, worksize and vectors combination for the selected
+    devices into the kernel cache, so that mining and autotuning start from
+    cached binaries.
+    """
+    if not OPENCL:
+        say_line('OpenCL is not available, nothing to build')
+        return
+
+    from apoclypsebm.mining.autotune import candidates
+    for device_idx in select_devices(options):
+        miner = OpenCLMiner(device_idx, options)
+        built = cached = 0
+        for kernel, worksize, vectors in candidates(
+                options, miner.device.max_work_group_size):
+            miner.kernel_name = kernel
+            miner.worksize = worksize
+            miner.vectors = vectors
+            try:
+                miner.build()
+                hits = [miner.cache_hit]
+                # Version rolling takes the MIDSTATES kernel as well.
+                if getattr(options, 'version_rolls', 1) > 1:
+                    miner.use_kernel(options.version_rolls)
+                    hits.append(miner.cache_hit)
+            except cl.Error as e:
+                say_line('%s: kernel %s, worksize %d, vectors %s failed: %s',
+                         (miner.id(), kernel, worksize, vectors, e))
+                continue
+            cached += sum(hits)
+            built += len(hits) - sum(hits)
+        say_line('%s: %d kernels built, %d already cached in %s',
+                 (miner.id(), built, cached, miner.kernel_cache.directory))
+
+
 class OpenCLMiner(Miner):
     def __init__(self, device_idx, options):
         super(OpenCLMiner, self).__init__(device_idx, options)
@@ -146,11 +287,20 @@ class OpenCLMiner(Miner):
             cl.get_platforms()[options.platform].get_devices()[device_idx]
         )
         self.device_name = self.device.name.strip('\r\n \x00\t')
+        self.kernel_name = options.kernel or DEFAULT_KERNEL
+        self.kernel_cache = KernelCache.from_options(options)
+        self.cache_hit = False
+        # The loaded kernels, by whether they were built with MIDSTATES.
+        self.kernels = {}
+        self.midstates = False
         self.frames = 30
 
         self.worksize = self.frame_sleep = self.rate = self.estimated_rate = 0
         self.execution_local_dims = None
         self.vectors = False
+        self.queue_depth = 2
+        self.timings = False
+        self.efficiency = False
 
         self.adapter_idx = None
         if (
@@ -162,53 +312,80 @@ class OpenCLMiner(Miner):
                 self.adapter_idx = self.get_adapter_info()
                 if self.adapter_idx:
                     self.adapter_idx = self.adapter_idx[self.device_idx].iAdapterIndex
+            if self.adapter_idx is not None:
+                self.sensor = self.get_temperature
 
     def id(self):
         return f'{self.options.platform}:{self.device_idx}:{self.device_name}'
 
     def nonce_generator(self, nonces):
-        for i in range(0, len(nonces) - 4, 4):
-            nonce = bytearray_to_uint32(nonces[i:i + 4])
-            if nonce:
-                yield nonce
+        return unpack(f'<{len(nonces) // 4}I', nonces)
 
     def mining_thread(self):
         say_line('started OpenCL miner on platform %d, device %d (%s)',
                  (self.options.platform, self.device_idx, self.device_name))
 
-        self.defines, rate_divisor, hashspace = (
-            '-D VECTORS', 500, 0x7FFFFFFF
-        ) if self.vectors else (
-            '', 1000, 0xFFFFFFFF
-        )
-
-        self.defines += (
-            f' -D OUTPUT_SIZE={self.output_size}'
-            f' -D OUTPUT_MASK={self.output_size - 1}'
-        )
-
-        self.load_kernel()
-        frame = 1.0 / max(self.frames, 3)
+        rate_divisor, hashspace = self.build()
         unit = self.worksize * 256
-        global_threads = unit * 10
-
-        queue = cl.CommandQueue(self.context)
-
-        last_rated_pace = last_rated = last_n_time = last_temperature = monotonic()
-        base = last_hash_rate = threads_run_pace = threads_run = 0
-
-        blank_output = b'\x00' * ((self.output_size + 1) * 4)
-        host_output = bytearray(blank_output)
-        cl_output = cl.Buffer(
-            self.context,
-            cl.mem_flags.WRITE_ONLY,
-            size=len(host_output)
-        )
-        cl.enqueue_copy(queue, cl_output, blank_output)
-        self.kernel.set_arg(20, cl_output)
+        intensity = IntensityController(1.0 / max(self.frames, 3), unit,
+                                        unit * 10, hashspace)
+        global_threads = intensity.size
+        rows = 1
+        # Threads search the nonces of a work unit from first to last, each
+        # thread nonces_per_thread of them.
+        nonces_per_thread = (1 << 32) // (hashspace + 1)
+        first, last = 0, hashspace + 1
+
+        # Profiling times every launch and readback on the device.
+        telemetry = None
+        if self.timings:
+            telemetry = LaunchTelemetry()
+            queue = cl.CommandQueue(
+                self.context,
+                properties=cl.command_queue_properties.PROFILING_ENABLE
+            )
+        else:
+            queue = cl.CommandQueue(self.context)
+
+        last_rated = last_n_time = monotonic()
+        base = threads_run = 0
+
+        # Each launch in flight writes to its own output buffer. They are
+        # allocated host-accessible so that only the count of found nonces at
+        # the start has to be mapped after every launch.
+        blank_output = b'\x00' * ((self.output_size * 2 + 1) * 4)
+        cl_outputs = []
+        for i in range(self.queue_depth):
+            cl_outputs.append(cl.Buffer(
+                self.context,
+                cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR,
+                size=len(blank_output)
+            ))
+            cl.enqueue_copy(queue, cl_outputs[i], blank_output)
+        launches = deque()
+        launch_count = 0
+        last_completed = 0
+        idle_since = monotonic()
+        idle_time = 0
+
+        # Job arguments for the next ntime are set on the standby kernel, or
+        # uploaded to a buffer with MIDSTATES, while the device is busy so
+        # that rolling ntime is a swap between launches.
+        rolls = deque()
+        rolled_time = standby_time = standby_jobs = None
+
+        # Throttled devices rest after each launch until resume_at.
+        resume_at = 0
+
+        # Mining for efficiency, frames and the duty cycle are searched for
+        # the most hashes per joule.
+        efficiency = None
+        if self.efficiency:
+            efficiency = EfficiencyOptimizer(self.frames,
+                                             self.options.efficiency_window)
+            intensity.target = 1.0 / max(efficiency.frames, 3)
 
         work = None
-        temperature = 0
         while True:
             if self.should_stop:
                 return
@@ -223,128 +400,337 @@ class OpenCLMiner(Miner):
                 else:
                     if not work:
                         continue
-                    nonces_left = hashspace
-                    state = work.state
-                    f = [0, 0, 0, 0, 0, 0, 0, 0]
-                    state2 = partial(state, work.merkle_end, work.time,
-                                     work.difficulty, f)
-                    calculateF(state, work.merkle_end, work.time,
-                               work.difficulty, f, state2)
-
-                    set_arg = self.kernel.set_arg
-                    set_arg(0, uint32_as_bytes(state[0]))
-                    set_arg(1, uint32_as_bytes(state[1]))
-                    set_arg(2, uint32_as_bytes(state[2]))
-                    set_arg(3, uint32_as_bytes(state[3]))
-                    set_arg(4, uint32_as_bytes(state[4]))
-                    set_arg(5, uint32_as_bytes(state[5]))
-                    set_arg(6, uint32_as_bytes(state[6]))
-                    set_arg(7, uint32_as_bytes(state[7]))
-
-                    set_arg(8, uint32_as_bytes(state2[1]))
-                    set_arg(9, uint32_as_bytes(state2[2]))
-                    set_arg(10, uint32_as_bytes(state2[3]))
-                    set_arg(11, uint32_as_bytes(state2[5]))
-                    set_arg(12, uint32_as_bytes(state2[6]))
-                    set_arg(13, uint32_as_bytes(state2[7]))
-
-                    set_arg(15, uint32_as_bytes(f[0]))
-                    set_arg(16, uint32_as_bytes(f[1]))
-                    set_arg(17, uint32_as_bytes(f[2]))
-                    set_arg(18, uint32_as_bytes(f[3]))
-                    set_arg(19, uint32_as_bytes(f[4]))
-
-            if temperature < self.cutoff_temp:
-                self.kernel.set_arg(14, uint32_as_bytes(base))
-                cl.enqueue_nd_range_kernel(queue, self.kernel,
-                                           (global_threads,), self.execution_local_dims)
-
-                nonces_left -= global_threads
-                threads_run_pace += global_threads
-                threads_run += global_threads
-                base = uint32(base + global_threads)
+                    first = work.nonce_start // nonces_per_thread
+                    last = work.nonce_end // nonces_per_thread
+                    base = first
+                    nonces_left = last - first
+                    exhausted = False
+                    # Every row sweeps the same nonces for another midstate.
+                    rows = len(work.states)
+                    self.use_kernel(rows)
+                    jobs = self.job_args(work, work.time)
+                    self.set_job_args(jobs)
+                    global_threads = max(
+                        intensity.size // rows // unit * unit, unit)
+                    rolls.clear()
+                    rolled_time = work.time
+                    standby_time = None
+                    self.set_target_arg(work.target)
+
+            if self.target_update and work:
+                server, target, targetQ = self.target_update
+                self.target_update = None
+                if work.server is server:
+                    work.target, work.targetQ = target, targetQ
+                    self.set_target_arg(target)
+
+            duty = self.duty_cycle()
+            if efficiency:
+                duty = min(duty, efficiency.duty)
+            if duty > 0 and monotonic() >= resume_at:
+                slot = launch_count % self.queue_depth
+                # Launches never search past the end of the work's nonces.
+                # The last one is padded to a whole work group.
+                count = min(global_threads, last - base)
+                threads = -(-count // self.worksize) * self.worksize
+                self.set_arg(BASE_ARG, uint32_as_bytes(base))
+                self.set_arg(COUNT_ARG, uint32_as_bytes(count))
+                self.set_arg(OUTPUT_ARG, cl_outputs[slot])
+                kernel_event = cl.enqueue_nd_range_kernel(
+                    queue, self.kernel, (threads, rows),
+                    self.execution_local_dims)
+                found, readback = cl.enqueue_map_buffer(
+                    queue, cl_outputs[slot], cl.map_flags.READ, 0,
+                    (1,), np.uint32, is_blocking=False
+                )
+                enqueued = monotonic()
+                launches.append((readback, found, slot, work, work.time,
+                                 jobs, count * rows, enqueued,
+                                 kernel_event))
+                launch_count += 1
+                if idle_since is not None:
+                    idle_time += enqueued - idle_since
+                    idle_since = None
+
+                nonces_left -= count
+                base += count
+                if base >= last:
+                    # Searched all of them, start over at the next ntime.
+                    # Unless ntime can't roll: the same nonces would only
+                    # find the same shares again, the work is done.
+                    base = first
+                    last_n_time = 0
+                    exhausted = not self.switch.update_time
             else:
-                threads_run_pace = 0
-                last_rated_pace = monotonic()
                 sleep(self.cutoff_interval)
 
-            now = monotonic()
-            if self.adapter_idx is not None:
-                t = now - last_temperature
-                if temperature >= self.cutoff_temp or t > 1:
-                    last_temperature = now
-                    with adl_lock:
-                        temperature = self.get_temperature()
-
-            t = now - last_rated_pace
-            if t > 1:
-                rate = (threads_run_pace / t) / rate_divisor
-                last_rated_pace = now
-                threads_run_pace = 0
-                r = last_hash_rate / rate
-                if r < 0.9 or r > 1.1:
-                    global_threads = max(
-                        unit * int((rate * frame * rate_divisor) / unit), unit)
-                    last_hash_rate = rate
+            if self.switch.update_time:
+                if len(rolls) < NTIME_LOOKAHEAD:
+                    rolled_time = self.roll_ahead(work, rolled_time, rolls)
+                if standby_time is None:
+                    standby_time, standby_jobs = rolls.popleft()
+                    self.set_standby_args(standby_jobs)
 
+            now = monotonic()
             t = now - last_rated
             if t > self.options.rate:
+                if idle_since is not None:
+                    idle_time += now - idle_since
+                    idle_since = now
+                self.stats['idle %'] = round(100 * idle_time / t, 1)
+                self.stats.update(intensity.stats())
+                if self.temperature is not None:
+                    self.stats['temp C'] = self.temperature
+                    self.stats['duty %'] = round(100 * duty)
+                if self.power:
+                    self.stats['W'] = round(self.power, 1)
+                    self.stats['MH/J'] = round(
+                        threads_run / t / rate_divisor / 1000 / self.power, 3)
+                if efficiency:
+                    self.stats.update(efficiency.stats())
+                if telemetry:
+                    self.stats.update(telemetry.stats())
+                    if self.options.verbose:
+                        for name in ('kernel', 'host_gap', 'readback'):
+                            say_line('%s: %s ms histogram: %s',
+                                     (self.id(), name.replace('_', ' '),
+                                      getattr(telemetry, name)))
+                    telemetry.reset()
+                idle_time = 0
                 self.update_rate(now, threads_run, t, work.targetQ,
                                  rate_divisor)
                 last_rated = now
                 threads_run = 0
 
-            cl.enqueue_copy(queue, host_output, cl_output)
-            queue.finish()
-
-            if host_output[-1]:
-                result = Object()
-                result.header = work.header
-                result.merkle_end = work.merkle_end
-                result.time = work.time
-                result.difficulty = work.difficulty
-                result.target = work.target
-                result.state = tuple(state)
-                result.nonces = host_output[:]
-                result.job_id = work.job_id
-                result.extranonce2 = work.extranonce2
-                result.transactions = work.transactions
-                result.server = work.server
-                result.miner = self
-                self.switch.put(result)
-                cl.enqueue_copy(queue, cl_output, blank_output)
+            # Keep queue_depth launches in flight, only waiting on the oldest.
+            # Throttled, each launch completes before the rest after it.
+            # Finished work has all its launches read before it's dropped.
+            while launches and (len(launches) >= self.queue_depth or duty < 1
+                                or exhausted):
+                (readback, found, slot, launch_work, launch_time, launch_jobs,
+                 launch_size, enqueued, kernel_event) = launches.popleft()
+                readback.wait()
+                completed = monotonic()
+                threads_run += launch_size
+                if telemetry:
+                    seconds = telemetry.completed(kernel_event, readback)
+                else:
+                    # A launch starts executing once it's enqueued and the
+                    # one before it has completed.
+                    seconds = completed - max(enqueued, last_completed)
+                if duty < 1:
+                    resume_at = completed + pause(seconds, duty)
+                if efficiency and efficiency.completed(
+                        completed, launch_size * 1000 / rate_divisor,
+                        self.power):
+                    intensity.target = 1.0 / max(efficiency.frames, 3)
+                size = intensity.measured(launch_size, seconds)
+                global_threads = max(size // rows // unit * unit, unit)
+                last_completed = completed
+                if not launches or launches[-1][0].command_execution_status \
+                        == cl.command_execution_status.COMPLETE:
+                    idle_since = completed
+
+                count = int(found[0])
+                found.base.release(queue)
+                if count:
+                    if count > self.output_size:
+                        say_line('%s: %d nonces found in one launch, only %d'
+                                 ' fit the output', (self.id(), count,
+                                                      self.output_size))
+                        self.stats['lost nonces'] = self.stats.get(
+                            'lost nonces', 0) + count - self.output_size
+                        count = self.output_size
+                    output, readback = cl.enqueue_map_buffer(
+                        queue, cl_outputs[slot],
+                        cl.map_flags.READ | cl.map_flags.WRITE, 0,
+                        (count * 2 + 1,), np.uint32
+                    )
+                    found_nonces = output[1:].reshape(count, 2)
+                    # One result for each midstate row with nonces found.
+                    for row in np.unique(found_nonces[:, 1]):
+                        result = Object()
+                        result.header = launch_work.headers[row]
+                        result.version = launch_work.versions[row]
+                        result.merkle_end = launch_work.merkle_end
+                        result.time = launch_time
+                        result.difficulty = launch_work.difficulty
+                        result.target = launch_work.target
+                        result.state = tuple(launch_work.states[row])
+                        result.nonces = found_nonces[
+                            found_nonces[:, 1] == row, 0].tobytes()
+                        result.job_id = launch_work.job_id
+                        result.extranonce2 = launch_work.extranonce2
+                        result.transactions = launch_work.transactions
+                        result.server = launch_work.server
+                        result.miner = self
+                        self.switch.put(result)
+                    output[0] = 0
+                    output.base.release(queue)
 
             if not self.switch.update_time:
-                if nonces_left < 3 * global_threads * self.frames:
-                    self.update = True
-                    nonces_left += 0xFFFFFFFFFFFF
-                elif 0xFFFFFFFFFFF < nonces_left < 0xFFFFFFFFFFFF:
-                    say_line('warning: job finished, %s is idle', self.id())
+                if exhausted:
+                    self.want_work()
+                    if self.work_queue.empty():
+                        say_line('warning: job finished, %s is idle',
+                                 self.id())
                     work = None
+                elif nonces_left < 3 * global_threads * self.frames:
+                    self.want_work()
+                    nonces_left += 0xFFFFFFFFFFFF
             elif now - last_n_time > 1:
-                work.time = bytereverse(bytereverse(work.time) + 1)
-                state2 = partial(state, work.merkle_end, work.time,
-                                 work.difficulty, f)
-                calculateF(state, work.merkle_end, work.time, work.difficulty,
-                           f, state2)
-                set_arg = self.kernel.set_arg
-                set_arg(8, uint32_as_bytes(state2[1]))
-                set_arg(9, uint32_as_bytes(state2[2]))
-                set_arg(10, uint32_as_bytes(state2[3]))
-                set_arg(11, uint32_as_bytes(state2[5]))
-                set_arg(12, uint32_as_bytes(state2[6]))
-                set_arg(13, uint32_as_bytes(state2[7]))
-                set_arg(15, uint32_as_bytes(f[0]))
-                set_arg(16, uint32_as_bytes(f[1]))
-                set_arg(17, uint32_as_bytes(f[2]))
-                set_arg(18, uint32_as_bytes(f[3]))
-                set_arg(19, uint32_as_bytes(f[4]))
+                if standby_time is None:
+                    if not rolls:
+                        rolled_time = self.roll_ahead(work, rolled_time, rolls)
+                    standby_time, standby_jobs = rolls.popleft()
+                    self.set_standby_args(standby_jobs)
+                jobs = standby_jobs
+                self.swap_standby(jobs)
+                work.time = standby_time
+                standby_time = None
                 last_n_time = now
                 self.update_time_counter += 1
                 if self.update_time_counter >= self.switch.max_update_time:
-                    self.update = True
+                    self.want_work()
                     self.update_time_counter = 1
 
+    def build(self):
+        """Loads the kernel for the current settings, returning the rate
+        divisor and hash space that go with them.
+        """
+        self.defines, rate_divisor, hashspace = (
+            '-D VECTORS', 500, 0x7FFFFFFF
+        ) if self.vectors else (
+            '', 1000, 0xFFFFFFFF
+        )
+
+        self.defines += f' -D OUTPUT_SIZE={self.output_size}'
+
+        self.load_kernel()
+        return rate_divisor, hashspace
+
+    def benchmark(self, seconds, rate_divisor):
+        """Mines a random job with the built kernel for about seconds, sizing
+        executions to self.frames like mining_thread does, and returns the
+        hash rate in MH/s measured after the first third of that time. A
+        first execution outside of that time lets lazy runtimes finish
+        compiling.
+        """
+        header = [getrandbits(32) for i in range(19)]
+        work = Object()
+        work.states = [sha256(STATE, header[:16] + [0] * 48)]
+        work.merkle_end, work.time, work.difficulty = header[16:]
+        self.set_job_args(self.job_args(work, work.time))
+        queue = cl.CommandQueue(self.context)
+        cl_output = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY,
+                              size=(self.output_size * 2 + 1) * 4)
+        self.set_arg(OUTPUT_ARG, cl_output)
+        self.set_target_arg((0xFFFFFFFF,) * 8)
+
+        unit = self.worksize * 256
+        intensity = IntensityController(1.0 / max(self.frames, 3), unit)
+        global_threads = unit
+        base = threads_run = 0
+        self.set_arg(BASE_ARG, uint32_as_bytes(base))
+        self.set_arg(COUNT_ARG, uint32_as_bytes(global_threads))
+        cl.enqueue_nd_range_kernel(queue, self.kernel, (global_threads, 1),
+                                   self.execution_local_dims)
+        queue.finish()
+        start = now = monotonic()
+        measure_start = None
+        while now - start < seconds or not threads_run:
+            self.set_arg(BASE_ARG, uint32_as_bytes(base))
+            self.set_arg(COUNT_ARG, uint32_as_bytes(global_threads))
+            cl.enqueue_nd_range_kernel(queue, self.kernel,
+                                       (global_threads, 1),
+                                       self.execution_local_dims)
+            queue.finish()
+            last, now = now, monotonic()
+            base = uint32(base + global_threads)
+            if measure_start is not None:
+                threads_run += global_threads
+            elif now - start > seconds / 3:
+                measure_start = now
+            global_threads = intensity.measured(global_threads, now - last)
+
+        return threads_run / (now - measure_start) / rate_divisor / 1000
+
+    def set_target_arg(self, target):
+        """Sets the share target word the kernel checks H[6] against. It
+        only reports hashes with H[7] of 0, so that's all an easier target
+        gets."""
+        value = uint32_as_bytes(target[6] if not target[7] else 0xFFFFFFFF)
+        self.set_arg(TARGET_ARG, value)
+        if not self.midstates:
+            self.standby_kernel.set_arg(JOB_ARGS + TARGET_ARG, value)
+
+    def set_arg(self, arg, value):
+        """Sets the search kernel argument arg of those following the job
+        arguments."""
+        self.kernel.set_arg((1 if self.midstates else JOB_ARGS) + arg, value)
+
+    def use_kernel(self, rows):
+        """Switches to the kernel for work with rows midstates: the one
+        build() loaded for a single one, else the MIDSTATES one, built on
+        first use."""
+        self.midstates = rows > 1
+        if self.midstates not in self.kernels:
+            self.kernels[self.midstates] = self.compile(
+                self.defines + ' -D MIDSTATES')
+        self.kernel = self.kernels[self.midstates]
+
+    def job_args(self, work, time):
+        """The precomputed job arguments for the midstates of work at ntime
+        time. With MIDSTATES they are uploaded to a buffer, a row of the
+        search each, else they are kernel arguments of their own."""
+        if not self.midstates:
+            return [uint32_as_bytes(value) for value in precompute(
+                work.states[0], work.merkle_end, time, work.difficulty)]
+        data = b''.join(
+            pack(f'<{JOB_ARGS}I', *precompute(state, work.merkle_end, time,
+                                              work.difficulty))
+            for state in work.states
+        )
+        return cl.Buffer(
+            self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=data
+        )
+
+    def set_job_args(self, jobs, kernel=None):
+        """Sets the job arguments made by job_args() on kernel, the one in
+        use by default."""
+        if kernel is None:
+            kernel = self.kernel
+        if self.midstates:
+            kernel.set_arg(0, jobs)
+            return
+        for i, value in enumerate(jobs):
+            kernel.set_arg(i, value)
+
+    def set_standby_args(self, jobs):
+        """Readies the job arguments for the next ntime ahead of the roll to
+        it by setting them on the standby kernel. A MIDSTATES buffer needs
+        nothing more, job_args() uploaded it."""
+        if not self.midstates:
+            self.set_job_args(jobs, self.standby_kernel)
+
+    def swap_standby(self, jobs):
+        """Rolls the search over to jobs readied by set_standby_args(),
+        swapping in the standby kernel or the buffer."""
+        if self.midstates:
+            self.set_job_args(jobs)
+            return
+        self.kernel, self.standby_kernel = self.standby_kernel, self.kernel
+        self.kernels[False] = self.kernel
+
+    def roll_ahead(self, work, time, rolls):
+        """Appends the job buffer for the ntime following time to rolls and
+        returns that ntime.
+        """
+        time = bytereverse(bytereverse(time) + 1)
+        rolls.append((time, self.job_args(work, time)))
+        return time
+
     def load_kernel(self):
         max_worksize = self.device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
         if not self.worksize:
@@ -358,7 +744,7 @@ class OpenCLMiner(Miner):
             # at compile time isntead of at execution.
             self.execution_local_dims = None
         else:
-            self.execution_local_dims = (self.worksize,)
+            self.execution_local_dims = (self.worksize, 1)
 
         self.context = cl.Context([self.device], None, None)
         if self.device.extensions.find('cl_amd_media_ops') != -1:
@@ -369,43 +755,60 @@ class OpenCLMiner(Miner):
                                     'Zacate', 'WinterPark', 'BeaverCreek'):
                 self.defines += ' -D BFI_INT'
 
-        kernel = pkgutil.get_data('apoclypsebm', f'{self.options.kernel}.cl')
+        self.kernel = self.compile(self.defines)
+        self.kernels = {False: self.kernel}
+        # Ready for the next ntime while the kernel in use runs, then swapped
+        # with it.
+        self.standby_kernel = cl.Kernel(self.program, 'search')
+        self.midstates = False
+
+        if self.options.verbose:
+            compiled_worksize = self.kernel.get_work_group_info(
+                cl.kernel_work_group_info.COMPILE_WORK_GROUP_SIZE, self.device
+            )
+            say_line('Compiled work size: %s', compiled_worksize)
+
+    def compile(self, defines):
+        """The search kernel built with defines, from the kernel cache if
+        it's there."""
+        kernel = pkgutil.get_data('apoclypsebm', f'{self.kernel_name}.cl')
         m = md5(
             f'{self.device.platform.name}{self.device.platform.version}'
-            f'{self.device.name}{self.defines}'.encode('utf-8')
+            f'{self.device.name}{self.device.driver_version}'
+            f'{defines}'.encode('utf-8')
         )
         m.update(kernel)
-        cache_name = f'{m.hexdigest()}.elf'
+        cache_key = m.hexdigest()
 
-        try:
-            with open(cache_name, 'rb') as binary:
+        binary = self.kernel_cache.get(cache_key)
+        self.cache_hit = False
+        if binary is not None:
+            try:
                 self.program = cl.Program(self.context, [self.device],
-                                          [binary.read()]).build(self.defines)
-        except (IOError, cl.LogicError):
+                                          [binary]).build(defines)
+                self.cache_hit = True
+            except (cl.LogicError, cl.RuntimeError):
+                say_line('%s: cached kernel binary rejected, recompiling',
+                         self.id())
+        if not self.cache_hit:
             kernel = kernel.decode('ascii')
-            self.program = cl.Program(self.context, kernel).build(self.defines)
-            if self.defines.find('-D BFI_INT') != -1:
+            self.program = cl.Program(self.context, kernel).build(defines)
+            if defines.find('-D BFI_INT') != -1:
                 patched_binary = self.patch(self.program.binaries[0])
-                self.program = cl.Program(self.context, [self.device], [patched_binary]).build(self.defines)
-            with open(cache_name, 'wb') as binary:
-                binary.write(self.program.binaries[0])
+                self.program = cl.Program(self.context, [self.device], [patched_binary]).build(defines)
+            self.kernel_cache.put(cache_key, self.program.binaries[0])
 
-        self.kernel = self.program.search
-
-        if self.options.verbose:
-            compiled_worksize = self.kernel.get_work_group_info(
-                cl.kernel_work_group_info.COMPILE_WORK_GROUP_SIZE, self.device
-            )
-            say_line('Compiled work size: %s', compiled_worksize)
+        return self.program.search
 
     def get_temperature(self):
         temperature = ADLTemperature()
         temperature.iSize = sizeof(temperature)
 
-        if ADL_Overdrive5_Temperature_Get(self.adapter_idx, 0,
-                                          byref(temperature)) == ADL_OK:
-            return temperature.iTemperature / 1000.0
-        return 0
+        with adl_lock:
+            if ADL_Overdrive5_Temperature_Get(self.adapter_idx, 0,
+                                              byref(temperature)) == ADL_OK:
+                return temperature.iTemperature / 1000.0
+        return None
 
     def get_adapter_info(self):
         adapter_info = []
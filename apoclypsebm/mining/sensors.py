@@ -0,0 +1,133 @@
+import os
+from threading import Event, Lock, Thread
+
+from apoclypsebm.log import say_line
+
+HWMON_ROOT = '/sys/class/hwmon'
+
+SAMPLE_INTERVAL = 1.0  # seconds
+DEFAULT_BAND = 5.0  # C
+
+
+def duty_cycle(temperature, cutoff, band=DEFAULT_BAND):
+    """
+    The fraction of the time a device at temperature should spend hashing.
+    It falls linearly from 1 at band degrees below cutoff to 0 at cutoff,
+    so a hot device settles below cutoff at partial hash rate instead of
+    repeatedly stopping at it. Unknown temperatures don't throttle.
+    """
+    if temperature is None:
+        return 1.0
+    if temperature >= cutoff:
+        return 0.0
+    if temperature <= cutoff - band:
+        return 1.0
+    return (cutoff - temperature) / band
+
+
+def pause(seconds, duty):
+    """How long to rest after seconds of hashing to keep to duty."""
+    return seconds * (1 - duty) / duty if 0 < duty < 1 else 0
+
+
+class HwmonSensor(object):
+    """Reads a Linux hwmon input, temperatures in millidegrees C or power in
+    microwatts, scaled to C or W."""
+
+    def __init__(self, path, scale=1000.0):
+        self.path = path
+        self.scale = scale
+
+    def __call__(self):
+        with open(self.path) as value:
+            return int(value.read().strip()) / self.scale
+
+    def __repr__(self):
+        return self.path
+
+
+def hwmon_sensor(path):
+    """A sensor for a hwmon temperature input or the first one of a hwmon
+    directory, or None if there's none."""
+    if os.path.isdir(path):
+        inputs = sorted(name for name in os.listdir(path)
+                        if name.startswith('temp') and name.endswith('_input'))
+        if not inputs:
+            return None
+        path = os.path.join(path, inputs[0])
+    return HwmonSensor(path) if os.path.isfile(path) else None
+
+
+def hwmon_power(path):
+    """A sensor for a hwmon power input or the average power of a hwmon
+    directory, or None if there's none."""
+    if os.path.isdir(path):
+        for name in ('power1_average', 'power1_input'):
+            if os.path.isfile(os.path.join(path, name)):
+                return HwmonSensor(os.path.join(path, name), 1000000.0)
+        return None
+    return HwmonSensor(path, 1000000.0) if os.path.isfile(path) else None
+
+
+def find_hwmon(pci_address, root=HWMON_ROOT):
+    """The hwmon directory of the device at PCI address dddd:bb:dd.f, or
+    None."""
+    try:
+        names = sorted(os.listdir(root))
+    except OSError:
+        return None
+    for name in names:
+        device = os.path.join(root, name, 'device')
+        if os.path.basename(os.path.realpath(device)) == pci_address:
+            return os.path.join(root, name)
+    return None
+
+
+class SensorSampler(object):
+    """
+    Reads the sensors of miners on a background thread every interval
+    seconds and stores the readings as their temperature and power, so
+    mining loops only ever look at the latest reading instead of waiting on
+    drivers or serial round-trips. A reading that fails leaves it unknown.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.miners = []
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def add(self, miner):
+        with self.lock:
+            self.miners.append(miner)
+
+    def sample(self):
+        with self.lock:
+            miners = list(self.miners)
+        for miner in miners:
+            for sensor, reading in (('sensor', 'temperature'),
+                                    ('power_sensor', 'power')):
+                if not getattr(miner, sensor):
+                    continue
+                try:
+                    value = getattr(miner, sensor)()
+                except Exception as e:
+                    if getattr(miner, reading) is not None:
+                        say_line('%s: reading %s failed: %s',
+                                 (miner.id(), reading, e))
+                    value = None
+                setattr(miner, reading, value)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.sampling_thread, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def sampling_thread(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
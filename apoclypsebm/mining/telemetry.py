@@ -0,0 +1,154 @@
+from bisect import bisect_right
+
+# Bucket upper bounds in milliseconds, roughly logarithmic.
+BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200,
+           500, 1000)
+
+
+class Histogram(object):
+    """Counts durations in milliseconds into BUCKETS, the last bucket taking
+    anything longer."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect_right(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding the given fraction of the
+        durations, at most the longest duration."""
+        wanted = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) \
+                    else self.max
+        return 0
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def summary(self):
+        return '%.2f (p99 %.2f)' % (self.mean(), self.percentile(0.99))
+
+    def __str__(self):
+        return ' '.join(
+            '%s%g:%d' % ('<' if i < len(BUCKETS) else '>',
+                         BUCKETS[min(i, len(BUCKETS) - 1)], count)
+            for i, count in enumerate(self.counts) if count
+        )
+
+
+class LaunchTelemetry(object):
+    """
+    Aggregates the profiling info of completed kernel executions and the
+    readbacks after them: how long kernels ran, how long the device sat
+    between one kernel ending and the next starting (time the host loop
+    didn't keep it fed) and how long readbacks took.
+    """
+
+    def __init__(self):
+        self.last_kernel_end = None
+        self.reset()
+
+    def reset(self):
+        self.kernel = Histogram()
+        self.host_gap = Histogram()
+        self.readback = Histogram()
+
+    def completed(self, kernel_event, readback_event):
+        """Records a launch, returning its kernel time in seconds."""
+        kernel = kernel_event.profile
+        start, end = kernel.start, kernel.end
+        self.kernel.add((end - start) / 1e6)
+        if self.last_kernel_end is not None:
+            self.host_gap.add(max(start - self.last_kernel_end, 0) / 1e6)
+        self.last_kernel_end = end
+        readback = readback_event.profile
+        self.readback.add((readback.end - readback.start) / 1e6)
+        return (end - start) / 1e9
+
+    def stats(self):
+        """The histogram summaries since the last reset for display in the
+        miner status."""
+        if not self.kernel.count:
+            return {}
+        return {
+            'kernel ms': self.kernel.summary(),
+            'host gap ms': self.host_gap.summary(),
+            'readback ms': self.readback.summary(),
+        }
+
+
+class ShareLatency(object):
+    """
+    Times shares from being found to being sent, which covers waiting in
+    the result queue and verification, and from being sent to the server
+    answering.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.send = Histogram()
+        self.answer = Histogram()
+
+    def add(self, found, sent, answered):
+        """Records a share's times in seconds, returning its send and answer
+        latencies in milliseconds."""
+        send_ms = (sent - found) * 1000
+        answer_ms = (answered - sent) * 1000
+        self.send.add(send_ms)
+        self.answer.add(answer_ms)
+        return send_ms, answer_ms
+
+    def stats(self):
+        """The histogram summaries for display in the miner status."""
+        if not self.send.count:
+            return {}
+        return {
+            'send ms': self.send.summary(),
+            'answer ms': self.answer.summary(),
+        }
+
+
+class EndpointLatency(object):
+    """
+    Smoothed latencies of a server endpoint in milliseconds: connecting,
+    request round trips, and how long after the first endpoint to tell of a
+    new block it told of it. None until measured.
+    """
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.connect = self.rtt = self.notify = None
+
+    def add(self, kind, ms):
+        """Adds a measurement of kind 'connect', 'rtt' or 'notify'."""
+        average = getattr(self, kind)
+        if average is not None:
+            ms = average + self.smoothing * (ms - average)
+        setattr(self, kind, ms)
+
+    def score(self):
+        """How late work and shares are with the endpoint, the round trip
+        (the connect time until a request was answered) plus the notify
+        delay, or None if unknown."""
+        rtt = self.rtt if self.rtt is not None else self.connect
+        if rtt is None:
+            return None
+        return rtt + (self.notify or 0)
+
+    def __str__(self):
+        return ' '.join('%s %.1f ms' % (kind, getattr(self, kind))
+                        for kind in ('connect', 'rtt', 'notify')
+                        if getattr(self, kind) is not None)
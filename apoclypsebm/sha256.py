@@ -1,5 +1,18 @@
 from apoclypsebm.util import uint32
 
+NUMPY = False
+
+try:
+    import numpy as np
+
+    NUMPY = True
+except ImportError:
+    pass
+
+# Below this many headers the per-call overhead of NumPy outweighs the gain
+# and batches are hashed with the scalar functions instead.
+NUMPY_MIN_BATCH = 16
+
 K = (
     0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
     0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
@@ -84,6 +97,37 @@ def calculateF(state, merkle_end, time, difficulty, f, state2):
                                               (state2[5] | state2[6]))))
 
 
+def precompute(state, merkle_end, time, difficulty):
+    """Computes every nonce-independent argument of the search kernels, in
+    kernel argument order (everything before base).
+    """
+    f = [0, 0, 0, 0, 0, 0, 0, 0]
+    state2 = partial(state, merkle_end, time, difficulty, f)
+    calculateF(state, merkle_end, time, difficulty, f, state2)
+    w2, w16, w17, pre_val4, t1 = f[:5]
+
+    return (
+        state[0], state[1], state[2], state[3],
+        state[4], state[5], state[6], state[7],
+        # B1, C1, D1 + K[4] + W[4], F1, G1, H1
+        state2[1], state2[2], uint32(state2[3] + 0xb956c25b),
+        state2[5], state2[6], state2[7],
+        # P1(18) + P4(18), the nonce-independent part of W[18]
+        uint32((rotr(w16, 17) ^ rotr(w16, 19) ^ (w16 >> 10)) + w2),
+        w16, w17,
+        # Round 3, with state0 and T1 folded in
+        uint32(pre_val4 + state[0]),
+        uint32(pre_val4 + t1),
+        # K[5] + C1
+        uint32(K[5] + state2[2]),
+        # K[16] + W[16], K[17] + W[17]
+        uint32(K[16] + w16),
+        uint32(K[17] + w17),
+        # P1(19) + P2(19), the nonce-independent part of W[19]
+        uint32((rotr(w17, 17) ^ rotr(w17, 19) ^ (w17 >> 10)) + 0x11002000),
+    )
+
+
 def sha256(state, data):
     digest = list(state)
     for i in range(64):
@@ -142,3 +186,86 @@ def hash(midstate, merkle_end, time, difficulty, nonce):
     work[15] = 0x00000100
 
     return sha256(STATE, work)
+
+
+def _broadcast(columns):
+    size = max(
+        [len(column) for column in columns if not isinstance(column, int)],
+        default=1
+    )
+    return [
+        [column] * size if isinstance(column, int) else list(column)
+        for column in columns
+    ]
+
+
+def _np_rot(x, y):
+    return (x << np.uint32(y)) | (x >> np.uint32(32 - y))
+
+
+def _np_sha256(state, data):
+    """Vectorized equivalent of sha256() where every word of state and data
+    is a NumPy uint32 array (or uint32 scalar) and one lane is one message.
+    """
+    w = list(data) + [None] * 48
+    for i in range(16, 64):
+        x2, x15 = w[i - 2], w[i - 15]
+        w[i] = ((_np_rot(x2, 15) ^ _np_rot(x2, 13) ^ (x2 >> np.uint32(10)))
+                + w[i - 7]
+                + (_np_rot(x15, 25) ^ _np_rot(x15, 14) ^ (x15 >> np.uint32(3)))
+                + w[i - 16])
+
+    a, b, c, d, e, f, g, h = state
+    for i in range(64):
+        t1 = (h + (_np_rot(e, 26) ^ _np_rot(e, 21) ^ _np_rot(e, 7))
+              + (g ^ (e & (f ^ g))) + np.uint32(K[i]) + w[i])
+        t2 = ((_np_rot(a, 30) ^ _np_rot(a, 19) ^ _np_rot(a, 10))
+              + ((a & b) | (c & (a | b))))
+        h, g, f, e, d, c, b, a = g, f, e, d + t1, c, b, a, t1 + t2
+
+    return [x + y for x, y in zip((a, b, c, d, e, f, g, h), state)]
+
+
+def hash_many(midstate, merkle_end, time, difficulty, nonce):
+    """Batch form of hash(). Any of merkle_end, time, difficulty and nonce
+    may be a sequence, in which case one double-SHA-256 result is returned
+    per element; plain integers are shared by every element.
+    """
+    columns = (merkle_end, time, difficulty, nonce)
+    if not NUMPY:
+        columns = _broadcast(columns)
+        return [hash(midstate, *words) for words in zip(*columns)]
+
+    columns = np.broadcast_arrays(
+        *[np.asarray(column, dtype=np.uint32) for column in columns]
+    )
+    size = columns[0].size
+    if size < NUMPY_MIN_BATCH:
+        return [hash(midstate, *[int(x) for x in words])
+                for words in zip(*[column.ravel() for column in columns])]
+
+    zero = np.zeros(size, dtype=np.uint32)
+    data = [column.ravel() for column in columns] + [
+        zero + np.uint32(0x80000000)] + [zero] * 10 + [
+        zero + np.uint32(0x00000280)]
+    state = [np.uint32(word) for word in midstate]
+    with np.errstate(over='ignore'):
+        digest = _np_sha256(state, data)
+        data = digest + [zero + np.uint32(0x80000000)] + [zero] * 6 + [
+            zero + np.uint32(0x00000100)]
+        digest = _np_sha256([np.uint32(word) for word in STATE], data)
+    return np.stack(digest, axis=1).tolist()
+
+
+def midstate_many(blocks):
+    """Computes the midstate, sha256(STATE, block), of every block in
+    blocks, where each block is the first 16 message words of a header.
+    """
+    if not NUMPY or len(blocks) < NUMPY_MIN_BATCH:
+        return [sha256(STATE, list(block) + [0] * 48) for block in blocks]
+
+    words = np.asarray(blocks, dtype=np.uint32).reshape(-1, 16)
+    with np.errstate(over='ignore'):
+        digest = _np_sha256([np.uint32(word) for word in STATE],
+                            [words[:, i] for i in range(16)])
+    return np.stack(digest, axis=1).tolist()
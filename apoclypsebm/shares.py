@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from time import monotonic
+
+from apoclypsebm.util import Object
+
+# Shares are forgotten an hour after being sent, answered or not, and the
+# oldest first beyond MAX_SHARES.
+SHARE_TTL = 3600
+MAX_SHARES = 10000
+
+
+def share_key(result, nonce):
+    """
+    Identifies the share of nonce in result: its source, job, extranonce2,
+    ntime, nonce and block version. Sources without extranonce2 have the
+    block header stand in for it, which holds their merkle root.
+    """
+    return (result.server, result.job_id,
+            getattr(result, 'extranonce2', None) or bytes(result.header),
+            int(result.time), nonce, getattr(result, 'version', None))
+
+
+class ShareTracker(object):
+    """
+    Bookkeeping of the shares sent, from submission to the server's answer.
+    Shares are found by share_key() or by the id their submission carries,
+    and kept until they expire, so that the same share is never sent twice.
+    Memory stays bounded however long mining runs.
+    """
+
+    def __init__(self, ttl=SHARE_TTL, size=MAX_SHARES):
+        self.ttl = ttl
+        self.size = size
+        # Oldest first.
+        self.shares = OrderedDict()
+        self.ids = {}
+        self.count = 0
+        self.pending = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def add(self, key, **info):
+        """Tracks the share key is about to be sent, returning it with info
+        as attributes, or None if it already was sent."""
+        if key in self.shares:
+            self.duplicates += 1
+            return None
+        self.expire()
+        self.count += 1
+        share = Object()
+        share.__dict__.update(info)
+        share.key = key
+        share.id = 'share-%d' % self.count
+        share.added = monotonic()
+        share.answered = False
+        self.shares[key] = self.ids[share.id] = share
+        self.pending += 1
+        return share
+
+    def get(self, key):
+        return self.shares.get(key)
+
+    def by_id(self, id_):
+        return self.ids.get(id_)
+
+    def answer(self, share):
+        """Marks share answered, returning False if it already was."""
+        if share.answered:
+            return False
+        share.answered = True
+        self.pending -= 1
+        return True
+
+    def discard(self, share):
+        """Forgets share, which couldn't be sent and may be sent again."""
+        if self.shares.get(share.key) is share:
+            self.remove(share)
+
+    def remove(self, share):
+        del self.shares[share.key]
+        del self.ids[share.id]
+        if not share.answered:
+            self.pending -= 1
+
+    def expire(self):
+        deadline = monotonic() - self.ttl
+        while self.shares:
+            share = next(iter(self.shares.values()))
+            if len(self.shares) < self.size and share.added > deadline:
+                break
+            self.remove(share)
+            self.evicted += 1
+
+    def stats(self):
+        """Occupancy for display in the miner status."""
+        if not self.count:
+            return {}
+        return {
+            'shares': '%d tracked, %d pending, %d duplicate, %d expired' % (
+                len(self.shares), self.pending, self.duplicates,
+                self.evicted),
+        }
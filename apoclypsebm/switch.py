@@ -1,21 +1,41 @@
+import asyncio
 from binascii import hexlify, unhexlify
 from copy import copy
+from queue import Empty
 from struct import pack, unpack
-from threading import RLock
-from time import sleep, time
+from time import monotonic, time
 
 import socks
 
 from apoclypsebm import log
 from apoclypsebm.log import say_exception, say_line, say_quiet
-from apoclypsebm.sha256 import STATE, hash, sha256
-from apoclypsebm.util import Object, belowOrEquals, bytereverse, chunks, uint32
+from apoclypsebm.mining.telemetry import EndpointLatency, ShareLatency
+from apoclypsebm.sha256 import hash_many, midstate_many
+from apoclypsebm.shares import ShareTracker, share_key
+from apoclypsebm.util import (Object, apportion, belowOrEquals, bytereverse,
+                              chunks, nonce_ranges, rolled_versions, uint32)
 from apoclypsebm.work_sources import stratum
 
+# Seconds between rebalancing devices across weighted pools, and how much of
+# the hashes counted for a pool are kept each second (half after ten minutes).
+BALANCE_INTERVAL = 10
+BALANCE_DECAY = 0.5 ** (1 / 600)
+# Seconds between checks of the standby connections, and before connecting
+# again to a standby server that failed.
+STANDBY_INTERVAL = 5
+STANDBY_RETRY = 30
+# With --latency, another server is switched to once its latency score is
+# lower by both this fraction and this many milliseconds, and at most once
+# per SELECT_HOLD seconds, so that close servers don't take turns.
+SELECT_MARGIN = 0.2
+SELECT_MIN_MS = 5
+SELECT_HOLD = 60
+# How many of the latest new blocks are remembered to time notifies by.
+BLOCKS_SEEN = 16
+
 
 class Switch(object):
     def __init__(self, options, options_encoding):
-        self.lock = RLock()
         self.miners = []
         self.options = options
         self.options_encoding = options_encoding
@@ -34,9 +54,24 @@ class Switch(object):
 
         self.difficulty = 0
         self.true_target = None
-        self.last_block = ''
 
-        self.sent = {}
+        self.shares = ShareTracker()
+        self.share_latency = ShareLatency()
+        # Latencies by server name, when each new block was first notified
+        # and when the current server was set.
+        self.latency = {}
+        self.blocks_seen = {}
+        self.server_since = monotonic()
+        self.next_server = None
+
+        # Work sources run as coroutines on this event loop, woken by miners
+        # through wake().
+        self.event_loop = None
+        self.sources = []
+        # Tasks running the sources of backup servers on standby, by server,
+        # and when each server that failed may be tried again.
+        self.standbys = {}
+        self.standby_retry = {}
 
         if self.options.proxy:
             self.options.proxy = self.parse_server(self.options.proxy, False)
@@ -52,6 +87,15 @@ class Switch(object):
                 say_line("Ignored invalid server entry: %s", server)
                 continue
 
+        # With weights, the weighted servers are mined at once, each device
+        # mining for one of them, its pool.
+        self.weights = {}
+        self.pools = []
+        self.pool_stats = {}
+        self.last_balance = None
+        if self.options.weights:
+            self.set_weights(self.options.weights)
+
     def parse_server(self, server, mailAsUser=True):
         s = Object()
         temp = server.split('://', 1)
@@ -107,22 +151,91 @@ class Switch(object):
         self.miners.append(miner)
         miner.switch = self
 
-    def updatable_miner(self):
-        for miner in self.miners:
+    def pool_miners(self, source):
+        """The miners source gives work to: all of them, none while on
+        standby, or with weights the ones mining for its pool."""
+        if getattr(source, 'standby', False):
+            return []
+        if not self.pools:
+            return self.miners
+        return [miner for miner in self.miners
+                if miner.pool is source.server()]
+
+    def updatable_miner(self, source):
+        for miner in self.pool_miners(source):
             if miner.update:
                 miner.update = False
                 return miner
 
+    def prefetchable_miners(self, source):
+        """A miner for each work unit missing from the work buffers of the
+        miners of source not waiting for work, up to --prefetch units
+        each."""
+        return [miner for miner in self.pool_miners(source) if not miner.update
+                for i in range(self.options.prefetch - len(miner.work_buffer))]
+
+    def updatable_miners(self, source):
+        miners = [miner for miner in self.pool_miners(source) if miner.update]
+        for miner in miners:
+            miner.update = False
+        return miners
+
     def loop(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        self.event_loop = asyncio.get_running_loop()
         self.should_stop = False
         self.set_server_index(0)
 
+        if self.pools:
+            log.server = '+'.join(pool.name for pool in self.pools)
+            balancer = asyncio.ensure_future(self.balance_pools())
+            try:
+                await asyncio.gather(*[self.run_pool(pool)
+                                       for pool in self.pools])
+            finally:
+                balancer.cancel()
+            return
+
+        keeper = asyncio.ensure_future(self.keep_standbys())
+        try:
+            await self.run_failover()
+        finally:
+            keeper.cancel()
+            for task in self.standbys.values():
+                task.cancel()
+
+    async def run_failover(self):
         while True:
             if self.should_stop: return
 
-            failback = self.server_source().loop()
+            standby = self.standby_task(self.server())
+            if standby:
+                say_line('Switching to the standby connection')
+                self.server().source.promote()
+                failback = await standby
+            else:
+                source = await self.server_source()
+                source.standby = False
+                failback = await self.run_source(source)
+
+            if self.should_stop: return
+
+            index, self.next_server = self.next_server, None
+            if index is None and not failback:
+                index = self.healthy_standby()
+            if index is not None:
+                say_line('Switching over to %s on standby',
+                         self.servers[index].name)
+                self.errors = 0
+                self.last_server = None
+                self.backup_server_index = index + 1 if index else 1
+                self.set_server_index(index)
+                continue
 
-            sleep(1)
+            if not (failback and self.options.standby):
+                await asyncio.sleep(1)
 
             if failback:
                 say_line("Attempting to fail back to primary server")
@@ -155,6 +268,158 @@ class Switch(object):
                     self.backup_server_index += 1
                 self.set_server_index(new_server_index)
 
+    async def run_source(self, source):
+        """Runs source until it stops, sending its results meanwhile."""
+        self.sources.append(source)
+        submitter = asyncio.ensure_future(source.submit_results())
+        try:
+            return await source.loop()
+        finally:
+            submitter.cancel()
+            self.sources.remove(source)
+
+    async def run_standby(self, server):
+        source = await self.server_source(server, standby=True)
+        if not source.keeps_jobs:
+            return
+        source.standby = True
+        return await self.run_source(source)
+
+    def standby_servers(self):
+        """The servers to keep on standby: the next --standby ones failover
+        would go to, and the primary one while on a backup."""
+        if not self.options.standby:
+            return []
+        count = len(self.servers)
+        order = list(range(self.backup_server_index, count)) + \
+            list(range(count))
+        order = [index for index in dict.fromkeys(order)
+                 if index != self.server_index
+                 and self.can_stand_by(self.servers[index])]
+        standby = order[:self.options.standby]
+        if self.server_index != 0 and 0 not in standby and \
+                self.can_stand_by(self.servers[0]):
+            standby.append(0)
+        return [self.servers[index] for index in standby]
+
+    def can_stand_by(self, server):
+        """Whether server is worth keeping on standby: unless its source,
+        once made, turned out not to keep jobs."""
+        source = getattr(server, 'source', None)
+        return not source or source.keeps_jobs
+
+    async def keep_standbys(self):
+        """Keeps a source running on standby for each of the standby
+        servers, connected and following their jobs, so that failing over to
+        one only takes pointing the miners at it."""
+        if not self.options.standby:
+            return
+        while True:
+            wanted = self.standby_servers()
+            for server, task in list(self.standbys.items()):
+                if task.done() or server not in wanted:
+                    del self.standbys[server]
+                    if task.done():
+                        self.standby_retry[server.name] = (
+                            monotonic() + STANDBY_RETRY)
+                    else:
+                        task.cancel()
+            for server in wanted:
+                if server not in self.standbys and monotonic() >= \
+                        self.standby_retry.get(server.name, 0):
+                    self.standbys[server] = asyncio.ensure_future(
+                        self.run_standby(server))
+            if self.options.latency:
+                self.select_server()
+            await asyncio.sleep(STANDBY_INTERVAL)
+
+    def standby_task(self, server):
+        """Takes the task running server's source on standby, if it is
+        running."""
+        task = self.standbys.pop(server, None)
+        if task and not task.done() and \
+                getattr(server, 'source', None) in self.sources:
+            return task
+        if task:
+            task.cancel()
+
+    def standby_healthy(self, server):
+        """Whether server's source is on standby with a job to mine."""
+        task = self.standbys.get(server)
+        return bool(task) and not task.done() and server.source.healthy()
+
+    def healthy_standby(self):
+        """The index of the first server in failover order, or with
+        --latency the fastest, that is standby_healthy(), if any."""
+        servers = [server for server in self.standby_servers()
+                   if self.standby_healthy(server)]
+        if self.options.latency:
+            servers.sort(key=self.latency_score)
+        if servers:
+            return self.servers.index(servers[0])
+
+    def endpoint_latency(self, server):
+        latency = self.latency.get(server.name)
+        if latency is None:
+            latency = self.latency[server.name] = EndpointLatency()
+        return latency
+
+    def latency_score(self, server):
+        """server's latency score, unknown ones last."""
+        score = self.endpoint_latency(server).score()
+        return float('inf') if score is None else score
+
+    def block_notified(self, server, block):
+        """Times server's notify of the new block block against the first
+        server's to notify it."""
+        now = monotonic()
+        first = self.blocks_seen.setdefault(block, now)
+        while len(self.blocks_seen) > BLOCKS_SEEN:
+            del self.blocks_seen[next(iter(self.blocks_seen))]
+        self.endpoint_latency(server).add('notify', (now - first) * 1000)
+
+    def select_server(self):
+        """With --latency, switches to the healthy standby server with the
+        lowest latency score if it beats the current server's by the margins
+        above."""
+        if monotonic() - self.server_since < SELECT_HOLD:
+            return
+        index = self.healthy_standby()
+        source = getattr(self.server(), 'source', None)
+        if index is None or source not in self.sources:
+            return
+        best = self.latency_score(self.servers[index])
+        current = self.latency_score(self.server())
+        if current - best > max(current * SELECT_MARGIN, SELECT_MIN_MS):
+            if self.options.verbose:
+                say_line('%s: %s, %s: %s', (
+                    self.server().name, self.endpoint_latency(self.server()),
+                    self.servers[index].name,
+                    self.endpoint_latency(self.servers[index])))
+            self.next_server = index
+            source.stop()
+
+    def can_fail_back(self):
+        """Whether to try failing back to the primary server: if it is kept
+        on standby, only once it is healthy. Never with --latency, the
+        fastest server is mined instead."""
+        if self.options.latency:
+            return False
+        primary = self.servers[0]
+        source = getattr(primary, 'source', None)
+        if not (self.options.standby and source and source.keeps_jobs):
+            return True
+        return self.standby_healthy(primary)
+
+    async def run_pool(self, pool):
+        """Keeps mining for pool, reconnecting after errors. Its devices
+        move to the other pools meanwhile."""
+        while True:
+            await self.run_source(await self.server_source(pool))
+            if self.should_stop: return
+            self.balance()
+            await asyncio.sleep(1)
+
     def connection_ok(self):
         self.errors = 0
         if self.server_index == 0:
@@ -163,34 +428,184 @@ class Switch(object):
 
     def stop(self):
         self.should_stop = True
-        if self.server_index != -1:
-            self.server_source().stop()
+        for source in list(self.sources):
+            source.stop()
+
+    def wake(self):
+        """Wakes the running work sources waiting in Source.wait(). Safe to
+        call from any thread."""
+        try:
+            self.event_loop.call_soon_threadsafe(self.wake_sources)
+        except (AttributeError, RuntimeError):
+            # No event loop yet or any more.
+            pass
+
+    def wake_sources(self):
+        for source in self.sources:
+            source.wakeup.set()
+
+    def set_weights(self, weights):
+        """Mines for the servers tagged in weights, a dict of weight by tag,
+        at once, splitting hashes between them in proportion to their
+        weights. The servers are fixed once mining, but their weights can be
+        changed, or set to 0, at any time and take effect right away."""
+        servers = {server.name: server for server in self.servers}
+        for tag in weights:
+            if tag not in servers:
+                say_line('No server tagged %s to weigh', tag)
+        self.weights = {tag: weight for tag, weight in weights.items()
+                        if tag in servers}
+        if self.event_loop is None:
+            self.pools = [server for server in self.servers
+                          if server.name in self.weights]
+        else:
+            self.event_loop.call_soon_threadsafe(self.balance)
+
+    def pool_stat(self, server):
+        """The hashes, shares and stale results counted for server."""
+        stat = self.pool_stats.get(server.name)
+        if stat is None:
+            stat = self.pool_stats[server.name] = Object()
+            stat.hashes = 0
+            stat.share_count = [0, 0]
+            stat.stale_count = 0
+        return stat
+
+    async def balance_pools(self):
+        while True:
+            settled = self.balance()
+            await asyncio.sleep(BALANCE_INTERVAL if settled else 1)
+
+    def balance(self):
+        """Moves devices between the pools mining, so that each gets its
+        weighted share of the hashes. Returns whether every device has a
+        pool mining."""
+        now = monotonic()
+        if self.last_balance is not None:
+            elapsed = now - self.last_balance
+            # Past hashes count for less and less, so that a pool that was
+            # down doesn't get everything for long when it's back.
+            decay = BALANCE_DECAY ** elapsed
+            for pool in self.pools:
+                self.pool_stat(pool).hashes *= decay
+            for miner in self.miners:
+                if miner.pool is not None:
+                    self.pool_stat(miner.pool).hashes += (
+                        miner.rate * 1e6 * elapsed)
+        self.last_balance = now
+
+        mining = [pool for pool in self.pools
+                  if self.weights.get(pool.name, 0) > 0 and self.mining(pool)]
+        if not mining:
+            return False
+        assignment = apportion(
+            [miner.rate for miner in self.miners],
+            [self.weights.get(pool.name, 0) for pool in mining],
+            [self.pool_stat(pool).hashes for pool in mining],
+            BALANCE_INTERVAL,
+            [mining.index(miner.pool) if miner.pool in mining else None
+             for miner in self.miners]
+        )
+        for miner, index in zip(self.miners, assignment):
+            if miner.pool is not mining[index]:
+                if self.options.verbose:
+                    say_line('%s: mining for %s',
+                             (miner.id(), mining[index].name))
+                miner.pool = mining[index]
+                self.clear_work(miner, True)
+                miner.update = True
+                self.wake()
+        if self.options.verbose:
+            self.pools_updated()
+        return True
+
+    def mining(self, pool):
+        """Whether pool's source is running and able to take results."""
+        source = getattr(pool, 'source', None)
+        return source in self.sources and source.ready.is_set()
+
+    def pools_updated(self):
+        hashes = sum(self.pool_stat(pool).hashes for pool in self.pools)
+        weights = sum(self.weights.values())
+        for pool in self.pools:
+            stat = self.pool_stat(pool)
+            say_line('%s: %.03f MH/s, %.1f%% of hashes (weight %.1f%%) '
+                     '[Rej: %d/%d] [Stale: %d]', (
+                pool.name,
+                sum(miner.rate for miner in self.miners
+                    if miner.pool is pool),
+                100 * stat.hashes / hashes if hashes else 0,
+                100 * self.weights.get(pool.name, 0) / weights if weights else 0,
+                stat.share_count[0], sum(stat.share_count),
+                stat.stale_count))
 
     # callers must provide hex encoded block header and target
     def decode(self, server, block_header, target, job_id=None,
                extranonce2=None):
         if block_header:
+            return self.decode_many(server, ((block_header, job_id,
+                                              extranonce2),), target)[0]
+
+    def decode_many(self, server, works, target):
+        """Decodes several (block_header, job_id, extranonce2) work units
+        sharing the same target, computing their midstates in one batch.
+        Where server allows version rolling, each job also gets midstates for
+        --version-rolls block versions in all, state, header and version
+        being the first of states, headers and versions.
+        """
+        job_target, targetQ = self.decode_target(target)
+        version_mask = getattr(server, 'version_mask', 0)
+
+        jobs = []
+        blocks = []
+        for block_header, job_id, extranonce2 in works:
             job = Object()
 
             binary_data = unhexlify(block_header)
-            data0 = list(unpack('<16I', binary_data[:64])) + ([0] * 48)
-
-            job.target = unpack('<8I', unhexlify(target))
-            job.header = binary_data[:68]
+            job.block = unpack('<16I', binary_data[:64])
+            job.versions = rolled_versions(
+                unpack('>I', binary_data[:4])[0], version_mask,
+                self.options.version_rolls if version_mask else 1
+            )
+            job.headers = [pack('>I', version) + binary_data[4:68]
+                           for version in job.versions]
+            blocks.extend((bytereverse(version),) + job.block[1:]
+                          for version in job.versions)
+            job.target = job_target
+            job.header = job.headers[0]
             job.merkle_end = uint32(unpack('<I', binary_data[64:68])[0])
             job.time = uint32(unpack('<I', binary_data[68:72])[0])
             job.difficulty = uint32(unpack('<I', binary_data[72:76])[0])
-            job.state = sha256(STATE, data0)
-            job.targetQ = 2 ** 256 // int(''.join(list(chunks(target, 2))[::-1]),
-                                         16)
+            job.targetQ = targetQ
             job.job_id = job_id
             job.extranonce2 = extranonce2
             job.server = server
-
-            if job.difficulty != self.difficulty:
-                self.set_difficulty(job.difficulty)
-
-            return job
+            job.nonce_start, job.nonce_end = 0, 1 << 32
+            jobs.append(job)
+
+        states = midstate_many(blocks)
+        for job in jobs:
+            job.states = states[:len(job.versions)]
+            job.state = job.states[0]
+            del states[:len(job.versions)]
+
+        if jobs and jobs[-1].difficulty != self.difficulty:
+            self.set_difficulty(jobs[-1].difficulty)
+
+        return jobs
+
+    def decode_target(self, target):
+        """Returns the words of a hex encoded target and the expected number
+        of hashes per share meeting it."""
+        return (unpack('<8I', unhexlify(target)),
+                2 ** 256 // int(''.join(list(chunks(target, 2))[::-1]), 16))
+
+    def update_target(self, server, target):
+        """Updates the share target of work from server the miners already
+        have, as when a stratum server changes the difficulty."""
+        job_target, targetQ = self.decode_target(target)
+        for miner in self.miners:
+            miner.target_updated(server, job_target, targetQ)
 
     def set_difficulty(self, difficulty):
         self.difficulty = difficulty
@@ -200,10 +615,15 @@ class Switch(object):
         true_target = ''.join(list(chunks(true_target, 2))[::-1])
         self.true_target = unpack('<8I', unhexlify(true_target))
 
-    def send(self, result, send_callback):
-        for nonce in result.miner.nonce_generator(result.nonces):
-            h = hash(result.state, result.merkle_end, result.time,
-                     result.difficulty, nonce)
+    async def send(self, result, send_callback):
+        if self.stale(result):
+            result.miner.stale_count += 1
+            self.pool_stat(result.server.server()).stale_count += 1
+            return True  # there's no point verifying or sending it
+        nonces = list(result.miner.nonce_generator(result.nonces))
+        hashes = hash_many(result.state, result.merkle_end, result.time,
+                           result.difficulty, nonces)
+        for nonce, h in zip(nonces, hashes):
             if h[7] != 0:
                 hash6 = hexlify(pack('<I', int(h[6])))
                 say_line('Verification failed, check hardware! (%s, %s)',
@@ -218,14 +638,28 @@ class Switch(object):
                     print(hex(result.time))
                     print(hex(nonce))
 
-                    is_block = belowOrEquals(h[:7], self.true_target[:7])
-                    hash6 = hexlify(pack('<I', int(h[6])))
-                    hash5 = hexlify(pack('<I', int(h[5])))
-                    self.sent[nonce] = (is_block, hash6, hash5)
-                    if not send_callback(result, nonce):
+                    share = self.shares.add(
+                        share_key(result, nonce), miner=result.miner,
+                        is_block=belowOrEquals(h[:7], self.true_target[:7]),
+                        hash6=hexlify(pack('<I', int(h[6]))),
+                        hash5=hexlify(pack('<I', int(h[5]))),
+                        found=result.found, sent=monotonic(),
+                        pool=result.server.server())
+                    if not share:
+                        say_line('%s: duplicate share not sent again',
+                                 result.miner.id())
+                        continue
+                    if not await send_callback(result, nonce):
+                        self.shares.discard(share)
                         return False
         return True
 
+    def stale(self, result):
+        """Whether result is for a block that's no longer the latest or a
+        job its source has dropped."""
+        return (result.header[25:29] != result.server.last_block
+                or not result.server.job_alive(result.job_id))
+
     def diff1_found(self, hash_, target):
         if self.options.verbose and target < 0xFFFF0000:
             say_line('checking %s <= %s', (hash_, target))
@@ -240,23 +674,40 @@ class Switch(object):
         total_shares = rejected_shares + miner.share_count[
             1] if verbose else sum([m.share_count[1] for m in self.miners])
         total_shares_estimator = max(total_shares, 1)
-        say_quiet('%s[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]', (
+        stale = miner.stale_count if verbose else sum(
+            [m.stale_count for m in self.miners])
+        stats = ''.join([' [%s: %s]' % stat for stat in (
+            list(miner.stats.items()) + list(self.share_latency.stats().items())
+            + list(self.shares.stats().items())
+            + list(miner.work_lock.stats('work lock').items()))
+                         ]) if verbose else ''
+        say_quiet('%s[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]%s%s', (
         miner.id() + ' ' if verbose else '', rate, round(estimated_rate),
         rejected_shares, total_shares,
-        float(rejected_shares) * 100 / total_shares_estimator))
-
-    def report(self, miner, nonce, accepted):
-        is_block, hash6, hash5 = self.sent[nonce]
+        float(rejected_shares) * 100 / total_shares_estimator,
+        ' [Stale: %d]' % stale if stale else '', stats))
+
+    def report(self, share, accepted):
+        """Counts the server's answer to share, from shares, once."""
+        if not share or not self.shares.answer(share):
+            return
+        miner = share.miner
         miner.share_count[1 if accepted else 0] += 1
-        hash_ = hash6 + hash5 if is_block else hash6
-        if self.options.verbose or is_block:
-            say_line('%s %s%s, %s', (
-            miner.id(), 'block ' if is_block else '', hash_,
-            'accepted' if accepted else '_rejected_'))
-        del self.sent[nonce]
+        self.pool_stat(share.pool).share_count[1 if accepted else 0] += 1
+        send_ms, ack_ms = self.share_latency.add(share.found, share.sent,
+                                                 monotonic())
+        hash_ = share.hash6 + share.hash5 if share.is_block else share.hash6
+        if self.options.verbose or share.is_block:
+            say_line('%s %s%s, %s (sent after %.1f ms, answered in %.1f ms)', (
+            miner.id(), 'block ' if share.is_block else '', hash_,
+            'accepted' if accepted else '_rejected_', send_ms, ack_ms))
 
     def set_server_index(self, server_index):
         self.server_index = server_index
+        self.server_since = monotonic()
+        for miner in self.miners:
+            with miner.work_lock:
+                miner.work_buffer.clear()
         user = self.servers[server_index].user
         name = self.servers[server_index].name
         # say_line('Setting server %s (%s @ %s)', (name, user, host))
@@ -280,68 +731,194 @@ class Switch(object):
         return False
 
     def queue_work(self, server, block_header, target=None, job_id=None,
-                   extranonce2=None, miner=None, transactions=None):
+                   extranonce2=None, miner=None, transactions=None,
+                   clean=False, prefetch=False):
+        """Queues work for miner, the first miner by default, the others
+        then wanting new work. Work for a new block, or with clean set, first
+        flushes the work of all miners. With prefetch the work goes to the
+        miner's work buffer instead, unless it flushed it."""
+        if not miner:
+            miners = self.pool_miners(server)
+            if not miners:
+                return
+            miner = miners[0]
+            for other in miners[1:]:
+                other.update = True
         work = self.decode(server, block_header, target, job_id, extranonce2)
-        work.transactions = transactions
-        with self.lock:
-            if not miner:
-                miner = self.miners[0]
-                for i in range(1, len(self.miners)):
-                    self.miners[i].update = True
-            miner.work_queue.put(work)
+        if work:
+            work.transactions = transactions
+        if work and (self.new_block(work) or clean):
+            self.flush_work(server, [miner])
+        elif work and prefetch:
+            miner.work_buffer.append(work)
+            return
+        miners, shards = [miner], [work]
+        if work and self.options.shard and miner.shardable:
+            # Other miners waiting for work share this unit.
+            miners += [other for other in self.pool_miners(server)
+                       if other.update and other.shardable
+                       and other is not miner]
+            shards = self.shard(work, miners)
+        for miner, shard in zip(miners, shards):
+            miner.work_queue.put(shard)
             if work:
-                miner.update = False;
-                self.last_work = time()
-                if self.last_block != work.header[25:29]:
-                    self.last_block = work.header[25:29]
-                    self.clear_result_queue(server)
-
-    def clear_result_queue(self, server):
-        while not server.result_queue.empty():
-            server.result_queue.get(False)
-
-    def server_source(self):
-        if not hasattr(self.server(), 'source'):
+                miner.update = False
+        if work:
+            self.work_queued(server, work)
+
+    def queue_work_many(self, server, works, target, miners=None,
+                        transactions=None, clean=False, prefetch=False):
+        """Hands one of works, a sequence of (block_header, job_id,
+        extranonce2), to each of miners, all miners by default. With --shard
+        the first is shared by the miners that can take part of one, see
+        work_units(). Like queue_work(), new blocks and clean flush the work
+        of all miners first, and prefetch buffers the work instead.
+        """
+        miners = miners or self.pool_miners(server)
+        if not miners:
+            return
+        jobs = self.decode_many(server, works, target)
+        for work in jobs:
+            work.transactions = transactions
+        flush = bool(jobs) and (self.new_block(jobs[0]) or clean)
+        if prefetch:
+            if not flush:
+                for miner, work in zip(miners, jobs):
+                    miner.work_buffer.append(work)
+                return
+            # Work for a new block is for right away, one unit per miner.
+            miners = list(dict.fromkeys(miners))
+        if self.options.shard and jobs:
+            shared = [miner for miner in miners if miner.shardable]
+            if shared:
+                miners = shared + [miner for miner in miners
+                                   if not miner.shardable]
+                jobs[:1] = self.shard(jobs[0], shared)
+        if flush:
+            self.flush_work(server, miners[:len(jobs)])
+        for miner, work in zip(miners, jobs):
+            miner.work_queue.put(work)
+            miner.update = False
+        if jobs:
+            self.work_queued(server, jobs[-1])
+
+    def work_units(self, miners):
+        """How many work units queue_work_many() needs for miners: one each,
+        or with --shard one for all that can share it and one each for the
+        rest."""
+        if not self.options.shard:
+            return len(miners)
+        unshared = len([miner for miner in miners if not miner.shardable])
+        return unshared + (unshared < len(miners))
+
+    def shard(self, work, miners):
+        """Copies of work for each of miners, splitting its nonces between
+        them in proportion to their hash rates. The nonce ranges can't
+        overlap, so neither can the searches, whatever ntime each rolls to.
+        """
+        shards = []
+        for start, end in nonce_ranges([miner.rate for miner in miners],
+                                       space=work.nonce_end - work.nonce_start):
+            shard = copy(work)
+            shard.nonce_start = work.nonce_start + start
+            shard.nonce_end = work.nonce_start + end
+            shards.append(shard)
+        return shards
+
+    def work_queued(self, server, work):
+        self.last_work = time()
+
+    def new_block(self, work):
+        """Whether work is for another block than the work before from its
+        source, which it then makes the source's latest block."""
+        if work.server.last_block == work.header[25:29]:
+            return False
+        work.server.last_block = work.header[25:29]
+        return True
+
+    def flush_work(self, server, receiving=()):
+        """Drops the queued work of all miners of server, none of which is
+        worth searching any more. Miners not receiving new work right away
+        stop searching what they have and want new work. Their launches in
+        flight still complete, and send() drops the stale results."""
+        for miner in self.pool_miners(server):
+            self.clear_work(miner, miner not in receiving)
+            if miner not in receiving:
+                miner.update = True
+        # Have the source refill the work buffers.
+        self.wake()
+
+    def clear_work(self, miner, stop=False):
+        """Drops the work queued and buffered for miner, at once so that
+        want_work() can't put buffered work back in between. With stop the
+        miner stops searching its current work too."""
+        with miner.work_lock:
+            while True:
+                try:
+                    miner.work_queue.get_nowait()
+                except Empty:
+                    break
+            miner.work_buffer.clear()
+            if stop:
+                miner.work_queue.put(None)
+
+    async def server_source(self, server=None, standby=False):
+        """The work source of server, the current server by default, made
+        on first use. With standby, work it gets while checking for stratum
+        doesn't go to the miners."""
+        server = server or self.server()
+        if not getattr(server, 'source', None):
             http_source = None
-            if self.server().proto == 'http':
+            if server.proto == 'http':
                 from apoclypsebm.work_sources.getblocktemplate import GetblocktemplateSource
-                http_source = GetblocktemplateSource(self)
-            elif self.server().proto == 'getwork+http':
+                http_source = GetblocktemplateSource(self, server)
+            elif server.proto == 'getwork+http':
                 from apoclypsebm.work_sources.getwork import GetworkSource
-                http_source = GetworkSource(self)
+                http_source = GetworkSource(self, server)
             else:
-                self.add_stratum_source()
+                await self.add_stratum_source(server)
 
             if http_source:
+                http_source.standby = standby
                 say_line('checking for stratum...')
-                stratum_host = http_source.detect_stratum()
+                stratum_host = await http_source.detect_stratum()
                 if stratum_host:
                     http_source.close_connection()
-                    self.server().proto = 'stratum'
-                    self.server().host = stratum_host
-                    self.add_stratum_source()
+                    server.proto = 'stratum'
+                    server.host = stratum_host
+                    await self.add_stratum_source(server)
                 else:
-                    self.server().source = http_source
+                    server.source = http_source
 
-        return self.server().source
+        return server.source
 
-    def add_stratum_source(self):
+    async def add_stratum_source(self, server):
         if self.options.stratum_proxies:
-            stratum_proxy = stratum.detect_stratum_proxy(
-                self.server().host)
+            stratum_proxy = await self.event_loop.run_in_executor(
+                None, stratum.detect_stratum_proxy, server.host)
             if stratum_proxy:
-                original_server = copy(self.server())
-                original_server.source = stratum.StratumSource(self)
+                original_server = copy(server)
+                original_server.source = stratum.StratumSource(
+                    self, original_server)
                 self.servers.insert(self.backup_server_index, original_server)
-                self.server().host = stratum_proxy
-                self.server().name += '(p)'
-                log.server = self.server().name
+                server.host = stratum_proxy
+                server.name += '(p)'
+                log.server = server.name
             else:
                 say_line('No proxy found')
-        self.server().source = stratum.StratumSource(self)
+        server.source = stratum.StratumSource(self, server)
 
     def server(self):
         return self.servers[self.server_index]
 
     def put(self, result):
-        result.server.result_queue.put(result)
+        """Queues a result for its server from a miner thread."""
+        result.found = monotonic()
+        loop = self.event_loop
+        if not loop or loop.is_closed():
+            return  # nothing is left to send it
+        try:
+            loop.call_soon_threadsafe(
+                result.server.result_queue.put_nowait, result)
+        except RuntimeError:
+            pass  # the loop closed in the meantime
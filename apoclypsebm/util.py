@@ -1,12 +1,48 @@
+from apoclypsebm.detect import WINDOWS
 from apoclypsebm.log import say_exception
 from struct import Struct
+from threading import Lock
+from time import monotonic
+import os
 import sys
+import tempfile
 
 
 class Object(object):
     pass
 
 
+class CountingLock(object):
+    """
+    A lock counting how often it is taken, how often it had to be waited
+    for and for how long, to show that it is rarely contended.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.acquired = 0
+        self.contended = 0
+        self.waited = 0.0
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            start = monotonic()
+            self.lock.acquire()
+            self.contended += 1
+            self.waited += monotonic() - start
+        self.acquired += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+    def stats(self, name):
+        if not self.acquired:
+            return {}
+        return {name: '%d/%d contended, %.1f ms waited' % (
+            self.contended, self.acquired, self.waited * 1000)}
+
+
 def uint32(x):
     """
     Ensure only first 32-bits are used in the integer. e.g. if we get an integer
@@ -38,11 +74,134 @@ def belowOrEquals(hash_, target):
     return True
 
 
+# The block version bits BIP 320 leaves to miners when rolling is allowed.
+VERSION_ROLLING_MASK = 0x1fffe000
+
+
+def rolled_versions(version, mask, count):
+    """
+    Returns version followed by up to count - 1 versions differing from it
+    only in the bits set in mask, as BIP 310 version rolling allows.
+    """
+    bits = [1 << i for i in range(32) if mask & (1 << i)]
+    versions = []
+    for index in range(min(count, 1 << len(bits))):
+        rolled = version
+        for i, bit in enumerate(bits):
+            if index & (1 << i):
+                rolled ^= bit
+        versions.append(rolled)
+    return versions
+
+
+# Nonce range boundaries of shards, a multiple of any power of two number of
+# threads a kernel launch could need.
+SHARD_ALIGN = 1 << 20
+
+
+def nonce_ranges(rates, align=SHARD_ALIGN, space=1 << 32):
+    """
+    Splits the nonces [0, space) into one (start, end) range for each of
+    rates, sized in proportion to them, so that no two overlap. Boundaries
+    are multiples of align and every range gets at least align nonces.
+    Unknown (zero) rates count as the average of the known ones.
+    """
+    known = [rate for rate in rates if rate > 0]
+    average = sum(known) / len(known) if known else 1
+    rates = [rate if rate > 0 else average for rate in rates]
+    total = sum(rates)
+    blocks = space // align
+    bounds = [0]
+    so_far = 0
+    for i, rate in enumerate(rates[:-1], 1):
+        so_far += rate
+        block = round(blocks * so_far / total)
+        block = min(max(block, bounds[-1] // align + 1),
+                    blocks - (len(rates) - i))
+        bounds.append(block * align)
+    bounds.append(space)
+    return list(zip(bounds, bounds[1:]))
+
+
+def apportion(rates, weights, done, period, current=None):
+    """
+    Assigns devices hashing at rates to pools with weights for the next
+    period seconds, returning the index of the pool for each device. Every
+    pool is due its weighted share of all hashes done by then, less the ones
+    in done it already got. Devices, fastest first, go to the pool furthest
+    short of its due, but stay with their pool in current while that is
+    short by more than half of what they would hash for it. Unknown (zero)
+    rates count as the average of the known ones.
+    """
+    known = [rate for rate in rates if rate > 0]
+    average = sum(known) / len(known) if known else 1
+    rates = [rate if rate > 0 else average for rate in rates]
+    total = sum(done) + sum(rates) * period
+    due = [total * weight / sum(weights) - hashes
+           for weight, hashes in zip(weights, done)]
+    pools = [None] * len(rates)
+    for i in sorted(range(len(rates)), key=lambda i: -rates[i]):
+        hashes = rates[i] * period
+        pool = max(range(len(weights)), key=lambda p: due[p])
+        if current and current[i] is not None and weights[current[i]] \
+                and due[current[i]] > hashes / 2:
+            pool = current[i]
+        pools[i] = pool
+        due[pool] -= hashes
+    return pools
+
+
 def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
 
+def user_dir(kind):
+    """
+    The apoclypsebm directory within the user's XDG base directory of the given
+    kind, 'config' or 'cache'.
+    """
+    base = os.environ.get(f'XDG_{kind.upper()}_HOME')
+    if not base and WINDOWS:
+        base = os.environ.get('LOCALAPPDATA')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), f'.{kind}')
+    return os.path.join(base, 'apoclypsebm')
+
+
+def atomic_write(path, data):
+    """
+    Writes data to path through a temporary file in the same directory so
+    that concurrent readers only ever see a complete file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def tokenize_weights(option):
+    """Parses TAG=WEIGHT,... into a dict of weights by server tag."""
+    weights = {}
+    if option:
+        try:
+            for entry in option.split(','):
+                tag, weight = entry.rsplit('=', 1)
+                weights[tag] = float(weight)
+                if weights[tag] < 0:
+                    raise ValueError(f'negative weight for {tag}')
+        except ValueError:
+            say_exception('Invalid weights specified: %s\n\n' % option)
+            sys.exit()
+    return weights
+
+
 def tokenize(option, name, default=[0], cast=int):
     if option:
         try:
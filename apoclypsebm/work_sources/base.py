@@ -1,30 +1,212 @@
-from queue import Queue
+import asyncio
+import http.client
+from base64 import b64encode
+from json import loads
 from time import monotonic
 
+from apoclypsebm.log import say_exception, say_line
+from apoclypsebm.work_sources.connection import HTTPConnection
+
+# Seconds to wait for the response to a request other than a long poll.
+REQUEST_TIMEOUT = 20
+# Seconds before asking again for work a request failed to get.
+RETRY_INTERVAL = 1
+
+
+class NotAuthorized(Exception):
+    pass
+
+
+class RPCError(Exception):
+    pass
+
 
 class Source(object):
-    def __init__(self, switch):
+    # Whether the source follows the server's jobs without miners asking for
+    # work, so that it is worth keeping on standby.
+    keeps_jobs = False
+
+    def __init__(self, switch, server=None):
         self.switch = switch
-        self.result_queue = Queue()
+        # The server this source gets work from, the current one by default.
+        self.pool = server or switch.server()
+        # Woken by the switch when miners want work or the source stops.
+        self.wakeup = asyncio.Event()
+        # The previous block hash of the latest work from this source.
+        self.last_block = ''
+        # A source on standby keeps connected without giving work to miners.
+        self.standby = False
+        self.result_queue = asyncio.Queue()
+        # Set while the source can submit results.
+        self.ready = asyncio.Event()
         self.options = switch.options
+        # Block version bits miners may roll for this source (BIP 310).
+        self.version_mask = 0
 
     def server(self):
-        return self.switch.server()
+        return self.pool
 
-    def loop(self):
+    async def loop(self):
         self.should_stop = False
         self.last_failback = monotonic()
+        self.ready.set()
+
+    def job_alive(self, job_id):
+        """Whether results for job_id may still be submitted."""
+        return True
 
     def check_failback(self):
-        if self.switch.server_index != 0 and monotonic() - self.last_failback > self.options.failback:
-            self.stop()
-            return True
-
-    def process_result_queue(self):
-        while not self.result_queue.empty():
-            result = self.result_queue.get(False)
-            with self.switch.lock:
-                if not self.switch.send(result, self.send_internal):
-                    self.result_queue.put(result)
-                    self.stop()
-                    break
+        if self.standby or self.switch.server_index == 0:
+            return
+        if monotonic() - self.last_failback > self.options.failback:
+            if self.switch.can_fail_back():
+                self.stop()
+                return True
+            self.last_failback = monotonic()
+
+    def healthy(self):
+        """Whether the source could give miners work right away."""
+        return self.ready.is_set()
+
+    def promote(self):
+        """Takes the source off standby, pointing the miners at it."""
+        self.standby = False
+        self.switch.flush_work(self)
+
+    async def wait(self, timeout=None):
+        """Waits until the switch is woken, by miners wanting work or the
+        source stopping, until it's time to fail back, or up to timeout
+        seconds."""
+        if self.switch.server_index != 0 and not self.standby:
+            failback = max(self.last_failback + self.options.failback
+                           - monotonic(), 0) + 0.01
+            timeout = failback if timeout is None else min(timeout, failback)
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+    async def submit_results(self):
+        """Sends results as soon as miners put them, alongside the source
+        loop so submissions never wait for work to be fetched. Stops the
+        source if one can't be sent, keeping it queued for the next try."""
+        while True:
+            result = await self.result_queue.get()
+            await self.ready.wait()
+            try:
+                sent = await self.switch.send(result, self.send_internal)
+            except Exception:
+                say_exception('Unexpected error submitting a result:')
+                continue
+            if not sent:
+                self.result_queue.put_nowait(result)
+                self.stop()
+                return
+
+
+class HTTPSource(Source):
+    """
+    A source talking JSON-RPC over HTTP. Work requests, long polls and
+    result submissions each have a connection of their own, so that none
+    waits for the others.
+    """
+
+    def __init__(self, switch, server=None):
+        super(HTTPSource, self).__init__(switch, server)
+
+        self.connection = self.lp_connection = self.submit_connection = None
+        self.long_poll_timeout = 3600
+        self.max_redirects = 3
+
+        self.headers = {'User-Agent': self.switch.user_agent,
+                        'Authorization': 'Basic ' + b64encode(
+                            b'%b:%b' % (self.server().user_bytes, self.server().pwd_bytes)).decode('ascii'),
+                        'X-Mining-Extensions': 'hostlist midstate rollntime'}
+        self.long_poll_url = ''
+        self.long_poll_active = False
+        self.stratum_header = ''
+
+        self.authorization_failed = False
+
+    def retry_timeout(self):
+        """How long to wait before asking for work again: RETRY_INTERVAL
+        while a miner still wants work a request failed to get, otherwise
+        until woken."""
+        if any(miner.update for miner in self.switch.pool_miners(self)):
+            return RETRY_INTERVAL
+        return None
+
+    def ensure_connected(self, connection, proto, host):
+        if connection is None or (connection.proto, connection.host) != (
+                proto, host):
+            connection = HTTPConnection(proto, host, self.options.proxy)
+        return connection, not connection.connected
+
+    async def request(self, connection, url, headers, data=None, timeout=0):
+        result = response = None
+        try:
+            if data:
+                response = await self.timeout_response(
+                    connection.request('POST', url, data, headers), timeout)
+            else:
+                response = await self.timeout_response(
+                    connection.request('GET', url, headers=headers), timeout)
+            if not response:
+                return None
+            if response.status == http.client.UNAUTHORIZED:
+                say_line('Wrong username or password for %s',
+                         self.server().name)
+                self.authorization_failed = True
+                raise NotAuthorized()
+            r = self.max_redirects
+            while response.status == http.client.TEMPORARY_REDIRECT:
+                response.read()
+                url = response.getheader('Location', '')
+                if r == 0 or url == '': raise http.client.HTTPException(
+                    'Too much or bad redirects')
+                response = await self.timeout_response(
+                    connection.request('GET', url, headers=headers), timeout)
+                if not response:
+                    return None
+                r -= 1
+            self.response_headers(response)
+            result = loads(response.read())
+            if result['error']:
+                say_line('server error: %s', result['error']['message'])
+                raise RPCError(result['error']['message'])
+            return (connection, result)
+        finally:
+            if not result:
+                connection.close()
+
+    async def timeout_response(self, request, timeout):
+        """Awaits the response to request. A long poll with a timeout gives
+        up quietly after it, other requests fail after REQUEST_TIMEOUT."""
+        try:
+            return await asyncio.wait_for(request, timeout or REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            if timeout:
+                return None
+            raise
+
+    def response_headers(self, response):
+        """Takes what the source follows from the headers of response."""
+        self.stratum_header = response.getheader('x-stratum', '')
+
+    def stop(self):
+        self.should_stop = True
+        self.switch.wake()
+
+    def close_connection(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+        if self.submit_connection:
+            self.submit_connection.close()
+            self.submit_connection = None
+
+    def close_lp_connection(self):
+        if self.lp_connection:
+            self.lp_connection.close()
+            self.lp_connection = None
@@ -0,0 +1,121 @@
+import asyncio
+import ssl
+from http.client import HTTPException
+
+import socks
+
+
+class Response(object):
+    def __init__(self, version, status, headers, body):
+        self.version = version
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self):
+        return self.body
+
+
+class HTTPConnection(object):
+    """
+    A keep-alive HTTP/1.1 client connection on asyncio streams, connecting
+    on the first request after it was closed. Responses are read whole, so
+    that a connection is only ever used by one request at a time.
+    """
+
+    def __init__(self, proto, host, proxy=None):
+        self.proto = proto
+        self.host = host
+        self.proxy = proxy
+        self.reader = self.writer = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        address, _, port = self.host.partition(':')
+        port = int(port or (443 if self.proto == 'https' else 80))
+        context = ssl.create_default_context() if self.proto == 'https' \
+            else None
+        if not self.proxy:
+            self.reader, self.writer = await asyncio.open_connection(
+                address, port, ssl=context)
+            return
+        sock = socks.socksocket()
+        p = self.proxy
+        sock.setproxy(p.type, p.host, p.port, True, p.user, p.pwd)
+        await asyncio.get_running_loop().run_in_executor(
+            None, sock.connect, (address, port))
+        self.reader, self.writer = await asyncio.open_connection(
+            sock=sock, ssl=context, server_hostname=context and address)
+
+    async def request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        if not self.connected:
+            await self.connect()
+        lines = [f'{method} {url} HTTP/1.1', f'Host: {self.host}']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        if body is not None:
+            body = body.encode('utf-8') if isinstance(body, str) else body
+            lines += ['Content-Type: application/json',
+                      f'Content-Length: {len(body)}']
+        try:
+            self.writer.write(
+                ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+                + (body or b''))
+            await self.writer.drain()
+            return await self.read_response()
+        except BaseException:
+            self.close()
+            raise
+
+    async def read_response(self):
+        try:
+            status_line = await self.reader.readline()
+            if not status_line:
+                raise HTTPException('connection closed by server')
+            version, status = status_line.decode('latin-1').split()[:2]
+            status = int(status)
+            headers = {}
+            while True:
+                line = await self.reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                body = b''
+                while True:
+                    size = int((await self.reader.readline()).split(b';')[0],
+                               16)
+                    if not size:
+                        await self.reader.readline()
+                        break
+                    body += await self.reader.readexactly(size)
+                    await self.reader.readline()
+            elif 'content-length' in headers:
+                body = await self.reader.readexactly(
+                    int(headers['content-length']))
+            else:
+                body = await self.reader.read()
+                headers['connection'] = 'close'
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            raise HTTPException(f'bad response: {e}')
+
+        response = Response(10 if version == 'HTTP/1.0' else 11, status,
+                            headers, body)
+        connection = headers.get('connection', '').lower()
+        if connection == 'close' or (response.version == 10
+                                     and connection != 'keep-alive'):
+            self.close()
+        return response
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
@@ -1,172 +1,89 @@
+import asyncio
 import http.client
-import socket
-from base64 import b64encode
 from binascii import hexlify, unhexlify
-from json import dumps, loads
+from json import dumps
 from struct import pack
-from threading import Event, Thread
-from time import monotonic, sleep
 from urllib.parse import urlsplit
 
 import socks
 
 from apoclypsebm.bitcoin import tx_make_generation, tx_merkle_root, var_int
 from apoclypsebm.log import say_exception, say_line
-from apoclypsebm.util import chunks
-from apoclypsebm.work_sources.base import Source
+from apoclypsebm.shares import share_key
+from apoclypsebm.util import VERSION_ROLLING_MASK, chunks
+from apoclypsebm.work_sources.base import HTTPSource, NotAuthorized, RPCError
 
 gbt_count = 0
 
 
-class NotAuthorized(Exception):
-    pass
+class GetblocktemplateSource(HTTPSource):
+    def __init__(self, switch, server=None):
+        super().__init__(switch, server)
 
-
-class RPCError(Exception):
-    pass
-
-
-class GetblocktemplateSource(Source):
-    def __init__(self, switch):
-        super().__init__(switch)
-
-        self.connection = self.lp_connection = None
-        self.long_poll_timeout = 3600
-        self.max_redirects = 3
-
-        self.headers = {'User-Agent': self.switch.user_agent,
-                        'Authorization': 'Basic ' + b64encode(
-                            b'%b:%b' % (self.server().user_bytes, self.server().pwd_bytes)).decode('ascii'),
-                        'X-Mining-Extensions': 'hostlist midstate rollntime'}
-        self.long_poll_url = ''
-
-        self.long_poll_active = False
         self.long_poll_last_host = None
 
-        self.authorization_failed = False
+        # The latest template, and a counter added to the coinbase message so
+        # that every work unit made from it is different.
+        self.template = None
+        self.extranonce = 0
 
-    def loop(self):
+    async def loop(self):
         if self.authorization_failed:
             return
-        super().loop()
-        long_poll_id_available = Event()
-        thread = Thread(
-            target=self.long_poll_thread,
-            args=(long_poll_id_available,),
-            daemon=True
-        )
-        thread.start()
+        await super().loop()
+        long_poll_id_available = asyncio.Event()
+        long_poll = asyncio.ensure_future(
+            self.long_poll(long_poll_id_available))
 
-        while True:
-            if self.should_stop:
-                return
+        try:
+            while True:
+                if self.should_stop:
+                    return
 
-            if self.check_failback():
-                return True
+                if self.check_failback():
+                    return True
 
-            try:
-                with self.switch.lock:
-                    miner = self.switch.updatable_miner()
+                try:
+                    miner = self.switch.updatable_miner(self)
                     while miner:
-                        template = self.getblocktemplate()
-                        if template:
-                            work = self.work_from_template(template)
-                            self.queue_work(work, miner)
-                            miner = self.switch.updatable_miner()
-
-                            if 'longpollid' in template:
-                                self.long_poll_id = template['longpollid']
-                                self.long_poll_url = template.get('longpolluri', '')
-                                long_poll_id_available.set()
-                            self.switch.update_time = ('time' in template.get('mutable', ()))
-
-
-                self.process_result_queue()
-                sleep(1)
-            except Exception:
-                say_exception("Unexpected error:")
-                break
-
-    def ensure_connected(self, connection, proto, host):
-        if connection != None and connection.sock != None:
-            return connection, False
-
-        if proto == 'https':
-            connector = http.client.HTTPSConnection
-        else:
-            connector = http.client.HTTPConnection
-
-        if not self.options.proxy:
-            return connector(host), True
-
-        host, port = host.split(':')
-        connection = connector(host)
-        connection.sock = socks.socksocket()
-        p = self.options.proxy
-        connection.sock.setproxy(p.type, p.host, p.port, True, p.user, p.pwd)
-        try:
-            connection.sock.connect((host, int(port)))
-        except socks.Socks5AuthError:
-            say_exception('Proxy error:')
-            self.stop()
-        return connection, True
-
-    def request(self, connection, url, headers, data=None, timeout=0):
-        result = response = None
-        try:
-            if data:
-                connection.request('POST', url, data, headers)
-            else:
-                connection.request('GET', url, headers=headers)
-            response = self.timeout_response(connection, timeout)
-            if not response:
-                return None
-            if response.status == http.client.UNAUTHORIZED:
-                say_line('Wrong username or password for %s',
-                         self.server().name)
-                self.authorization_failed = True
-                raise NotAuthorized()
-            r = self.max_redirects
-            while response.status == http.client.TEMPORARY_REDIRECT:
-                response.read()
-                url = response.getheader('Location', '')
-                if r == 0 or url == '': raise http.client.HTTPException(
-                    'Too much or bad redirects')
-                connection.request('GET', url, headers=headers)
-                response = self.timeout_response(connection, timeout)
-                r -= 1
-            self.stratum_header = response.getheader('x-stratum', '')
-            result = loads(response.read())
-            if result['error']:
-                say_line('server error: %s', result['error']['message'])
-                raise RPCError(result['error']['message'])
-            return (connection, result)
+                        template = await self.getblocktemplate()
+                        if not template:
+                            miner.update = True
+                            break
+                        self.template = template
+                        work = self.work_from_template(template)
+                        self.queue_work(work, miner)
+                        miner = self.switch.updatable_miner(self)
+
+                        if 'longpollid' in template:
+                            self.long_poll_id = template['longpollid']
+                            self.long_poll_url = template.get('longpolluri', '')
+                            long_poll_id_available.set()
+                        self.switch.update_time = ('time' in template.get('mutable', ()))
+
+                    # Miners wanting work come before filling buffers.
+                    for miner in self.switch.prefetchable_miners(self):
+                        if self.should_stop or any(
+                                m.update for m in self.switch.pool_miners(self)):
+                            break
+                        template = self.template
+                        if not (template and self.rolls_coinbase(template)):
+                            template = await self.getblocktemplate()
+                            if not template:
+                                break
+                        self.queue_work(self.work_from_template(template),
+                                        miner, prefetch=True)
+
+                    await self.wait(self.retry_timeout())
+                except Exception:
+                    say_exception("Unexpected error:")
+                    break
         finally:
-            if not result or not response or (
-                    response.version == 10 and response.getheader('connection',
-                                                                  '') != 'keep-alive') or response.getheader(
-                    'connection', '') == 'close':
-                connection.close()
-                connection = None
-
-    def timeout_response(self, connection, timeout):
-        if timeout:
-            start = monotonic()
-            connection.sock.settimeout(timeout)
-            response = None
-            while not response:
-                if self.should_stop or monotonic() - start > timeout:
-                    return
-                try:
-                    response = connection.getresponse()
-                except socket.timeout:
-                    pass
-            connection.sock.settimeout(20)
-            return response
-        else:
-            return connection.getresponse()
+            long_poll.cancel()
+            self.close_lp_connection()
+            self.close_connection()
 
-    def getblocktemplate(self, long_poll_id=None, timeout=None):
+    async def getblocktemplate(self, long_poll_id=None, timeout=None):
         param = {
             'capabilities': ('longpoll', 'coinbasetxn',
                              'coinbasevalue', 'workid'),
@@ -210,8 +127,11 @@ class GetblocktemplateSource(Source):
                 'id': 'json',
                 'params': (param,)
             }
-            connection, result = self.request(connection, url, self.headers,
-                                              dumps(postdata), timeout=timeout or 0)
+            response = await self.request(connection, url, self.headers,
+                                          dumps(postdata), timeout=timeout or 0)
+            if not response:
+                return None
+            connection, result = response
             self.switch.connection_ok()
 
             return result['result']
@@ -228,10 +148,13 @@ class GetblocktemplateSource(Source):
         except Exception:
             say_exception()
 
-    def submitblock(self, block_data, work_id=None):
+    async def submitblock(self, block_data, work_id=None):
+        """Submits a block, giving the server's reject reason, None when it
+        accepts the block, or False when the block didn't reach it."""
         try:
-            self.connection = \
-                self.ensure_connected(self.connection, self.server().proto,
+            self.submit_connection = \
+                self.ensure_connected(self.submit_connection,
+                                      self.server().proto,
                                       self.server().host)[0]
             if work_id:
                 params = (block_data, {'workid': work_id})
@@ -244,9 +167,11 @@ class GetblocktemplateSource(Source):
                 'params': params
             }
 
-            (self.connection, result) = self.request(self.connection, '/',
-                                                     self.headers,
-                                                     dumps(postdata))
+            response = await self.request(
+                self.submit_connection, '/', self.headers, dumps(postdata))
+            if not response:
+                return False
+            (self.submit_connection, result) = response
 
             self.switch.connection_ok()
 
@@ -257,11 +182,13 @@ class GetblocktemplateSource(Source):
             self.stop()
         except Exception:
             say_exception()
+        return False
 
-    def proposeblock(self, block_data, work_id=None):
+    async def proposeblock(self, block_data, work_id=None):
         try:
-            self.connection = \
-                self.ensure_connected(self.connection, self.server().proto,
+            self.submit_connection = \
+                self.ensure_connected(self.submit_connection,
+                                      self.server().proto,
                                       self.server().host)[0]
             param = {
                 'mode': 'proposal',
@@ -278,9 +205,11 @@ class GetblocktemplateSource(Source):
             with open('last_submission.txt', 'w') as submission_file:
                 submission_file.write(dumps(postdata))
 
-            (self.connection, result) = self.request(self.connection, '/',
-                                                     self.headers,
-                                                     dumps(postdata))
+            response = await self.request(
+                self.submit_connection, '/', self.headers, dumps(postdata))
+            if not response:
+                return None
+            (self.submit_connection, result) = response
 
             self.switch.connection_ok()
 
@@ -314,30 +243,33 @@ class GetblocktemplateSource(Source):
         )
         return block_hex
 
-    def send_internal(self, result, nonce):
+    async def send_internal(self, result, nonce):
         data = self.block_hex_from_result(result, nonce)
 
         # If want to debug the blocks that would otherwise be submitted:
-        #reject_reason = self.proposeblock(data, result.job_id)
+        #reject_reason = await self.proposeblock(data, result.job_id)
 
-        reject_reason = self.submitblock(data, result.job_id)
+        reject_reason = await self.submitblock(data, result.job_id)
 
         if reject_reason is None:
-            self.switch.report(result.miner, nonce, reject_reason is None)
+            self.switch.report(
+                self.switch.shares.get(share_key(result, nonce)), True)
             return True
 
-    def long_poll_thread(self, long_poll_id_available):
-        long_poll_id_available.wait()
+    async def long_poll(self, long_poll_id_available):
+        await long_poll_id_available.wait()
         while True:
             if self.should_stop or self.authorization_failed:
                 return
 
             try:
                 self.long_poll_active = True
-                template = self.getblocktemplate(long_poll_id=self.long_poll_id,
-                                                 timeout=self.long_poll_timeout)
+                template = await self.getblocktemplate(
+                    long_poll_id=self.long_poll_id,
+                    timeout=self.long_poll_timeout)
                 self.long_poll_active = False
                 if template:
+                    self.template = template
                     work = self.work_from_template(template)
                     self.queue_work(work)
                     if self.options.verbose:
@@ -350,25 +282,10 @@ class GetblocktemplateSource(Source):
                     socks.ProxyError, NotAuthorized, RPCError):
                 say_exception('long poll IO error')
                 self.close_lp_connection()
-                sleep(.5)
+                await asyncio.sleep(.5)
             except Exception:
                 say_exception()
 
-    def stop(self):
-        self.should_stop = True
-        self.close_lp_connection()
-        self.close_connection()
-
-    def close_connection(self):
-        if self.connection:
-            self.connection.close()
-            self.connection = None
-
-    def close_lp_connection(self):
-        if self.lp_connection:
-            self.lp_connection.close()
-            self.lp_connection = None
-
     def workable_block_header(self, template):
         """Takes a block template and creates a block header from it that
         is pre-processed into the SHA-256 message format.
@@ -405,13 +322,22 @@ class GetblocktemplateSource(Source):
         ))
         return header_words, gen_tx
 
+    def rolls_coinbase(self, template):
+        """Whether work from template gets a coinbase of our own, which can
+        then be varied to make more work from it without asking again."""
+        return bool(self.options.address) and (
+            'coinbasetxn' not in template
+            or 'coinbase' in template.get('mutable', ('coinbase',)))
+
     def generation_tx_for_template(self, template):
         template_tx = template.get('coinbasetxn')
         # In segwit mode, we need another merkle root that has hashed witness
         # portions of txes:
         witness_commitment = unhexlify(template['default_witness_commitment'])
         # TODO: use the 'hash' attrs if this is missing
-        coinbase_msg = self.options.coinbase_msg.encode('utf-8')
+        self.extranonce = (self.extranonce + 1) & 0xFFFFFFFF
+        coinbase_msg = (self.options.coinbase_msg.encode('utf-8')
+                        + pack('<I', self.extranonce))
         if template_tx:
             if self.options.address:
                 if 'coinbase' in template.get('mutable', ('coinbase',)):
@@ -441,6 +367,8 @@ class GetblocktemplateSource(Source):
         if not template:
             return None
         workable_header, coinbase_tx = self.workable_block_header(template)
+        self.version_mask = (VERSION_ROLLING_MASK if 'version/force' in
+                             template.get('mutable', ()) else 0)
         #john
         target = template['target']
         target = ''.join([target[i]+target[i+1] for i in range(0,len(target),2)][::-1])
@@ -454,7 +382,7 @@ class GetblocktemplateSource(Source):
         work['transactions'] = [{'data': coinbase_tx.hex()}] + template['transactions']
         return work
 
-    def queue_work(self, work, miner=None):
+    def queue_work(self, work, miner=None, prefetch=False):
         if work:
             if not 'target' in work:
                 work['target'] = ('000000000000'
@@ -467,10 +395,11 @@ class GetblocktemplateSource(Source):
             self.switch.queue_work(self, block_header=work['data'],
                                    target=work['target'],
                                    job_id=work.get('job_id'),
-                                   miner=miner, transactions=work['transactions'])
+                                   miner=miner, transactions=work['transactions'],
+                                   prefetch=prefetch)
 
-    def detect_stratum(self):
-        template = self.getblocktemplate()
+    async def detect_stratum(self):
+        template = await self.getblocktemplate()
         if self.authorization_failed:
             return False
 
@@ -486,6 +415,7 @@ class GetblocktemplateSource(Source):
                 return host
             else:
                 say_line('using getblocktemplate JSON-RPC (no stratum header)')
+                self.template = template
                 work = self.work_from_template(template)
                 self.queue_work(work)
                 return False
@@ -1,167 +1,92 @@
-import http
-import socket
-from base64 import b64encode
-from binascii import hexlify
+import asyncio
+import http.client
 from json import dumps, loads
 from struct import pack
-from threading import Thread
-from time import monotonic, sleep
 from urllib.parse import urlsplit
 
 import socks
 
 from apoclypsebm.log import say_exception, say_line
-from apoclypsebm.work_sources.base import Source
+from apoclypsebm.shares import share_key
+from apoclypsebm.work_sources.base import HTTPSource, NotAuthorized, RPCError
 
 
-class NotAuthorized(Exception):
-    pass
-
-
-class RPCError(Exception):
-    pass
-
-
-class GetworkSource(Source):
-    def __init__(self, switch):
-        super(GetworkSource, self).__init__(switch)
-
-        self.connection = self.lp_connection = None
-        self.long_poll_timeout = 3600
-        self.max_redirects = 3
+class GetworkSource(HTTPSource):
+    def __init__(self, switch, server=None):
+        super(GetworkSource, self).__init__(switch, server)
 
         self.postdata = {'method': 'getwork', 'id': 'json'}
-        self.headers = {"User-Agent": self.switch.user_agent,
-                        "Authorization": 'Basic ' + b64encode(
-                            b'%b:%b' % (self.server().user_bytes, self.server().pwd_bytes)).decode('ascii'),
-                        "X-Mining-Extensions": 'hostlist midstate rollntime'}
-        self.long_poll_url = ''
+        self.long_poll_url_available = asyncio.Event()
 
-        self.long_poll_active = False
-
-        self.authorization_failed = False
-
-    def loop(self):
+    async def loop(self):
         if self.authorization_failed: return
-        super(GetworkSource, self).loop()
+        await super(GetworkSource, self).loop()
 
-        thread = Thread(target=self.long_poll_thread)
-        thread.daemon = True
-        thread.start()
-
-        while True:
-            if self.should_stop: return
+        long_poll = asyncio.ensure_future(self.long_poll())
+        try:
+            while True:
+                if self.should_stop: return
 
-            if self.check_failback():
-                return True
+                if self.check_failback():
+                    return True
 
-            try:
-                with self.switch.lock:
-                    miner = self.switch.updatable_miner()
+                try:
+                    miner = self.switch.updatable_miner(self)
                     while miner:
-                        work = self.getwork()
+                        work = await self.getwork()
+                        if not work:
+                            miner.update = True
+                            break
                         self.queue_work(work, miner)
-                        miner = self.switch.updatable_miner()
-
-                self.process_result_queue()
-                sleep(1)
-            except Exception:
-                say_exception("Unexpected error:")
-                break
-
-    def ensure_connected(self, connection, proto, host):
-        if connection != None and connection.sock != None:
-            return connection, False
-
-        if proto == 'https':
-            connector = http.client.HTTPSConnection
-        else:
-            connector = http.client.HTTPConnection
-
-        if not self.options.proxy:
-            return connector(host), True
-
-        host, port = host.split(':')
-        connection = connector(host)
-        connection.sock = socks.socksocket()
-        p = self.options.proxy
-        connection.sock.setproxy(p.type, p.host, p.port, True, p.user, p.pwd)
-        try:
-            connection.sock.connect((host, int(port)))
-        except socks.Socks5AuthError:
-            say_exception('Proxy error:')
-            self.stop()
-        return connection, True
+                        miner = self.switch.updatable_miner(self)
+
+                    # Miners wanting work come before filling buffers.
+                    for miner in self.switch.prefetchable_miners(self):
+                        if self.should_stop or any(
+                                m.update for m in self.switch.pool_miners(self)):
+                            break
+                        work = await self.getwork()
+                        if not work:
+                            break
+                        self.queue_work(work, miner, prefetch=True)
+
+                    await self.wait(self.retry_timeout())
+                except Exception:
+                    say_exception("Unexpected error:")
+                    break
+        finally:
+            long_poll.cancel()
+            self.close_lp_connection()
+            self.close_connection()
+
+    def response_headers(self, response):
+        super(GetworkSource, self).response_headers(response)
+        self.long_poll_url = response.getheader('X-Long-Polling', '')
+        if self.long_poll_url:
+            self.long_poll_url_available.set()
+        if not self.standby:
+            self.switch.update_time = bool(
+                response.getheader('X-Roll-NTime', ''))
+        hostList = response.getheader('X-Host-List', '')
+        if (not self.options.nsf) and hostList: self.switch.add_servers(
+            loads(hostList))
 
-    def request(self, connection, url, headers, data=None, timeout=0):
-        result = response = None
+    async def getwork(self, data=None):
         try:
             if data:
-                connection.request('POST', url, data, headers)
+                connection = self.submit_connection = self.ensure_connected(
+                    self.submit_connection, self.server().proto,
+                    self.server().host)[0]
             else:
-                connection.request('GET', url, headers=headers)
-            response = self.timeout_response(connection, timeout)
+                connection = self.connection = self.ensure_connected(
+                    self.connection, self.server().proto,
+                    self.server().host)[0]
+            self.postdata['params'] = [data] if data else []
+            response = await self.request(connection, '/', self.headers,
+                                          dumps(self.postdata))
             if not response:
                 return None
-            if response.status == http.client.UNAUTHORIZED:
-                say_line('Wrong username or password for %s',
-                         self.server().name)
-                self.authorization_failed = True
-                raise NotAuthorized()
-            r = self.max_redirects
-            while response.status == http.client.TEMPORARY_REDIRECT:
-                response.read()
-                url = response.getheader('Location', '')
-                if r == 0 or url == '': raise http.client.HTTPException(
-                    'Too much or bad redirects')
-                connection.request('GET', url, headers=headers)
-                response = self.timeout_response(connection, timeout)
-                r -= 1
-            self.long_poll_url = response.getheader('X-Long-Polling', '')
-            self.switch.update_time = bool(
-                response.getheader('X-Roll-NTime', ''))
-            hostList = response.getheader('X-Host-List', '')
-            self.stratum_header = response.getheader('x-stratum', '')
-            if (not self.options.nsf) and hostList: self.switch.add_servers(
-                loads(hostList))
-            result = loads(response.read())
-            if result['error']:
-                say_line('server error: %s', result['error']['message'])
-                raise RPCError(result['error']['message'])
-            return (connection, result)
-        finally:
-            if not result or not response or (
-                    response.version == 10 and response.getheader('connection',
-                                                                  '') != 'keep-alive') or response.getheader(
-                    'connection', '') == 'close':
-                connection.close()
-                connection = None
-
-    def timeout_response(self, connection, timeout):
-        if timeout:
-            start = monotonic()
-            connection.sock.settimeout(5)
-            response = None
-            while not response:
-                if self.should_stop or monotonic() - start > timeout: return
-                try:
-                    response = connection.getresponse()
-                except socket.timeout:
-                    pass
-            connection.sock.settimeout(timeout)
-            return response
-        else:
-            return connection.getresponse()
-
-    def getwork(self, data=None):
-        try:
-            self.connection = \
-            self.ensure_connected(self.connection, self.server().proto,
-                                  self.server().host)[0]
-            self.postdata['params'] = [data] if data else []
-            (self.connection, result) = self.request(self.connection, '/',
-                                                     self.headers,
-                                                     dumps(self.postdata))
+            result = response[1]
 
             self.switch.connection_ok()
 
@@ -172,18 +97,20 @@ class GetworkSource(Source):
         except Exception:
             say_exception()
 
-    def send_internal(self, result, nonce):
-        data = ''.join([hexlify(result.header),
-                        hexlify(pack('<3I', int(result.time), int(result.difficulty),
-                             int(nonce))),
+    async def send_internal(self, result, nonce):
+        data = ''.join([result.header.hex(),
+                        pack('<3I', int(result.time), int(result.difficulty),
+                             int(nonce)).hex(),
                         '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'])
-        accepted = self.getwork(data)
+        accepted = await self.getwork(data)
         if accepted is not None:
-            self.switch.report(result.miner, nonce, accepted)
+            self.switch.report(
+                self.switch.shares.get(share_key(result, nonce)), accepted)
             return True
 
-    def long_poll_thread(self):
+    async def long_poll(self):
         last_host = None
+        await self.long_poll_url_available.wait()
         while True:
             if self.should_stop or self.authorization_failed:
                 return
@@ -208,9 +135,9 @@ class GetworkSource(Source):
                         last_host = host
 
                     self.long_poll_active = True
-                    response = self.request(self.lp_connection, url,
-                                            self.headers,
-                                            timeout=self.long_poll_timeout)
+                    response = await self.request(
+                        self.lp_connection, url, self.headers,
+                        timeout=self.long_poll_timeout)
                     self.long_poll_active = False
                     if response:
                         (self.lp_connection, result) = response
@@ -224,36 +151,21 @@ class GetworkSource(Source):
                 NotAuthorized, RPCError):
                     say_exception('long poll IO error')
                     self.close_lp_connection()
-                    sleep(.5)
+                    await asyncio.sleep(.5)
                 except Exception:
                     say_exception()
 
-    def stop(self):
-        self.should_stop = True
-        self.close_lp_connection()
-        self.close_connection()
-
-    def close_connection(self):
-        if self.connection:
-            self.connection.close()
-            self.connection = None
-
-    def close_lp_connection(self):
-        if self.lp_connection:
-            self.lp_connection.close()
-            self.lp_connection = None
-
-    def queue_work(self, work, miner=None):
+    def queue_work(self, work, miner=None, prefetch=False):
         if work:
             if not 'target' in work:
                 work[
                     'target'] = '0000000000000000000000000000000000000000000000000000ffff00000000'
 
             self.switch.queue_work(self, work['data'], work['target'],
-                                   miner=miner)
+                                   miner=miner, prefetch=prefetch)
 
-    def detect_stratum(self):
-        work = self.getwork()
+    async def detect_stratum(self):
+        work = await self.getwork()
         if self.authorization_failed:
             return False
 
@@ -1,17 +1,16 @@
-import asynchat
-import asyncore
+import asyncio
 import socket
 from binascii import hexlify, unhexlify
 from hashlib import sha256
 from json import dumps, loads
 from struct import pack
-from threading import Lock, Thread, Timer
-from time import sleep, time, monotonic
+from time import time, monotonic
 
 import socks
 
 from apoclypsebm.log import say_exception, say_line
-from apoclypsebm.util import Object, chunks
+from apoclypsebm.shares import share_key
+from apoclypsebm.util import VERSION_ROLLING_MASK, Object, chunks
 from apoclypsebm.work_sources.base import Source
 
 # import ssl
@@ -19,6 +18,14 @@ from apoclypsebm.work_sources.base import Source
 
 BASE_DIFFICULTY = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 MIN_DIFFICULTY = 0x00000000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+# Seconds without a message from the server after which the connection is
+# taken for dead and made again. Servers notify new jobs far more often.
+SILENCE_TIMEOUT = 180
+# Seconds to wait for a connection, short so that failing over to a backup on
+# standby isn't held up by a server that doesn't answer.
+CONNECT_TIMEOUT = 5
+# Jobs kept for results to be submitted on, the oldest dropped first.
+MAX_JOBS = 64
 
 
 def detect_stratum_proxy(host):
@@ -56,87 +63,162 @@ def detect_stratum_proxy(host):
 
 
 class StratumSource(Source):
-    def __init__(self, switch):
-        super(StratumSource, self).__init__(switch)
-        self.handler = None
-        self.socket = None
-        self.channel_map = {}
+    keeps_jobs = True
+
+    def __init__(self, switch, server=None):
+        super(StratumSource, self).__init__(switch, server)
+        self.reader = self.writer = None
+        self.reader_task = None
+        self.last_message = monotonic()
+        # When each request awaiting an answer was sent, and the block of the
+        # latest notify, to time the server by.
+        self.requests = {}
+        self.notified_block = None
+        # Set whenever the server answers a request.
+        self.answered = asyncio.Event()
         self.subscribed = False
         self.authorized = None
-        self.submits = {}
-        self.last_submits_cleanup = monotonic()
         self.server_difficulty = BASE_DIFFICULTY
         self.jobs = {}
         self.current_job = None
         self.extranonce = ''
         self.extranonce2_size = 4
-        self.send_lock = Lock()
+        self.configured = False
 
-    def loop(self):
-        super(StratumSource, self).loop()
+    async def loop(self):
+        await super(StratumSource, self).loop()
 
-        self.switch.update_time = True
-
-        while True:
-            if self.should_stop: return
-
-            if self.current_job:
-                miner = self.switch.updatable_miner()
-                while miner:
-                    self.current_job = self.refresh_job(self.current_job)
-                    self.queue_work(self.current_job, miner)
-                    miner = self.switch.updatable_miner()
+        if not self.standby:
+            self.switch.update_time = True
 
-            if self.check_failback():
-                return True
-
-            if not self.handler:
-                try:
-                    # socket = ssl.wrap_socket(socket)
-                    address, port = self.server().host.split(':', 1)
-
-                    if not self.options.proxy:
-                        self.socket = socket.socket(socket.AF_INET,
-                                                    socket.SOCK_STREAM)
-                        self.socket.connect((address, int(port)))
-                    else:
-                        self.socket = socks.socksocket()
-                        p = self.options.proxy
-                        self.socket.setproxy(p.type, p.host, p.port, True,
-                                             p.user, p.pwd)
-                        try:
-                            self.socket.connect((address, int(port)))
-                        except socks.Socks5AuthError:
-                            say_exception('Proxy error:')
+        try:
+            while True:
+                if self.should_stop: return
+
+                if self.current_job:
+                    miners = self.switch.updatable_miners(self)
+                    if miners:
+                        self.queue_work_many(
+                            self.roll_work(self.current_job,
+                                           self.switch.work_units(miners)),
+                            miners)
+                    miners = self.switch.prefetchable_miners(self)
+                    if miners:
+                        self.queue_work_many(
+                            self.roll_work(self.current_job, len(miners)),
+                            miners, prefetch=True)
+
+                if self.check_failback():
+                    return True
+
+                if self.writer and \
+                        monotonic() - self.last_message > SILENCE_TIMEOUT:
+                    say_line('%s silent for %d seconds, reconnecting',
+                             (self.server().name, SILENCE_TIMEOUT))
+                    self.close()
+
+                if not self.writer:
+                    try:
+                        await self.connect()
+
+                        await self.configure()
+                        if not await self.subscribe():
+                            say_line('Failed to subscribe')
                             self.stop()
+                        elif not await self.authorize():
+                            self.stop()
+                        else:
+                            self.ready.set()
 
-                    self.handler = Handler(self.socket, self.channel_map, self)
-                    thread = Thread(target=self.asyncore_thread)
-                    thread.daemon = True
-                    thread.start()
-
-                    if not self.subscribe():
-                        say_line('Failed to subscribe')
+                    except (socket.error, socks.ProxyError):
+                        say_exception()
                         self.stop()
-                    elif not self.authorize():
-                        self.stop()
-
-                except socket.error:
-                    say_exception()
-                    self.stop()
-                    continue
+                        continue
 
-            with self.send_lock:
-                self.process_result_queue()
-            sleep(1)
+                await self.wait(
+                    self.last_message + SILENCE_TIMEOUT - monotonic() + 0.01
+                    if self.writer else None)
+        finally:
+            self.close()
 
-    def asyncore_thread(self):
-        asyncore.loop(map=self.channel_map)
+    async def connect(self):
+        # socket = ssl.wrap_socket(socket)
+        address, port = self.server().host.split(':', 1)
+        self.subscribed = False
+        self.authorized = None
+        self.ready.clear()
+        self.last_message = monotonic()
+        self.requests.clear()
+        self.notified_block = None
+
+        start = monotonic()
+        if not self.options.proxy:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(address, int(port)), CONNECT_TIMEOUT)
+        else:
+            sock = socks.socksocket()
+            p = self.options.proxy
+            sock.setproxy(p.type, p.host, p.port, True, p.user, p.pwd)
+            await asyncio.get_running_loop().run_in_executor(
+                None, sock.connect, (address, int(port)))
+            self.reader, self.writer = await asyncio.open_connection(
+                sock=sock)
+        self.switch.endpoint_latency(self.server()).add(
+            'connect', (monotonic() - start) * 1000)
+        self.reader_task = asyncio.ensure_future(
+            self.read_messages(self.reader))
+
+    async def read_messages(self, reader):
+        """Handles the messages of the server until it disconnects, then
+        wakes the source loop to reconnect."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.last_message = monotonic()
+                self.handle_message(loads(line))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            say_exception()
+        self.close()
+        self.switch.wake()
+
+    def close(self):
+        if self.reader_task and \
+                self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+        self.reader_task = None
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+        self.ready.clear()
 
     def stop(self):
         self.should_stop = True
-        if self.handler:
-            self.handler.close()
+        self.switch.wake()
+
+    def job_alive(self, job_id):
+        return job_id in self.jobs
+
+    def healthy(self):
+        return (self.ready.is_set() and self.current_job is not None
+                and self.current_job.job_id in self.jobs
+                and monotonic() - self.last_message < SILENCE_TIMEOUT)
+
+    def promote(self):
+        """Takes the source off standby, giving the miners its current job
+        right away."""
+        if not self.current_job:
+            return super(StratumSource, self).promote()
+        self.standby = False
+        self.switch.update_time = True
+        miners = self.switch.pool_miners(self)
+        self.queue_work_many(
+            self.roll_work(self.current_job,
+                           max(self.switch.work_units(miners), 1)),
+            miners, clean=True)
 
     def refresh_job(self, j):
         j.extranonce2 = self.increment_nonce(j.extranonce2)
@@ -156,6 +238,16 @@ class StratumSource(Source):
         j.time = time()
         return j
 
+    def roll_work(self, j, count):
+        """Refreshes j count times, returning the work unit for each
+        extranonce2 as a (block_header, job_id, extranonce2) tuple.
+        """
+        works = []
+        for i in range(count):
+            j = self.refresh_job(j)
+            works.append((j.block_header, j.job_id, j.extranonce2))
+        return works
+
     def increment_nonce(self, nonce):
         next_nonce = int(nonce, 16) + 1
         if len('%x' % next_nonce) > (self.extranonce2_size * 2):
@@ -194,26 +286,44 @@ class StratumSource(Source):
                 if clear_jobs:
                     self.jobs.clear()
                 j.extranonce2 = self.extranonce2_size * '00'
-
-                j = self.refresh_job(j)
-
+                # The first notify after connecting is the job at the time,
+                # not a new block.
+                if self.notified_block not in (None, j.prevhash):
+                    self.switch.block_notified(self.server(), j.prevhash)
+                self.notified_block = j.prevhash
                 self.jobs[j.job_id] = j
+                while len(self.jobs) > MAX_JOBS:
+                    del self.jobs[next(iter(self.jobs))]
                 self.current_job = j
 
-                self.queue_work(j)
-                self.switch.connection_ok()
+                # On standby the job is only kept for promote().
+                if not self.standby:
+                    # Every miner gets its own extranonce2 at once, so their
+                    # midstates are computed in a single batch.
+                    works = self.roll_work(
+                        j, max(self.switch.work_units(
+                            self.switch.pool_miners(self)), 1))
+
+                    self.queue_work_many(works, clean=clear_jobs)
+                    self.switch.connection_ok()
 
             # mining.get_version
             if message['method'] == 'mining.get_version':
-                with self.send_lock:
-                    self.send_message({"error": None, "id": message['id'],
-                                       "result": self.user_agent})
+                self.send_message({"error": None, "id": message['id'],
+                                   "result": self.user_agent})
 
             # mining.set_difficulty
             elif message['method'] == 'mining.set_difficulty':
                 say_line("Setting new difficulty: %s", message['params'][0])
                 self.server_difficulty = min(MIN_DIFFICULTY, int(BASE_DIFFICULTY //
                                              message['params'][0]))
+                self.switch.update_target(self, self.target())
+
+            # mining.set_version_mask
+            elif message['method'] == 'mining.set_version_mask':
+                self.version_mask = (int(message['params'][0], 16)
+                                     & VERSION_ROLLING_MASK)
+                say_line('Setting new version mask: %08x', self.version_mask)
 
             # client.reconnect
             elif message['method'] == 'client.reconnect':
@@ -226,7 +336,7 @@ class StratumSource(Source):
                 say_line("%s asked us to reconnect to %s:%d in %d seconds",
                          (self.server().name, address, port, timeout))
                 self.server().host = address + ':' + str(port)
-                Timer(timeout, self.reconnect).start()
+                asyncio.get_running_loop().call_later(timeout, self.reconnect)
 
             # client.add_peers
             elif message['method'] == 'client.add_peers':
@@ -236,27 +346,36 @@ class StratumSource(Source):
 
         # responses to server API requests
         elif 'result' in message:
+            self.answered.set()
+            sent = self.requests.pop(message['id'], None)
+            if sent is not None:
+                self.switch.endpoint_latency(self.server()).add(
+                    'rtt', (monotonic() - sent) * 1000)
+
+            # response to mining.configure
+            # store the version rolling mask, if any
+            if message['id'] == 'c':
+                result = message['result'] or {}
+                if result.get('version-rolling'):
+                    self.version_mask = (
+                        int(result.get('version-rolling.mask', '0'), 16)
+                        & VERSION_ROLLING_MASK
+                    )
+                    say_line('Version rolling with mask %08x',
+                             self.version_mask)
+                self.configured = True
 
             # response to mining.subscribe
             # store extranonce and extranonce2_size
-            if message['id'] == 's':
+            elif message['id'] == 's':
                 self.extranonce = message['result'][1]
                 self.extranonce2_size = message['result'][2]
                 self.subscribed = True
 
-            # check if this is submit confirmation (message id should be in submits dictionary)
-            # cleanup if necessary
-            elif message['id'] in self.submits:
-                miner, nonce = self.submits[message['id']][:2]
-                accepted = message['result']
-                self.switch.report(miner, nonce, accepted)
-                del self.submits[message['id']]
-                if monotonic() - self.last_submits_cleanup > 3600:
-                    now = monotonic()
-                    for key, value in self.submits.items():
-                        if now - value[2] > 3600:
-                            del self.submits[key]
-                    self.last_submits_cleanup = now
+            # response to mining.submit, for a share the switch tracks
+            elif self.switch.shares.by_id(message['id']):
+                self.switch.report(self.switch.shares.by_id(message['id']),
+                                   message['result'])
 
             # response to mining.authorize
             elif message['id'] == self.server().user:
@@ -270,28 +389,59 @@ class StratumSource(Source):
     def reconnect(self):
         say_line("%s reconnecting to %s",
                  (self.server().name, self.server().host))
-        self.handler.close()
+        self.close()
+        self.switch.wake()
+
+    async def answer(self, answered, timeout):
+        """Waits up to timeout seconds for answered() to hold, checking
+        whenever the server answers a request."""
+        deadline = monotonic() + timeout
+        while not answered():
+            remaining = deadline - monotonic()
+            if remaining <= 0 or not self.writer:
+                break
+            self.answered.clear()
+            try:
+                await asyncio.wait_for(self.answered.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return answered()
+
+    async def configure(self):
+        """Negotiates version rolling (BIP 310) unless disabled. Servers that
+        don't know mining.configure may not answer, so this doesn't wait
+        long."""
+        self.version_mask = 0
+        if self.options.version_rolls <= 1:
+            return
+        self.configured = False
+        self.send_message(
+            {'id': 'c', 'method': 'mining.configure',
+             'params': [['version-rolling'], {
+                 'version-rolling.mask': '%08x' % VERSION_ROLLING_MASK,
+                 'version-rolling.min-bit-count': 2}]})
+        await self.answer(lambda: self.configured, 2)
 
-    def subscribe(self):
+    async def subscribe(self):
         self.send_message(
             {'id': 's', 'method': 'mining.subscribe', 'params': []})
-        for i in range(10):
-            sleep(1)
-            if self.subscribed: break
-        return self.subscribed
+        return await self.answer(lambda: self.subscribed, 10)
 
-    def authorize(self):
+    async def authorize(self):
         self.send_message(
             {'id': self.server().user, 'method': 'mining.authorize',
              'params': [self.server().user, self.server().pwd]})
-        for i in range(10):
-            sleep(1)
-            if self.authorized != None: break
+        await self.answer(lambda: self.authorized is not None, 10)
         return self.authorized
 
-    def send_internal(self, result, nonce):
+    async def send_internal(self, result, nonce):
         job_id = result.job_id
         if not job_id in self.jobs:
+            # The job ended after the share was checked, it's stale.
+            self.switch.shares.discard(
+                self.switch.shares.get(share_key(result, nonce)))
+            result.miner.stale_count += 1
+            self.switch.pool_stat(self.server()).stale_count += 1
             return True
         extranonce2 = result.extranonce2
         #john
@@ -301,10 +451,12 @@ class StratumSource(Source):
         hex_nonce = hexlify(pack('<I', int(nonce))) 
         hex_nonce = pack('<I', int(nonce))  #john
         hex_nonce = ''.join(['%02x' % b for b in hex_nonce]) 
-        id_ = job_id + hex_nonce
-        self.submits[id_] = (result.miner, nonce, time())
-        return self.send_message({'params': [self.server().user, job_id,
-                                             extranonce2, ntime, hex_nonce],
+        id_ = self.switch.shares.get(share_key(result, nonce)).id
+        params = [self.server().user, job_id, extranonce2, ntime, hex_nonce]
+        version = getattr(result, 'version', None)
+        if self.version_mask and version is not None:
+            params.append('%08x' % (version & self.version_mask))
+        return self.send_message({'params': params,
                                   'id': id_, 'method': u'mining.submit'})
 
     def send_message(self, message):
@@ -312,50 +464,26 @@ class StratumSource(Source):
         print(data)
         data = data.encode('utf-8')
         try:
-            # self.handler.push(data)
-
-            # there is some bug with asyncore's send mechanism
-            # so we send data 'manually'
-            # note that this is not thread safe
-            if not self.handler:
+            if not self.writer:
                 return False
-            while data:
-                sent = self.handler.send(data)
-                data = data[sent:]
+            self.writer.write(data)
+            if 'method' in message:
+                self.requests[message['id']] = monotonic()
             return True
-        except AttributeError:
-            self.stop()
         except Exception:
             say_exception()
             self.stop()
 
-    def queue_work(self, work, miner=None):
-        target = ''.join(
+    def target(self):
+        return ''.join(
             list(chunks('%064x' % self.server_difficulty, 2))[::-1])
-        self.switch.queue_work(self, work.block_header, target, work.job_id,
-                               work.extranonce2, miner)
-
 
-class Handler(asynchat.async_chat):
-    def __init__(self, socket, map_, parent):
-        asynchat.async_chat.__init__(self, socket, map_)
-        self.parent = parent
-        self.data = b''
-        self.set_terminator(b'\n')
-
-    def handle_close(self):
-        self.close()
-        self.parent.handler = None
-        self.parent.socket = None
-
-    #def handle_error(self):
-    #    say_exception()
-    #    self.parent.stop()
+    def queue_work(self, work, miner=None):
+        self.switch.queue_work(self, work.block_header, self.target(),
+                               work.job_id, work.extranonce2, miner)
 
-    def collect_incoming_data(self, data):
-        self.data += data
+    def queue_work_many(self, works, miners=None, clean=False,
+                        prefetch=False):
+        self.switch.queue_work_many(self, works, self.target(), miners,
+                                    clean=clean, prefetch=prefetch)
 
-    def found_terminator(self):
-        message = loads(self.data)
-        self.parent.handle_message(message)
-        self.data = b''
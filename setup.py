@@ -18,7 +18,8 @@ args = {
     'author': 'Justin T. Arthur',
     'author_email': 'justinarthur@gmail.com',
     'url': 'https://github.com/JustinTArthur/apoclypsebm/',
-    'install_requires': ["pyopencl>=2017.2,<=2020.1", 'pyserial>=2.6', 'PySocks>=1.6.0'],
+    'install_requires': ["pyopencl>=2022.1.3", 'pyserial>=2.6', 'PySocks>=1.6.0'],
+    'extras_require': {'numpy': ('numpy>=1.16',)},
     'entry_points': {
         'console_scripts': (
             'apoclypse = apoclypsebm.command:main',
@@ -26,7 +27,7 @@ args = {
     },
     'packages': find_packages(include=('apoclypsebm', 'apoclypsebm.*',)),
     'package_data': {'apoclypsebm': ('apoclypse-0.cl', 'apoclypse-loopy.cl')},
-    'python_requires': '>=3.6',
+    'python_requires': '>=3.10',
     'classifiers': ('License :: Public Domain',)
 }
 
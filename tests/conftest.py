@@ -0,0 +1,92 @@
+import asyncio
+from collections import deque
+from queue import Queue
+from types import SimpleNamespace
+
+from apoclypsebm.command import parse_options
+from apoclypsebm.switch import Switch
+from apoclypsebm.util import CountingLock
+
+# The genesis block header with each word byte swapped, as sources give it,
+# and one on top of another block.
+HEADER = (
+    '00000001' + '00' * 32 +
+    '4a5e1e4bbaab8f8a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+    '495fab291d00ffff7c2bac1d'
+)
+NEXT_HEADER = '00000001' + '11' * 32 + HEADER[72:]
+# The difficulty 1 share target.
+TARGET = '00' * 28 + 'ffff0000'
+# Stratum servers tagged a, b and c.
+SERVERS = ['stratum://u:p@a:1#a', 'stratum://u:p@b:1#b', 'stratum://u:p@c:1#c']
+
+
+def make_options(servers=(), **options):
+    """The options of a command line giving servers, with the defaults of
+    the rest but those given."""
+    parsed = parse_options(list(servers))
+    for name, value in options.items():
+        setattr(parsed, name, value)
+    return parsed
+
+
+def make_switch(servers=(), miners=(), **options):
+    switch = Switch(make_options(servers, **options), 'utf-8')
+    for miner in miners:
+        switch.add_miner(miner)
+    return switch
+
+
+class FakeMiner(object):
+    def __init__(self, rate=100, shardable=True, update=True):
+        self.rate = rate
+        self.shardable = shardable
+        self.update = update
+        self.pool = None
+        self.work_queue = Queue()
+        self.work_buffer = deque()
+        self.work_lock = CountingLock()
+        self.share_count = [0, 0]
+        self.stale_count = 0
+
+    def id(self):
+        return 'fake'
+
+    def nonce_generator(self, nonces):
+        return nonces
+
+    def queued(self):
+        work = []
+        while not self.work_queue.empty():
+            work.append(self.work_queue.get(False))
+        return work
+
+
+class FakeSource(object):
+    """A running source of server, giving work for 'job' only."""
+    keeps_jobs = True
+
+    def __init__(self, server=None):
+        self.pool = server or SimpleNamespace(name='pool')
+        self.pool.source = self
+        self.jobs = {'job'}
+        self.last_block = ''
+        self.standby = False
+        self.version_mask = 0
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.wakeup = asyncio.Event()
+        self.is_healthy = True
+        self.stopped = False
+
+    def server(self):
+        return self.pool
+
+    def job_alive(self, job_id):
+        return job_id in self.jobs
+
+    def healthy(self):
+        return self.is_healthy
+
+    def stop(self):
+        self.stopped = True
@@ -0,0 +1,65 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from apoclypsebm.mining import autotune
+
+cl = pytest.importorskip('pyopencl')
+opencl = pytest.importorskip('apoclypsebm.mining.opencl')
+
+
+def make_options(profile_file, **kwargs):
+    options = SimpleNamespace(
+        platform=0, device=[0], kernel='apoclypse-0', worksize='64',
+        frames='60,30', frame_sleep='', vectors='0', old_vectors=False,
+        queue_depth='', timings=False, cutoff_temp=[95],
+        cutoff_interval=[0.01], throttle_band=[5], hwmon=[], power=[],
+        profile_file=str(profile_file), version='test', verbose=False,
+        efficiency=False, efficiency_window=30,
+        cache_dir=str(profile_file.parent / 'cache'), cache_size=256,
+        cache_age=30,
+    )
+    options.__dict__.update(kwargs)
+    return options
+
+
+def test_candidate_worksizes():
+    assert autotune.candidate_worksizes(256) == [32, 64, 128, 256]
+    assert autotune.candidate_worksizes(200) == [32, 64, 128, 200]
+    assert autotune.candidate_worksizes(16) == [16]
+
+
+def test_load_profiles_tolerates_missing_and_invalid(tmp_path):
+    assert autotune.load_profiles(str(tmp_path / 'missing.json')) == {}
+    invalid = tmp_path / 'invalid.json'
+    invalid.write_text('{')
+    assert autotune.load_profiles(str(invalid)) == {}
+
+
+def test_autotune_saves_profile_applied_by_initialize(tmp_path):
+    if not opencl.OPENCL:
+        pytest.skip('No OpenCL platform (try installing pocl)')
+    profile_file = tmp_path / 'profiles.json'
+
+    profiles = autotune.autotune(make_options(profile_file), seconds=0.3)
+
+    device = cl.get_platforms()[0].get_devices()[0]
+    profile = profiles[autotune.profile_key(device)]
+    assert profile['kernel'] == 'apoclypse-0'
+    assert profile['worksize'] == 64
+    assert profile['vectors'] is False
+    assert profile['frames'] in (60, 30)
+    assert profile['rate'] > 0
+    assert json.loads(profile_file.read_text()) == profiles
+
+    profile_file.write_text(json.dumps({autotune.profile_key(device): dict(
+        profile, kernel='apoclypse-loopy', frames=15)}))
+    miner, = opencl.initialize(make_options(
+        profile_file, kernel=None, worksize='', frames='', vectors=''))
+    assert (miner.kernel_name, miner.worksize, miner.vectors,
+            miner.frames) == ('apoclypse-loopy', 64, False, 15)
+
+    miner, = opencl.initialize(make_options(
+        profile_file, kernel=None, frames='', vectors='', worksize='32'))
+    assert (miner.kernel_name, miner.worksize) == ('apoclypse-loopy', 32)
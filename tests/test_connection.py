@@ -0,0 +1,171 @@
+import asyncio
+import threading
+from http.client import HTTPException
+from types import SimpleNamespace
+
+import pytest
+
+from apoclypsebm.work_sources import base
+from apoclypsebm.work_sources.base import Source
+from apoclypsebm.work_sources.connection import HTTPConnection
+from apoclypsebm.work_sources.getblocktemplate import GetblocktemplateSource
+from apoclypsebm.work_sources import getwork
+from apoclypsebm.work_sources.getwork import GetworkSource
+from conftest import FakeMiner, make_switch
+
+
+async def serve(responses):
+    """Starts an HTTP server answering each request on a connection with the
+    next of responses, returning it, its port and the requests it got."""
+    requests = []
+
+    async def handle(reader, writer):
+        for response in responses:
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = [int(line.split(b':')[1]) for line in head.split(b'\r\n')
+                      if line.lower().startswith(b'content-length')]
+            body = await reader.readexactly(length[0]) if length else b''
+            requests.append((head.split(b'\r\n')[0], body))
+            writer.write(response)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], requests
+
+
+def test_keep_alive_and_chunked():
+    async def run():
+        server, port, requests = await serve([
+            b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+            b'X-Long-Polling: /lp\r\n\r\n{}',
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'3\r\n{"a\r\n5\r\n": 1}\r\n0\r\n\r\n',
+            b'HTTP/1.0 200 OK\r\n\r\nbye',
+        ])
+        connection = HTTPConnection('http', '127.0.0.1:%d' % port)
+        response = await connection.request('POST', '/', '{"id": 1}')
+        assert response.status == 200 and response.read() == b'{}'
+        assert response.getheader('X-Long-Polling') == '/lp'
+        assert connection.connected
+
+        response = await connection.request('GET', '/lp')
+        assert response.read() == b'{"a": 1}'
+
+        response = await connection.request('GET', '/')
+        assert response.version == 10 and response.read() == b'bye'
+        assert not connection.connected
+        assert requests == [(b'POST / HTTP/1.1', b'{"id": 1}'),
+                            (b'GET /lp HTTP/1.1', b''),
+                            (b'GET / HTTP/1.1', b'')]
+
+        # The server is gone, so is the connection.
+        server.close()
+        with pytest.raises((HTTPException, OSError)):
+            await connection.request('GET', '/')
+        assert not connection.connected
+
+    asyncio.run(run())
+
+
+def test_miner_threads_wake_the_switch():
+    switch = make_switch()
+    server = SimpleNamespace(result_queue=asyncio.Queue())
+    result = SimpleNamespace(server=server)
+
+    async def run():
+        switch.event_loop = asyncio.get_running_loop()
+        switch.server_index = 0
+        switch.servers = [SimpleNamespace()]
+        sources = [Source(switch), Source(switch)]
+        switch.sources.extend(sources)
+        threading.Thread(target=switch.wake).start()
+        for source in sources:
+            await asyncio.wait_for(source.wait(), 5)
+            assert not source.wakeup.is_set()
+
+        # Results go straight to the source's submission queue.
+        threading.Thread(target=switch.put, args=(result,)).start()
+        assert await asyncio.wait_for(server.result_queue.get(), 5) is result
+        assert result.found > 0
+
+    # Results found before the loop starts or after it closes are dropped.
+    switch.put(result)
+    asyncio.run(run())
+    switch.put(result)
+    assert server.result_queue.empty()
+
+
+def test_results_are_submitted_when_ready():
+    sent = []
+
+    async def send(result, send_callback):
+        sent.append(result)
+        return result != 'fail'
+
+    switch = SimpleNamespace(options=None, send=send, server=lambda: None)
+
+    async def run():
+        source = Source(switch)
+        source.send_internal = None
+        source.stop = lambda: setattr(source, 'should_stop', True)
+        submitter = asyncio.ensure_future(source.submit_results())
+        source.result_queue.put_nowait('share')
+        await asyncio.sleep(0.01)
+        assert sent == []
+
+        source.ready.set()
+        await asyncio.sleep(0.01)
+        assert sent == ['share']
+
+        # A result that can't be sent stays queued and stops the source.
+        source.result_queue.put_nowait('fail')
+        await asyncio.wait_for(submitter, 5)
+        assert source.should_stop
+        assert source.result_queue.get_nowait() == 'fail'
+
+    asyncio.run(run())
+
+
+def test_requests_without_a_response(monkeypatch):
+    switch = make_switch(['getwork+http://u:p@a:1#a', 'http://u:p@b:1#b'])
+    a, b = switch.servers
+
+    async def request(self, *args, **kwargs):
+        return None
+
+    errors = []
+    monkeypatch.setattr(GetworkSource, 'request', request)
+    monkeypatch.setattr(GetblocktemplateSource, 'request', request)
+    monkeypatch.setattr(getwork, 'say_exception', lambda: errors.append(1))
+    source = GetworkSource(switch, a)
+    assert asyncio.run(source.getwork()) is None
+    assert errors == []
+
+    # A block that didn't reach the server isn't taken as accepted.
+    gbt = GetblocktemplateSource(switch, b)
+    assert asyncio.run(gbt.submitblock('00')) is False
+
+
+@pytest.mark.parametrize('source_class, fetch', [
+    (GetworkSource, 'getwork'),
+    (GetblocktemplateSource, 'getblocktemplate'),
+])
+def test_failed_work_requests_are_retried(monkeypatch, source_class, fetch):
+    miner = FakeMiner()
+    switch = make_switch(['http://u:p@a:1#a'], [miner])
+    switch.server_index = 0
+    source = source_class(switch, switch.servers[0])
+    calls = []
+
+    async def fail(*args, **kwargs):
+        calls.append(miner.update)
+        source.should_stop = len(calls) > 1
+        return None
+
+    monkeypatch.setattr(source, fetch, fail)
+    monkeypatch.setattr(base, 'RETRY_INTERVAL', 0.01)
+    asyncio.run(asyncio.wait_for(source.loop(), 5))
+
+    # The miner still wants work, and is asked for it again.
+    assert calls == [False, False] and miner.update
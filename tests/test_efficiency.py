@@ -0,0 +1,51 @@
+from apoclypsebm.mining.efficiency import DUTIES, FRAMES, EfficiencyOptimizer
+
+
+def run(optimizer, efficiency, windows):
+    """Feeds the optimizer windows of launches at the hashes per joule
+    efficiency(frames, duty) gives and returns the points it measured."""
+    now = 0
+    points = []
+    optimizer.completed(now, 0, 100)
+    for i in range(windows):
+        points.append((optimizer.frames, optimizer.duty))
+        hashes = efficiency(optimizer.frames, optimizer.duty) * 100
+        while not optimizer.completed(now + 1, hashes, 100):
+            now += 1
+        now += 1
+    return points
+
+
+def test_climbs_to_most_efficient_point():
+    optimizer = EfficiencyOptimizer(30, window=10)
+    assert (optimizer.frames, optimizer.duty) == (30, 1.0)
+
+    def efficiency(frames, duty):
+        return 1000 / (1 + 0.1 * abs(FRAMES.index(frames) - 1)
+                       + 0.1 * abs(DUTIES.index(duty) - 4))
+
+    points = run(optimizer, efficiency, 40)
+    # Having found it, it keeps probing the neighbours of the best point.
+    assert points[-10:].count((10, 0.8)) >= 5
+    assert set(points[-10:]) <= {(10, 0.8), (5, 0.8), (15, 0.8), (10, 0.85),
+                                 (10, 0.7)}
+
+
+def test_follows_drift():
+    optimizer = EfficiencyOptimizer(30, window=10)
+    def best_at(best):
+        return lambda frames, duty: 1000 / (
+            1 + 0.1 * abs(DUTIES.index(duty) - DUTIES.index(best)))
+
+    run(optimizer, best_at(0.5), 40)
+    assert optimizer.duty in (0.5, 0.6)
+    run(optimizer, best_at(0.9), 40)
+    assert optimizer.duty in (0.85, 0.9, 0.95)
+
+
+def test_needs_power():
+    optimizer = EfficiencyOptimizer(30, window=1)
+    for now in range(10):
+        assert not optimizer.completed(now, 100, None)
+    assert optimizer.score is None
+    assert optimizer.stats() == {'eff frames': 30, 'eff duty %': 100}
@@ -0,0 +1,42 @@
+from apoclypsebm.mining.intensity import IntensityController
+
+UNIT = 64 * 256
+
+
+def run(controller, throughput, launches):
+    sizes = []
+    for i in range(launches):
+        size = controller.size
+        sizes.append(controller.measured(size, size / throughput(i)))
+    return sizes
+
+
+def test_settles_on_target_latency():
+    controller = IntensityController(1 / 30, UNIT, UNIT * 10)
+    sizes = run(controller, lambda i: 50e6, 40)
+    assert abs(sizes[-1] / 50e6 - 1 / 30) < 0.05 / 30
+    # Converged without oscillating by more than the launch granularity.
+    assert max(sizes[-10:]) - min(sizes[-10:]) <= UNIT
+    assert abs(controller.stats()['launch ms'] - 1000 / 30) < 1
+
+
+def test_steps_are_limited():
+    controller = IntensityController(1 / 30, UNIT, UNIT)
+    sizes = run(controller, lambda i: 1e9, 5)
+    for before, after in zip([UNIT] + sizes, sizes):
+        assert after <= before * 2
+
+
+def test_tracks_throughput_drop():
+    # A device throttling to half its clock at launch 30.
+    controller = IntensityController(1 / 30, UNIT, UNIT * 10)
+    sizes = run(controller, lambda i: 50e6 if i < 30 else 25e6, 80)
+    assert abs(sizes[-1] / 25e6 - 1 / 30) < 0.05 / 30
+    assert max(size / 25e6 for size in sizes[30:]) < 2.5 / 30
+
+
+def test_sizes_are_whole_units_within_limit():
+    controller = IntensityController(1, UNIT, limit=UNIT * 3 + 5)
+    sizes = run(controller, lambda i: 1e12, 10)
+    assert all(size % UNIT == 0 for size in sizes)
+    assert sizes[-1] == UNIT * 3
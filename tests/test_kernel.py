@@ -3,11 +3,13 @@ import pkgutil
 from binascii import unhexlify
 from struct import unpack
 
-import pyopencl as cl
+import pytest
 
-from apoclypsebm.sha256 import partial, calculateF, sha256, STATE
+from apoclypsebm.sha256 import STATE, hash, precompute, sha256
 from apoclypsebm.util import uint32, uint32_as_bytes
 
+cl = pytest.importorskip('pyopencl')
+
 DEFAULT_FRAMES = 30
 
 
@@ -56,7 +58,7 @@ def try_kernel(platform_idx, device_idx):
 
     print(f'worksize: {worksize},  unit: {unit},  global_threads: {global_threads}')
 
-    kernel.set_arg(20, cl_out_buffer)
+    kernel.set_arg(25, cl_out_buffer)
 
     base = 0
 
@@ -87,36 +89,15 @@ def try_kernel(platform_idx, device_idx):
 
 
     state = list(midstate)
-    f = [0] * 8
-    state2 = partial(state, merkle_end, time, difficulty, f)
-    print(f'state2 and f: {state2}, {f}')
-    calculateF(state, merkle_end, time, difficulty, f, state2)
-    print(f'state and f after fcalc: {state}, {f}')
-    kernel.set_arg(0, uint32_as_bytes(state[0]))
-    kernel.set_arg(1, uint32_as_bytes(state[1]))
-    kernel.set_arg(2, uint32_as_bytes(state[2]))
-    kernel.set_arg(3, uint32_as_bytes(state[3]))
-    kernel.set_arg(4, uint32_as_bytes(state[4]))
-    kernel.set_arg(5, uint32_as_bytes(state[5]))
-    kernel.set_arg(6, uint32_as_bytes(state[6]))
-    kernel.set_arg(7, uint32_as_bytes(state[7]))
-
-    kernel.set_arg(8, uint32_as_bytes(state2[1]))
-    kernel.set_arg(9, uint32_as_bytes(state2[2]))
-    kernel.set_arg(10, uint32_as_bytes(state2[3]))
-    kernel.set_arg(11, uint32_as_bytes(state2[5]))
-    kernel.set_arg(12, uint32_as_bytes(state2[6]))
-    kernel.set_arg(13, uint32_as_bytes(state2[7]))
-
-    kernel.set_arg(15, uint32_as_bytes(f[0]))
-    kernel.set_arg(16, uint32_as_bytes(f[1]))
-    kernel.set_arg(17, uint32_as_bytes(f[2]))
-    kernel.set_arg(18, uint32_as_bytes(f[3]))
-    kernel.set_arg(19, uint32_as_bytes(f[4]))
+    args = precompute(state, merkle_end, time, difficulty)
+    print(f'precomputed kernel args: {args}')
+    for i, value in enumerate(args):
+        kernel.set_arg(i, uint32_as_bytes(value))
 
     # This part usually done after temperature check:
     print(f'Starting with base {base}')
-    kernel.set_arg(14, uint32_as_bytes(base)[::-1])
+    kernel.set_arg(23, uint32_as_bytes(0xFFFFFFFF))
+    kernel.set_arg(24, uint32_as_bytes(base)[::-1])
     cmd_queue = cl.CommandQueue(context)
     cl.enqueue_copy(cmd_queue, cl_out_buffer, host_out_buffer)
     cl.enqueue_nd_range_kernel(cmd_queue, kernel,
@@ -133,6 +114,137 @@ def try_kernel(platform_idx, device_idx):
     base = uint32(base + global_threads)
 
 
+# The genesis block header, serialized.
+GENESIS = unhexlify(
+    '01000000' + '00' * 32 +
+    '3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a'
+    '29ab5f49ffff001d1dac2b7c'
+)
+WORKABLE = b''.join(GENESIS[i:i + 4][::-1] for i in range(0, 80, 4))
+MIDSTATE = sha256(STATE, list(unpack('<16I', WORKABLE[:64])) + [0] * 48)
+MERKLE_END, TIME, BITS, NONCE = unpack('<4I', WORKABLE[64:80])
+TEST_WORKSIZE = 64
+
+
+def opencl_device():
+    try:
+        platforms = cl.get_platforms()
+    except cl.Error:
+        platforms = ()
+    for platform in platforms:
+        devices = platform.get_devices()
+        if devices:
+            return devices[0]
+    pytest.skip('No OpenCL device (try installing pocl)')
+
+
+def run_search(kernel_name, vectors, base, global_threads, output_size=256,
+               time=TIME, target=0xFFFFFFFF, midstates=None, count=None):
+    """Runs the search kernel on the genesis job, or in MIDSTATES mode one row
+    for each of midstates, returning the (nonce, row) pairs found. Only the
+    first count threads search, all of them by default."""
+    device = opencl_device()
+    context = cl.Context([device])
+    queue = cl.CommandQueue(context)
+    defines = (
+        f'-D OUTPUT_SIZE={output_size} -D WORK_GROUP_SIZE={TEST_WORKSIZE}'
+    )
+    if vectors:
+        defines += ' -D VECTORS'
+    if midstates:
+        defines += ' -D MIDSTATES'
+    kernel_code = pkgutil.get_data('apoclypsebm', f'{kernel_name}.cl')
+    kernel = cl.Program(context, kernel_code.decode('ascii')).build(defines).search
+
+    if midstates:
+        jobs = b''.join(
+            uint32_as_bytes(value) for state in midstates
+            for value in precompute(state, MERKLE_END, time, BITS)
+        )
+        cl_jobs = cl.Buffer(
+            context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=jobs
+        )
+        kernel.set_arg(0, cl_jobs)
+        arg = 1
+    else:
+        for i, value in enumerate(precompute(MIDSTATE, MERKLE_END, time, BITS)):
+            kernel.set_arg(i, uint32_as_bytes(value))
+        arg = 23
+    kernel.set_arg(arg, uint32_as_bytes(target))
+    kernel.set_arg(arg + 1, uint32_as_bytes(base))
+    kernel.set_arg(arg + 2, uint32_as_bytes(
+        global_threads if count is None else count))
+    host_output = bytearray((output_size * 2 + 1) * 4)
+    cl_output = cl.Buffer(context, cl.mem_flags.WRITE_ONLY,
+                          size=len(host_output))
+    cl.enqueue_copy(queue, cl_output, host_output)
+    kernel.set_arg(arg + 3, cl_output)
+
+    rows = len(midstates) if midstates else 1
+    cl.enqueue_nd_range_kernel(queue, kernel, (global_threads, rows),
+                               (TEST_WORKSIZE, 1))
+    cl.enqueue_copy(queue, host_output, cl_output)
+    queue.finish()
+    count, *found = unpack(f'<{output_size * 2 + 1}I', host_output)
+    return list(zip(found[:count * 2:2], found[1:count * 2:2]))
+
+
+@pytest.mark.parametrize('vectors', [False, True])
+@pytest.mark.parametrize('kernel_name', ['apoclypse-0', 'apoclypse-loopy'])
+def test_search_finds_genesis_nonce(kernel_name, vectors):
+    base = (NONCE - 1000) >> 1 if vectors else NONCE - 1000
+    found = run_search(kernel_name, vectors, base, TEST_WORKSIZE * 64)
+    assert found == [(NONCE, 0)]
+    assert hash(MIDSTATE, MERKLE_END, TIME, BITS, NONCE)[7] == 0
+
+
+@pytest.mark.parametrize('vectors', [False, True])
+@pytest.mark.parametrize('kernel_name', ['apoclypse-0', 'apoclypse-loopy'])
+def test_search_filters_by_share_target(kernel_name, vectors):
+    # The genesis hash has H[6] 0x68d61900, 0x0019d668 byte swapped.
+    base = (NONCE - 1000) >> 1 if vectors else NONCE - 1000
+    assert run_search(kernel_name, vectors, base, TEST_WORKSIZE * 64,
+                      target=0x0019d668) == [(NONCE, 0)]
+    assert run_search(kernel_name, vectors, base, TEST_WORKSIZE * 64,
+                      target=0x0019d667) == []
+
+
+@pytest.mark.parametrize('vectors', [False, True])
+@pytest.mark.parametrize('kernel_name', ['apoclypse-0', 'apoclypse-loopy'])
+def test_search_sweeps_midstates(kernel_name, vectors):
+    # The genesis block with other versions doesn't hash below the target.
+    other = [
+        sha256(STATE, [version] + list(unpack('<15I', WORKABLE[4:64])) +
+               [0] * 48)
+        for version in (2, 0x20000000)
+    ]
+    base = (NONCE - 1000) >> 1 if vectors else NONCE - 1000
+    assert run_search(kernel_name, vectors, base, TEST_WORKSIZE * 64,
+                      midstates=[other[0], MIDSTATE, other[1]]) == [(NONCE, 1)]
+
+
+@pytest.mark.parametrize('vectors', [False, True])
+@pytest.mark.parametrize('kernel_name', ['apoclypse-0', 'apoclypse-loopy'])
+def test_search_stops_at_count(kernel_name, vectors):
+    # The genesis nonce is searched by thread 1000, which a launch padded to
+    # whole work groups only runs up to count.
+    base = (NONCE - 1000) >> 1 if vectors else NONCE - 1000
+    threads = 1000 >> 1 if vectors else 1000
+    assert run_search(kernel_name, vectors, base, TEST_WORKSIZE * 64,
+                      count=threads + 1) == [(NONCE, 0)]
+    assert run_search(kernel_name, vectors, base, TEST_WORKSIZE * 64,
+                      count=threads) == []
+
+
+@pytest.mark.parametrize('kernel_name', ['apoclypse-0', 'apoclypse-loopy'])
+def test_search_rejects_other_time(kernel_name):
+    # Changing any nonce-independent input invalidates the genesis nonce.
+    base = NONCE - 1000
+    assert run_search(kernel_name, False, base, TEST_WORKSIZE * 64,
+                      time=TIME + 1) == []
+
+
 if __name__ == '__main__':
     # os.environ['PYOPENCL_']
     try_kernel(0, 2)
@@ -0,0 +1,119 @@
+import json
+import os
+from time import time
+
+import pytest
+
+from apoclypsebm.mining.kernel_cache import MANIFEST, KernelCache
+
+
+def test_put_and_get(tmp_path):
+    cache = KernelCache(str(tmp_path / 'kernels'))
+    assert cache.get('a') is None
+    cache.put('a', b'binary')
+    assert cache.get('a') == b'binary'
+    manifest = json.loads((tmp_path / 'kernels' / MANIFEST).read_text())
+    assert manifest['a']['size'] == 6
+    assert not [name for name in os.listdir(tmp_path / 'kernels')
+                if name.startswith('.tmp-')]
+
+
+def test_evicts_least_recently_used_beyond_size(tmp_path):
+    cache = KernelCache(str(tmp_path), max_size=2.5 / 1024)
+    cache.put('a', b'x' * 1024)
+    cache.put('b', b'x' * 1024)
+    # Using a makes b the least recently used.
+    cache.get('a')
+    cache.put('c', b'x' * 1024)
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+
+
+def test_evicts_expired_and_unlisted(tmp_path):
+    cache = KernelCache(str(tmp_path), max_age=1)
+    cache.put('old', b'old')
+    manifest = cache.read_manifest()
+    manifest['old']['used'] = time() - 2 * 24 * 60 * 60
+    cache.write_manifest(manifest)
+    # Stored by another process whose manifest update was lost.
+    (tmp_path / 'stale.bin').write_bytes(b'stale')
+    os.utime(tmp_path / 'stale.bin', (0, 0))
+
+    cache.put('new', b'new')
+    assert sorted(cache.read_manifest()) == ['new']
+    assert sorted(os.listdir(tmp_path)) == [MANIFEST, 'new.bin']
+
+
+def test_load_kernel_uses_cache(tmp_path):
+    cl = pytest.importorskip('pyopencl')
+    opencl = pytest.importorskip('apoclypsebm.mining.opencl')
+    if not opencl.OPENCL:
+        pytest.skip('No OpenCL platform (try installing pocl)')
+    from types import SimpleNamespace
+    options = SimpleNamespace(
+        platform=0, device=[0], kernel='apoclypse-0', worksize='64',
+        vectors='0', old_vectors=False, verbose=False,
+        cache_dir=str(tmp_path), cache_size=256, cache_age=30,
+    )
+
+    opencl.prebuild(options)
+    assert len(KernelCache(str(tmp_path)).read_manifest()) == 1
+
+    miner = opencl.OpenCLMiner(0, options)
+    miner.worksize = 64
+    miner.build()
+    assert miner.cache_hit
+    assert isinstance(miner.kernel, cl.Kernel)
+
+
+def test_midstates_kernel_only_for_several_midstates(tmp_path):
+    opencl = pytest.importorskip('apoclypsebm.mining.opencl')
+    if not opencl.OPENCL:
+        pytest.skip('No OpenCL platform (try installing pocl)')
+    from types import SimpleNamespace
+    options = SimpleNamespace(
+        platform=0, device=[0], kernel='apoclypse-0', worksize='64',
+        vectors='0', old_vectors=False, verbose=False, version_rolls=4,
+        cache_dir=str(tmp_path), cache_size=256, cache_age=30,
+    )
+
+    opencl.prebuild(options)
+    assert len(KernelCache(str(tmp_path)).read_manifest()) == 2
+
+    miner = opencl.OpenCLMiner(0, options)
+    miner.worksize = 64
+    miner.build()
+    plain = miner.kernel
+    miner.use_kernel(4)
+    assert miner.midstates and miner.cache_hit and miner.kernel is not plain
+    miner.use_kernel(1)
+    assert not miner.midstates and miner.kernel is plain
+
+
+def test_scalar_ntime_rolls_swap_kernels(tmp_path):
+    opencl = pytest.importorskip('apoclypsebm.mining.opencl')
+    if not opencl.OPENCL:
+        pytest.skip('No OpenCL platform (try installing pocl)')
+    from types import SimpleNamespace
+    options = SimpleNamespace(
+        platform=0, device=[0], kernel='apoclypse-0', worksize='64',
+        vectors='0', old_vectors=False, verbose=False,
+        cache_dir=str(tmp_path), cache_size=256, cache_age=30,
+    )
+    work = SimpleNamespace(states=[(0,) * 8], merkle_end=0, time=0,
+                           difficulty=0)
+
+    miner = opencl.OpenCLMiner(0, options)
+    miner.worksize = 64
+    miner.build()
+    miner.use_kernel(1)
+    active, standby = miner.kernel, miner.standby_kernel
+    jobs = miner.job_args(work, 1)
+    miner.set_standby_args(jobs)
+    assert miner.kernel is active
+
+    # Rolling ntime swaps in the kernel readied for it.
+    miner.swap_standby(jobs)
+    assert miner.kernel is standby and miner.standby_kernel is active
+    miner.use_kernel(1)
+    assert miner.kernel is standby
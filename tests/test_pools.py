@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+from apoclypsebm.util import apportion
+from conftest import (HEADER, SERVERS, TARGET, FakeMiner, FakeSource,
+                      make_switch)
+
+
+def simulate(rates, weights, rounds=100, period=10):
+    done = [0] * len(weights)
+    current = None
+    for i in range(rounds):
+        current = apportion(rates, weights, done, period, current)
+        for rate, pool in zip(rates, current):
+            done[pool] += rate * period
+    return [hashes / sum(done) for hashes in done]
+
+
+def test_apportion_converges_to_weights():
+    # A single device alternates to give each pool its share over time.
+    shares = simulate([100], [3, 1])
+    assert abs(shares[0] - 0.75) < 0.02
+
+    shares = simulate([400, 100, 100, 0], [2, 1, 1])
+    assert all(abs(share - want) < 0.02
+               for share, want in zip(shares, [0.5, 0.25, 0.25]))
+
+    # A pool weighed 0 gets nothing, the others split its devices.
+    assert apportion([100, 100], [0, 1], [0, 0], 10) == [1, 1]
+
+
+def test_devices_stay_with_their_pool_while_it_is_due():
+    assert apportion([100, 100], [1, 1], [0, 0], 10, [1, 0]) == [1, 0]
+    # Far ahead of its due, a pool loses its devices.
+    assert apportion([100, 100], [1, 1], [0, 1e6], 10, [1, 0]) == [0, 0]
+
+
+def test_balance_moves_miners_between_pools():
+    miners = [FakeMiner(100, update=False), FakeMiner(100, update=False)]
+    switch = make_switch(SERVERS, miners, weights={'a': 1, 'b': 1, 'x': 1})
+    a, b, c = switch.servers
+    assert switch.pools == [a, b] and 'x' not in switch.weights
+
+    # Pools not mining yet don't get devices.
+    assert not switch.balance()
+    assert [miner.pool for miner in miners] == [None, None]
+
+    switch.sources = [FakeSource(a), FakeSource(b)]
+    assert switch.balance()
+    assert {miners[0].pool, miners[1].pool} == {a, b}
+    assert all(miner.update and miner.work_queue.get(False) is None
+               for miner in miners)
+
+    # Sources only give work to their pool's miners.
+    for miner in miners:
+        miner.update = False
+    source = a.source
+    switch.queue_work_many(source, [(HEADER, 'job', '00'),
+                                    (HEADER, 'job', '01')], TARGET)
+    (on_a,) = [miner for miner in miners if miner.pool is a]
+    (on_b,) = [miner for miner in miners if miner.pool is b]
+    assert on_a.work_queue.get(False).extranonce2 == '00'
+    assert on_b.work_queue.empty()
+
+    # Weighing a pool 0 moves its devices at once.
+    switch.event_loop = SimpleNamespace(
+        call_soon_threadsafe=lambda callback: callback())
+    switch.set_weights({'a': 0, 'b': 1})
+    assert [miner.pool for miner in miners] == [b, b]
+    assert on_a.update and on_a.work_queue.get(False) is None
+    assert not on_b.update
+    assert all(source.wakeup.is_set() for source in switch.sources)
+
+    # Work for a pool without devices isn't decoded.
+    def decode_many(*args):
+        raise AssertionError('work decoded for no miner')
+
+    switch.decode_many = decode_many
+    switch.queue_work_many(source, [(HEADER, 'job', '02')], TARGET)
@@ -0,0 +1,121 @@
+from threading import Event, Thread, Timer
+
+from apoclypsebm.mining.base import Miner
+from apoclypsebm.util import CountingLock
+from conftest import HEADER, NEXT_HEADER, TARGET, FakeSource, make_switch
+
+EASY_TARGET = '00' * 28 + 'ffffff00'
+
+
+def make_miners(count, prefetch=2):
+    switch = make_switch(prefetch=prefetch)
+    miners = [Miner(i, switch.options) for i in range(count)]
+    for miner in miners:
+        switch.add_miner(miner)
+    return switch, miners
+
+
+def units(count, header=HEADER):
+    return [(header, 'job', '%02x' % i) for i in range(count)]
+
+
+def test_buffers_fill_and_feed_miners():
+    switch, miners = make_miners(2)
+    source = FakeSource()
+    # Miners waiting for work don't get work prefetched.
+    assert switch.prefetchable_miners(source) == []
+
+    switch.queue_work_many(source, units(2), TARGET)
+    wanting = switch.prefetchable_miners(source)
+    assert wanting == [miners[0], miners[0], miners[1], miners[1]]
+    switch.queue_work_many(source, units(4), TARGET, wanting, prefetch=True)
+    assert switch.prefetchable_miners(source) == []
+    assert [len(miner.work_queue.queue) for miner in miners] == [1, 1]
+
+    # Finishing its work, a miner starts on the next buffered unit at once.
+    miners[0].work_queue.get(False)
+    miners[0].want_work()
+    assert not miners[0].update
+    assert miners[0].work_queue.get(False).extranonce2 == '00'
+    assert switch.prefetchable_miners(source) == [miners[0]]
+
+    miners[0].work_buffer.clear()
+    miners[0].want_work()
+    assert miners[0].update and miners[0].work_queue.empty()
+
+    # Difficulty changes apply to queued and buffered work too.
+    switch.update_target(source, EASY_TARGET)
+    work = list(miners[1].work_queue.queue) + list(miners[1].work_buffer)
+    assert all((w.target, w.targetQ) == switch.decode_target(EASY_TARGET)
+               for w in work)
+
+
+def test_new_block_evicts_buffers():
+    switch, miners = make_miners(2, prefetch=1)
+    source = FakeSource()
+    switch.queue_work_many(source, units(2), TARGET)
+    switch.queue_work_many(source, units(2), TARGET,
+                           switch.prefetchable_miners(source), prefetch=True)
+    assert all(miner.work_buffer for miner in miners)
+
+    # A unit prefetched for a new block is put to work right away.
+    switch.queue_work(source, NEXT_HEADER, TARGET, 'next', miner=miners[0],
+                      prefetch=True)
+    assert not any(miner.work_buffer for miner in miners)
+    assert [work and work.job_id for work in miners[0].work_queue.queue] == [
+        'next']
+    assert list(miners[1].work_queue.queue) == [None]
+    assert miners[1].update
+
+
+def test_work_lock_counts_contention():
+    lock = CountingLock()
+    assert lock.stats('lock') == {}
+    with lock:
+        pass
+    held, release = Event(), Event()
+
+    def hold():
+        with lock:
+            held.set()
+            release.wait(5)
+
+    thread = Thread(target=hold)
+    thread.start()
+    held.wait(5)
+    Timer(0.05, release.set).start()
+    with lock:
+        pass
+    thread.join()
+    assert (lock.acquired, lock.contended) == (3, 1)
+    assert lock.stats('lock')['lock'].startswith('1/3 contended')
+
+
+def test_buffers_change_while_miners_take_work():
+    switch, miners = make_miners(1, prefetch=4)
+    miner = miners[0]
+    source = FakeSource()
+    switch.queue_work_many(source, units(1), TARGET)
+    done = Event()
+    errors = []
+
+    def mine():
+        try:
+            while not done.is_set():
+                miner.want_work()
+                while not miner.work_queue.empty():
+                    miner.work_queue.get(False)
+        except Exception as e:
+            errors.append(e)
+
+    thread = Thread(target=mine)
+    thread.start()
+    for i in range(200):
+        switch.queue_work_many(source, units(4), TARGET, [miner] * 4,
+                               prefetch=True)
+        switch.update_target(source, EASY_TARGET if i % 2 else TARGET)
+        switch.flush_work(source)
+    done.set()
+    thread.join()
+    assert not errors
+    assert miner.work_lock.acquired > 400
@@ -0,0 +1,73 @@
+import os
+from types import SimpleNamespace
+
+from apoclypsebm.mining.sensors import (SensorSampler, duty_cycle, find_hwmon,
+                                        hwmon_power, hwmon_sensor, pause)
+
+
+def fake_hwmon(root, name, pci_address, millidegrees):
+    """Lays out a hwmon device like /sys/class/hwmon, whose entries link to
+    the PCI device they belong to."""
+    device = root / 'devices' / pci_address
+    device.mkdir(parents=True)
+    hwmon = root / 'hwmon' / name
+    hwmon.mkdir(parents=True)
+    os.symlink(device, hwmon / 'device')
+    (hwmon / 'temp1_input').write_text('%d\n' % millidegrees)
+    return hwmon
+
+
+def test_duty_cycle():
+    assert duty_cycle(None, 95) == 1
+    assert duty_cycle(80, 95) == 1
+    assert duty_cycle(90, 95) == 1
+    assert duty_cycle(92, 95) == 0.6
+    assert duty_cycle(95, 95) == 0
+    assert duty_cycle(100, 95) == 0
+    assert duty_cycle(94, 95, band=0) == 1
+    assert duty_cycle(95, 95, band=0) == 0
+    assert pause(1, 1) == 0
+    assert pause(1, 0.25) == 3
+
+
+def test_find_hwmon(tmp_path):
+    fake_hwmon(tmp_path, 'hwmon0', '0000:00:1f.3', 40000)
+    fake_hwmon(tmp_path, 'hwmon1', '0000:03:00.0', 71500)
+    hwmon = find_hwmon('0000:03:00.0', str(tmp_path / 'hwmon'))
+    assert hwmon == str(tmp_path / 'hwmon' / 'hwmon1')
+    assert hwmon_sensor(hwmon)() == 71.5
+    assert find_hwmon('0000:04:00.0', str(tmp_path / 'hwmon')) is None
+    assert find_hwmon('0000:03:00.0', str(tmp_path / 'missing')) is None
+
+
+def test_hwmon_sensor_paths(tmp_path):
+    hwmon = fake_hwmon(tmp_path, 'hwmon0', '0000:03:00.0', 65000)
+    (hwmon / 'temp2_input').write_text('90000\n')
+    assert hwmon_sensor(str(hwmon))() == 65
+    assert hwmon_sensor(str(hwmon / 'temp2_input'))() == 90
+    assert hwmon_sensor(str(tmp_path / 'devices')) is None
+    assert hwmon_sensor(str(hwmon / 'temp3_input')) is None
+
+    assert hwmon_power(str(hwmon)) is None
+    (hwmon / 'power1_input').write_text('150000000\n')
+    assert hwmon_power(str(hwmon))() == 150
+    (hwmon / 'power1_average').write_text('142500000\n')
+    assert hwmon_power(str(hwmon))() == 142.5
+    assert hwmon_power(str(hwmon / 'power1_input'))() == 150
+
+
+def test_sampler_caches_readings(tmp_path):
+    hwmon = fake_hwmon(tmp_path, 'hwmon0', '0000:03:00.0', 93000)
+    miner = SimpleNamespace(sensor=hwmon_sensor(str(hwmon)), temperature=None,
+                            power_sensor=lambda: 120.0, power=None,
+                            id=lambda: 'test')
+    sampler = SensorSampler()
+    sampler.add(miner)
+    sampler.sample()
+    assert miner.temperature == 93
+    assert miner.power == 120
+
+    (hwmon / 'temp1_input').unlink()
+    sampler.sample()
+    assert miner.temperature is None
+    assert miner.power == 120
@@ -0,0 +1,64 @@
+import random
+from binascii import unhexlify
+from struct import unpack
+
+import pytest
+
+from apoclypsebm import sha256
+from apoclypsebm.sha256 import STATE, hash, hash_many
+
+# The genesis block header, serialized.
+GENESIS = unhexlify(
+    '01000000' + '00' * 32 +
+    '3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a'
+    '29ab5f49ffff001d1dac2b7c'
+)
+# Same header pre-processed into SHA-256 message words.
+WORKABLE = b''.join(GENESIS[i:i + 4][::-1] for i in range(0, 80, 4))
+MIDSTATE = sha256.sha256(STATE, list(unpack('<16I', WORKABLE[:64])) + [0] * 48)
+MERKLE_END, TIME, BITS, NONCE = unpack('<4I', WORKABLE[64:80])
+
+
+def test_hash_genesis():
+    h = hash(MIDSTATE, MERKLE_END, TIME, BITS, NONCE)
+    assert h[7] == 0
+    assert h[6] == 0x68d61900
+
+
+@pytest.mark.parametrize('batch_size', [1, 5, 16, 300])
+@pytest.mark.parametrize('numpy', [True, False])
+def test_hash_many_matches_hash(monkeypatch, batch_size, numpy):
+    if numpy and not sha256.NUMPY:
+        pytest.skip('NumPy not installed')
+    monkeypatch.setattr(sha256, 'NUMPY', numpy)
+    rng = random.Random(batch_size)
+    nonces = [rng.getrandbits(32) for _ in range(batch_size - 1)] + [NONCE]
+    times = [rng.getrandbits(32) for _ in range(batch_size)]
+
+    expected = [hash(MIDSTATE, MERKLE_END, TIME, BITS, n) for n in nonces]
+    assert hash_many(MIDSTATE, MERKLE_END, TIME, BITS, nonces) == expected
+
+    expected = [hash(MIDSTATE, MERKLE_END, t, BITS, n)
+                for t, n in zip(times, nonces)]
+    assert hash_many(MIDSTATE, MERKLE_END, times, BITS, nonces) == expected
+
+
+def test_hash_many_empty():
+    assert hash_many(MIDSTATE, MERKLE_END, TIME, BITS, []) == []
+
+
+@pytest.mark.parametrize('batch_size', [1, 40])
+@pytest.mark.parametrize('numpy', [True, False])
+def test_midstate_many_matches_sha256(monkeypatch, batch_size, numpy):
+    if numpy and not sha256.NUMPY:
+        pytest.skip('NumPy not installed')
+    monkeypatch.setattr(sha256, 'NUMPY', numpy)
+    rng = random.Random(batch_size)
+    blocks = [[rng.getrandbits(32) for _ in range(16)]
+              for _ in range(batch_size - 1)]
+    blocks.append(unpack('<16I', WORKABLE[:64]))
+
+    expected = [sha256.sha256(STATE, list(block) + [0] * 48)
+                for block in blocks]
+    assert sha256.midstate_many(blocks) == expected
+    assert expected[-1] == MIDSTATE
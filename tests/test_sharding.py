@@ -0,0 +1,64 @@
+from apoclypsebm.util import SHARD_ALIGN, nonce_ranges
+from conftest import HEADER, TARGET, FakeMiner, FakeSource, make_switch
+
+
+def assert_partition(ranges, space=1 << 32):
+    assert ranges[0][0] == 0 and ranges[-1][1] == space
+    for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+        assert end == next_start
+    for start, end in ranges:
+        assert start < end
+        assert start % SHARD_ALIGN == 0
+
+
+def test_nonce_ranges_by_rate():
+    ranges = nonce_ranges([300, 100])
+    assert_partition(ranges)
+    assert ranges[0] == (0, 3 << 30)
+
+    # Devices without a rate yet get the average share.
+    ranges = nonce_ranges([0, 100, 0, 100])
+    assert_partition(ranges)
+    assert len(set(end - start for start, end in ranges)) == 1
+
+    # However slow, every device gets some nonces.
+    ranges = nonce_ranges([1e9, 1e-9, 1e-9, 1e9])
+    assert_partition(ranges)
+    assert ranges[1][1] - ranges[1][0] == SHARD_ALIGN
+
+    assert nonce_ranges([5]) == [(0, 1 << 32)]
+
+
+def test_queue_work_many_shards_one_unit():
+    miners = [FakeMiner(200), FakeMiner(100), FakeMiner(100),
+              FakeMiner(0, shardable=False)]
+    switch = make_switch(miners=miners, shard=True)
+    assert switch.work_units(miners) == 2
+    assert make_switch().work_units(miners) == 4
+
+    server = FakeSource()
+    switch.queue_work_many(server, [(HEADER, 'job', '00'),
+                                    (HEADER, 'job', '01')], TARGET)
+    works = [miner.work_queue.get(False) for miner in miners]
+    assert not any(miner.update for miner in miners)
+    assert [work.extranonce2 for work in works] == ['00', '00', '00', '01']
+    assert [(work.nonce_start, work.nonce_end) for work in works] == [
+        (0, 1 << 31), (1 << 31, 3 << 30), (3 << 30, 1 << 32), (0, 1 << 32)]
+    # Miners rolling ntime don't affect each other's work.
+    works[0].time += 1
+    assert works[1].time == works[0].time - 1
+
+
+def test_queue_work_shares_with_waiting_miners():
+    miners = [FakeMiner(100), FakeMiner(100), FakeMiner(100)]
+    switch = make_switch(miners=miners, shard=True)
+    miners[2].update = False
+
+    server = FakeSource()
+    # Work for a new block would flush every miner.
+    switch.new_block(switch.decode(server, HEADER, TARGET))
+    switch.queue_work(server, HEADER, TARGET, 'job', '00', miners[1])
+    assert [(work.nonce_start, work.nonce_end) for work in (
+        miners[1].work_queue.get(False), miners[0].work_queue.get(False))
+    ] == [(0, 1 << 31), (1 << 31, 1 << 32)]
+    assert miners[2].work_queue.empty()
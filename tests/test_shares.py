@@ -0,0 +1,92 @@
+import asyncio
+from binascii import unhexlify
+from types import SimpleNamespace
+
+from apoclypsebm.shares import ShareTracker, share_key
+from apoclypsebm.work_sources.stratum import StratumSource
+from conftest import SERVERS, FakeMiner, FakeSource, make_switch
+
+# The genesis block header with each word byte swapped, as sources give it,
+# and its nonce.
+GENESIS = unhexlify(
+    '01000000' + '00' * 32 +
+    '3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a'
+    '29ab5f49ffff001d1dac2b7c'
+)
+HEADER = b''.join(GENESIS[i:i + 4][::-1] for i in range(0, 76, 4)).hex()
+NONCE = 0x1dac2b7c
+# Any hash with its top 32 bits zero is a share.
+TARGET = '00' * 24 + 'ff' * 4 + '00' * 4
+
+
+def test_tracker_bounds_and_deduplicates():
+    tracker = ShareTracker(size=3)
+    assert tracker.stats() == {}
+    shares = [tracker.add(('source', 'job', '00', 0, nonce), miner=nonce)
+              for nonce in range(3)]
+    assert tracker.add(('source', 'job', '00', 0, 1)) is None
+    assert tracker.get(('source', 'job', '00', 0, 1)) is shares[1]
+    assert tracker.by_id(shares[2].id) is shares[2] and shares[2].miner == 2
+    assert tracker.pending == 3
+
+    assert tracker.answer(shares[0]) and not tracker.answer(shares[0])
+    tracker.discard(shares[1])
+    assert tracker.get(shares[1].key) is None and tracker.pending == 1
+
+    # The oldest shares make room for new ones.
+    tracker.add(('source', 'job', '01', 0, 0))
+    tracker.add(('source', 'job', '01', 0, 1))
+    assert tracker.get(shares[0].key) is None
+    assert tracker.by_id(shares[0].id) is None
+    assert len(tracker.shares) == 3 and tracker.evicted == 1
+
+    # Expired shares go too, answered or not.
+    tracker.ttl = -1
+    tracker.add(('source', 'job', '02', 0, 0))
+    assert len(tracker.shares) == 1 and tracker.pending == 1
+    assert tracker.stats() == {
+        'shares': '1 tracked, 1 pending, 1 duplicate, 4 expired'}
+
+
+def test_shares_are_sent_once():
+    switch = make_switch()
+    source = FakeSource()
+    work = switch.decode(source, HEADER, TARGET, 'job', '00')
+    switch.new_block(work)
+    switch.true_target = work.target
+    miner = FakeMiner()
+    result = SimpleNamespace(
+        header=work.header, job_id='job', extranonce2='00', server=source,
+        miner=miner, nonces=[NONCE], state=work.state, target=work.target,
+        merkle_end=work.merkle_end, time=work.time,
+        difficulty=work.difficulty, found=0)
+    sent = []
+
+    async def send(result, nonce):
+        sent.append(nonce)
+        return len(sent) > 1
+
+    # A share that couldn't be sent can be sent again, but only once.
+    assert not asyncio.run(switch.send(result, send))
+    assert asyncio.run(switch.send(result, send))
+    assert asyncio.run(switch.send(result, send))
+    assert sent == [NONCE, NONCE]
+
+    share = switch.shares.get(share_key(result, NONCE))
+    switch.report(share, True)
+    switch.report(share, True)
+    assert miner.share_count == [0, 1]
+
+
+def test_shares_for_ended_jobs_are_dropped():
+    switch = make_switch(SERVERS)
+    source = StratumSource(switch, switch.servers[0])
+    miner = FakeMiner()
+    result = SimpleNamespace(job_id='job', extranonce2='00', server=source,
+                             miner=miner, header=unhexlify(HEADER), time=0)
+    share = switch.shares.add(share_key(result, NONCE), miner=miner)
+
+    # The job ended between checking the share and sending it.
+    assert asyncio.run(source.send_internal(result, NONCE))
+    assert switch.shares.get(share.key) is None
+    assert switch.shares.pending == 0 and miner.stale_count == 1
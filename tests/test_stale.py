@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+from conftest import (HEADER, NEXT_HEADER, TARGET, FakeMiner, FakeSource,
+                      make_switch)
+
+
+def test_new_block_flushes_all_miners():
+    miners = [FakeMiner(), FakeMiner(), FakeMiner()]
+    switch = make_switch(miners=miners)
+    source = FakeSource()
+    switch.queue_work_many(source, [(HEADER, 'job', '00'),
+                                    (HEADER, 'job', '01'),
+                                    (HEADER, 'job', '02')], TARGET)
+    switch.queue_work_many(source, [(HEADER, 'job', '03')], TARGET,
+                           miners[:1])
+    assert [len(miner.work_queue.queue) for miner in miners] == [2, 1, 1]
+
+    # A long poll brings a new block for the first miner, the others drop
+    # their old work and ask for new.
+    switch.queue_work(source, NEXT_HEADER, TARGET, 'next')
+    work = miners[0].queued()
+    assert [w.job_id for w in work] == ['next']
+    for miner in miners[1:]:
+        assert miner.queued() == [None]
+        assert miner.update
+
+    # More work for the same block doesn't flush.
+    switch.queue_work(source, NEXT_HEADER, TARGET, 'next', miner=miners[1])
+    assert [w.job_id for w in miners[1].queued()] == ['next']
+    assert miners[0].work_queue.empty()
+
+    # Clean jobs flush even on the same block.
+    switch.queue_work_many(source, [(NEXT_HEADER, 'clean', '00')], TARGET,
+                           miners[:1], clean=True)
+    assert [w.job_id for w in miners[0].queued()] == ['clean']
+    assert miners[1].queued() == [None]
+
+    # Clean jobs on a new block make it the latest block all the same.
+    switch.queue_work_many(source, [(HEADER, 'back', '00')], TARGET,
+                           miners[:1], clean=True)
+    switch.queue_work(source, HEADER, TARGET, 'back', miner=miners[1])
+    assert [w.job_id for w in miners[0].queued()] == ['back']
+
+
+def test_stale_results_are_dropped():
+    miner = FakeMiner()
+    switch = make_switch(miners=[miner])
+    source = FakeSource()
+    switch.queue_work(source, HEADER, TARGET, 'job')
+    old = miner.queued()[0]
+    switch.queue_work(source, NEXT_HEADER, TARGET, 'job')
+    new = miner.queued()[0]
+
+    async def never(result, nonce):
+        raise AssertionError('stale result sent')
+
+    def result(work):
+        return SimpleNamespace(
+            header=work.header, job_id='job', server=source, miner=miner,
+            nonces=[], state=work.state, merkle_end=work.merkle_end,
+            time=work.time, difficulty=work.difficulty)
+
+    assert asyncio.run(switch.send(result(old), never))
+    assert miner.stale_count == 1
+    source.jobs.clear()
+    assert asyncio.run(switch.send(result(new), never))
+    assert miner.stale_count == 2
+    source.jobs.add('job')
+    assert asyncio.run(switch.send(result(new), never))
+    assert miner.stale_count == 2
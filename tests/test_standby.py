@@ -0,0 +1,144 @@
+import asyncio
+
+from apoclypsebm.mining.base import Miner
+from apoclypsebm.switch import SELECT_HOLD
+from apoclypsebm.work_sources.getwork import GetworkSource
+from apoclypsebm.work_sources.stratum import StratumSource
+from conftest import (HEADER, SERVERS, TARGET, FakeMiner, FakeSource,
+                      make_switch)
+
+NOTIFY = {'id': None, 'method': 'mining.notify', 'params': [
+    'job', '00' * 32,
+    '01000000010000000000000000000000000000000000000000000000000000000000'
+    '000000ffffffff20020862062f503253482f04b8864e5008',
+    '072f736c7573682f000000000100f2052a010000001976a914d23fcdf86f7e756a64a7'
+    'a9688ef9903327048ed988ac00000000',
+    [], '00000002', '1c2ac4af', '504e86b9', True]}
+
+
+def standby_switch(standby=1):
+    switch = make_switch(SERVERS, standby=standby)
+    switch.server_index = 0
+    return switch
+
+
+def test_standby_servers_follow_failover_order():
+    switch = standby_switch()
+    a, b, c = switch.servers
+    assert switch.standby_servers() == [b]
+    switch.options.standby = 2
+    assert switch.standby_servers() == [b, c]
+
+    # On a backup, the primary is kept on standby to fail back to.
+    switch.server_index, switch.backup_server_index = 1, 2
+    switch.options.standby = 1
+    assert switch.standby_servers() == [c, a]
+    switch.server_index, switch.backup_server_index = 2, 3
+    assert switch.standby_servers() == [a]
+    switch.options.standby = 0
+    assert switch.standby_servers() == []
+
+
+def test_promoting_a_standby_gives_its_job_at_once():
+    switch = standby_switch()
+    miner = Miner(0, switch.options)
+    switch.add_miner(miner)
+    miner.update = False
+    source = StratumSource(switch, switch.servers[1])
+    source.standby = True
+
+    # On standby, jobs are followed but miners don't get them.
+    source.handle_message(NOTIFY)
+    assert source.current_job.job_id == 'job'
+    assert miner.work_queue.empty()
+    assert not source.healthy()
+    source.ready.set()
+    assert source.healthy()
+
+    source.promote()
+    assert not source.standby
+    work = miner.work_queue.get(False)
+    assert work.job_id == 'job' and work.server is source
+
+
+def test_http_backups_are_not_kept_on_standby(monkeypatch):
+    miner = FakeMiner()
+    switch = make_switch([SERVERS[0], 'getwork+http://u:p@b:1#b'], [miner])
+    switch.server_index = 0
+    a, b = switch.servers
+    FakeSource(a)
+    assert switch.standby_servers() == [b]
+
+    async def getwork(self, data=None):
+        self.stratum_header = ''
+        return {'data': HEADER, 'target': TARGET}
+
+    # Checking for stratum, the backup gets work the miners mustn't get.
+    monkeypatch.setattr(GetworkSource, 'getwork', getwork)
+    assert asyncio.run(switch.run_standby(b)) is None
+    assert b.source.standby and b.source not in switch.sources
+    assert miner.work_queue.empty() and miner.update
+
+    # getwork doesn't follow jobs, so it is only connected to on failover.
+    assert switch.standby_servers() == []
+
+
+class FakeTask(object):
+    def done(self):
+        return False
+
+
+def test_latency_selection_has_hysteresis():
+    switch = standby_switch(standby=2)
+    switch.options.latency = True
+    a, b, c = switch.servers
+    for server in switch.servers:
+        FakeSource(server)
+        switch.standbys[server] = FakeTask()
+    del switch.standbys[a]
+    switch.sources = [a.source]
+    switch.server_since -= SELECT_HOLD
+
+    # Block notifies are timed against the first server to send them.
+    for server in switch.servers:
+        switch.endpoint_latency(server).add('rtt', 50)
+    switch.block_notified(b, 'block')
+    switch.blocks_seen['block'] -= 0.008
+    switch.block_notified(a, 'block')
+    assert switch.endpoint_latency(b).notify == 0
+    assert 8 <= switch.endpoint_latency(a).notify < 12
+
+    # b is faster, but not by enough to be worth switching to.
+    switch.select_server()
+    assert switch.next_server is None and not a.source.stopped
+
+    switch.endpoint_latency(c).rtt = 10
+    assert switch.healthy_standby() == 2
+    switch.select_server()
+    assert switch.next_server == 2 and a.source.stopped
+
+    # Nor right after a switch.
+    a.source.stopped = False
+    switch.next_server = None
+    switch.set_server_index(0)
+    switch.select_server()
+    assert switch.next_server is None and not a.source.stopped
+
+    # Only healthy servers are switched to, never back to the primary.
+    c.source.is_healthy = False
+    assert switch.healthy_standby() == 1
+    assert not switch.can_fail_back()
+
+
+def test_standby_work_is_not_decoded():
+    miner = FakeMiner()
+    switch = make_switch(miners=[miner])
+    source = FakeSource()
+    source.standby = True
+
+    def decode(*args):
+        raise AssertionError('work decoded for no miner')
+
+    switch.decode = decode
+    switch.queue_work(source, HEADER, TARGET, 'job')
+    assert miner.work_queue.empty() and source.last_block == ''
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import pytest
+
+from apoclypsebm.mining.telemetry import (EndpointLatency, Histogram,
+                                          LaunchTelemetry, ShareLatency)
+
+
+def event(start, end):
+    return SimpleNamespace(profile=SimpleNamespace(start=start, end=end))
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for ms in [0.3] * 90 + [8] * 9 + [1500]:
+        histogram.add(ms)
+    assert histogram.percentile(0.5) == 0.5
+    assert histogram.percentile(0.99) == 10
+    assert histogram.percentile(1) == 1500
+    assert abs(histogram.mean() - (27 + 72 + 1500) / 100) < 1e-9
+    assert str(histogram) == '<0.5:90 <10:9 >1000:1'
+
+
+def test_launch_telemetry():
+    telemetry = LaunchTelemetry()
+    assert telemetry.stats() == {}
+    ms = 1000000
+    assert telemetry.completed(event(0, 30 * ms),
+                               event(31 * ms, 31 * ms + 50000)) == 0.03
+    telemetry.completed(event(32 * ms, 62 * ms), event(62 * ms, 63 * ms))
+    assert telemetry.kernel.count == 2
+    assert telemetry.host_gap.count == 1
+    assert telemetry.host_gap.max == 2
+    assert telemetry.readback.max == 1
+    assert set(telemetry.stats()) == {'kernel ms', 'host gap ms',
+                                      'readback ms'}
+
+    telemetry.reset()
+    assert telemetry.stats() == {}
+    # The gap to the last kernel before a reset still counts.
+    telemetry.completed(event(63 * ms, 93 * ms), event(93 * ms, 94 * ms))
+    assert telemetry.host_gap.max == 1
+
+
+def test_share_latency():
+    latency = ShareLatency()
+    assert latency.stats() == {}
+    assert latency.add(10.0, 10.002, 10.052) == (
+        pytest.approx(2), pytest.approx(50))
+    latency.add(20.0, 20.001, 20.041)
+    assert latency.send.count == latency.answer.count == 2
+    assert latency.answer.max == pytest.approx(50)
+    assert set(latency.stats()) == {'send ms', 'answer ms'}
+
+
+def test_endpoint_latency():
+    latency = EndpointLatency(smoothing=0.5)
+    assert latency.score() is None
+    latency.add('connect', 30)
+    assert latency.score() == 30
+    latency.add('rtt', 20)
+    latency.add('rtt', 40)
+    latency.add('notify', 10)
+    assert latency.rtt == 30
+    assert latency.score() == 40
+    assert str(latency) == 'connect 30.0 ms rtt 30.0 ms notify 10.0 ms'
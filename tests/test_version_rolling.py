@@ -0,0 +1,32 @@
+from struct import unpack
+
+from apoclypsebm.sha256 import STATE, sha256
+from apoclypsebm.util import VERSION_ROLLING_MASK, rolled_versions
+from conftest import HEADER, TARGET, FakeSource, make_switch
+
+
+def test_rolled_versions():
+    assert rolled_versions(0x20000000, 0x6000, 8) == [
+        0x20000000, 0x20002000, 0x20004000, 0x20006000]
+    assert rolled_versions(0x20002000, VERSION_ROLLING_MASK, 3) == [
+        0x20002000, 0x20000000, 0x20006000]
+    assert rolled_versions(0x20000000, 0, 4) == [0x20000000]
+
+
+def test_decode_rolls_versions_allowed_by_source():
+    server = FakeSource()
+    server.version_mask = VERSION_ROLLING_MASK
+    job, = make_switch(version_rolls=4).decode_many(server, [(HEADER, 'job', '00')], TARGET)
+    assert job.versions == [1, 0x2001, 0x4001, 0x6001]
+    assert [header[:4].hex() for header in job.headers] == [
+        '00000001', '00002001', '00004001', '00006001']
+    assert job.state == job.states[0]
+    for header, state in zip(job.headers, job.states):
+        assert state == sha256(STATE, list(unpack('<16I', header[:64]))
+                               + [0] * 48)
+
+
+def test_decode_without_version_rolling():
+    job = make_switch(version_rolls=4).decode(FakeSource(), HEADER, TARGET, 'job', '00')
+    assert job.versions == [1]
+    assert len(job.states) == 1